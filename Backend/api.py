@@ -2,98 +2,146 @@ import os
 import sys
 import json
 import atexit
+import base64
+import binascii
+import hmac
 import uuid
 import time
 from flask import Flask, jsonify, request
 from flask_cors import CORS
-from multiprocessing import Process, Manager, Queue, freeze_support
-from main import main as run_bot_main # Import the bot's main function
+from multiprocessing import freeze_support
+from config_loader import load_config
+from metrics import render_prometheus
+from rate_limiter import shared_openai_buckets
+from supervisor import MailboxSupervisor
 
 # --- Flask App Initialization ---
 app = Flask(__name__)
 CORS(app, resources={r"/api/*": {"origins": "*"}})
 
-# This will hold our single bot process
-bot_process = None
-# This manager will be created inside the main block
-shared_state = None
+# Runs every mailbox on a pool of worker processes; created inside the main block
+supervisor = None
+# Shared secret the Pub/Sub push subscription appends to the webhook URL as ?token=...
+push_verification_token = ""
 
-# --- API Endpoints ---
+EMPTY_DASHBOARD = {
+    "bot_status": "Offline",
+    "stats": {"processed": 0, "replied": 0, "escalated": 0, "ignored": 0},
+    "cache_stats": {},
+    "rate_limits": {},
+    "context_stats": {},
+    "metrics": {},
+    "activity_log": [],
+    "mailboxes": {}
+}
+
+def unknown_mailbox(name):
+    return jsonify({"status": "error", "message": f"Unknown mailbox '{name}'."}), 404
+
+def decode_push_notification(envelope):
+    """Returns (email_address, history_id) from a Pub/Sub push request body. Raises ValueError if it is malformed."""
+    try:
+        data = json.loads(base64.b64decode(envelope['message']['data']))
+        return data['emailAddress'], int(data['historyId'])
+    except (KeyError, TypeError, ValueError, binascii.Error) as e:
+        raise ValueError(f"Malformed Gmail push notification: {e!r}")
+
+# --- API Endpoints: all mailboxes ---
 @app.route('/api/start', methods=['POST'])
 def start_bot():
-    global bot_process
-    if bot_process and bot_process.is_alive():
+    started = supervisor.start_all()
+    if not started:
         return jsonify({"status": "error", "message": "Bot is already running."}), 400
-
-    shared_state['bot_status'] = 'Starting...'
-    
-    # Pass the shared state to the target function
-    bot_process = Process(target=run_bot_main, args=(shared_state, None)) # Queue is not used for now
-    bot_process.daemon = True
-    bot_process.start()
-    
-    shared_state['bot_process_pid'] = bot_process.pid
-    return jsonify({"status": "success", "message": "Bot started.", "pid": bot_process.pid})
+    return jsonify({"status": "success", "message": f"Started {len(started)} mailboxes.", "mailboxes": started})
 
 @app.route('/api/stop', methods=['POST'])
 def stop_bot():
-    global bot_process
-    if not bot_process or not bot_process.is_alive():
+    stopped = supervisor.stop_all()
+    if not stopped:
         return jsonify({"status": "error", "message": "Bot is not running."}), 400
-
-    print(f"Stopping bot process with PID: {bot_process.pid}")
-    bot_process.terminate()
-    bot_process.join(timeout=5)
-    bot_process = None
-    
-    if shared_state:
-        shared_state['bot_status'] = 'Offline'
-        shared_state['bot_process_pid'] = None
-    
-    return jsonify({"status": "success", "message": "Bot stopped."})
+    print(f"Stopping mailboxes: {', '.join(stopped)}")
+    return jsonify({"status": "success", "message": f"Stopping {len(stopped)} mailboxes.", "mailboxes": stopped})
 
 @app.route('/api/dashboard-data', methods=['GET'])
 def get_dashboard_data():
-    if not shared_state:
-         return jsonify({
-            "bot_status": "Offline",
-            "stats": {"processed": 0, "replied": 0, "escalated": 0, "ignored": 0},
-            "activity_log": []
-         })
-
-    # Prune old log entries
-    activity_log = shared_state.get('activity_log', [])
-    while len(activity_log) > 50:
-        activity_log.pop()
-    
-    data = {
-        "bot_status": shared_state.get('bot_status', 'Unknown'),
-        "stats": dict(shared_state.get('stats', {})),
-        "activity_log": list(activity_log)
-    }
-    return jsonify(data)
+    if not supervisor:
+         return jsonify(EMPTY_DASHBOARD)
+    return jsonify(supervisor.aggregate_data())
+
+# --- Prometheus scrape endpoint ---
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    body = supervisor.prometheus_metrics() if supervisor else render_prometheus([])
+    return body, 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
+# --- Gmail push notifications (Pub/Sub push subscription) ---
+@app.route('/api/gmail/push', methods=['POST'])
+def receive_gmail_push():
+    if not push_verification_token:
+        # Anyone could trigger cycles through an endpoint without a token, so it stays off
+        return jsonify({"status": "error", "message": "Push notifications are disabled: settings.push_verification_token is not set."}), 403
+    if not hmac.compare_digest(request.args.get('token', ''), push_verification_token):
+        return jsonify({"status": "error", "message": "Invalid push token."}), 403
+    try:
+        email_address, history_id = decode_push_notification(request.get_json(silent=True))
+    except ValueError as e:
+        print(e)
+        return jsonify({"status": "error", "message": str(e)}), 400
+    if supervisor.notify(email_address, history_id) is None:
+        print(f"Ignoring push notification for {email_address}: no running mailbox has that address.")
+    # Acknowledge either way; Pub/Sub redelivers anything that is not a 2xx
+    return "", 204
+
+# --- API Endpoints: one mailbox ---
+@app.route('/api/mailboxes', methods=['GET'])
+def list_mailboxes():
+    supervisor.refresh()
+    return jsonify(supervisor.aggregate_data(activity_limit=0)['mailboxes'])
+
+@app.route('/api/mailboxes/<name>/start', methods=['POST'])
+def start_mailbox(name):
+    if name not in supervisor.names():
+        return unknown_mailbox(name)
+    if not supervisor.start(name):
+        return jsonify({"status": "error", "message": f"Mailbox '{name}' is already running."}), 400
+    return jsonify({"status": "success", "message": f"Mailbox '{name}' started."})
+
+@app.route('/api/mailboxes/<name>/stop', methods=['POST'])
+def stop_mailbox(name):
+    if name not in supervisor.names():
+        return unknown_mailbox(name)
+    if not supervisor.stop(name):
+        return jsonify({"status": "error", "message": f"Mailbox '{name}' is not running."}), 400
+    return jsonify({"status": "success", "message": f"Stopping mailbox '{name}'."})
+
+@app.route('/api/mailboxes/<name>/dashboard-data', methods=['GET'])
+def get_mailbox_dashboard_data(name):
+    if name not in supervisor.names():
+        return unknown_mailbox(name)
+    return jsonify(supervisor.mailbox_data(name))
 
 # --- Main Execution Block ---
 if __name__ == '__main__':
     # This is necessary for Windows multiprocessing
     freeze_support()
 
-    # Initialize the manager and shared state here
-    manager = Manager()
-    shared_state = manager.dict()
-    shared_state['bot_status'] = 'Offline'
-    shared_state['stats'] = manager.dict({"processed": 0, "replied": 0, "escalated": 0, "ignored": 0})
-    shared_state['activity_log'] = manager.list()
-    
-    # Define cleanup function here to have access to bot_process
+    # Initialize the supervisor here
+    settings = load_config()['settings']
+    push_verification_token = settings['push_verification_token']
+    if settings['push_topic_name'] and not push_verification_token:
+        print("WARNING: settings.push_topic_name is set but settings.push_verification_token is not. "
+              "/api/gmail/push stays disabled and every mailbox polls instead.")
+    supervisor = MailboxSupervisor(settings['mailboxes_dir'], ".", settings['worker_processes'], settings['max_mailboxes'],
+                                   openai_buckets=shared_openai_buckets(settings), push_enabled=bool(push_verification_token))
+    supervisor.start_monitor()
+    print(f"Found mailboxes: {', '.join(supervisor.names())}")
+
+    # Define cleanup function here to have access to the supervisor
     def cleanup():
-        global bot_process
-        if bot_process and bot_process.is_alive():
-            print("Flask app is shutting down. Terminating bot process...")
-            bot_process.terminate()
-            bot_process.join()
+        print("Flask app is shutting down. Stopping mailbox workers...")
+        supervisor.shutdown()
 
     atexit.register(cleanup)
 
     # Start the Flask server
-    app.run(port=5001, debug=True, use_reloader=False)
\ No newline at end of file
+    app.run(port=5001, debug=True, use_reloader=False)
@@ -0,0 +1,321 @@
+"""
+Asyncio engine for the bot loop, selected with settings.engine = "asyncio".
+
+OpenAI calls go through openai.AsyncOpenAI. Gmail calls keep using the
+blocking googleapiclient, but run on a dedicated thread pool where every
+thread owns its own service object. This keeps hundreds of emails in flight
+on one core. A cycle behaves like process_email_batch: emails in the same
+thread are handled in order, and the same labels, stats and activity log
+entries are written. Work-queue reads and writes hit SQLite, so they run
+off the loop too.
+
+Once an email's reply is about to go out, the rest of its handling runs in a
+shielded task that a cancelled cycle does not stop. The engine keeps those
+tasks and waits for them, up to shutdown_grace_seconds, before it shuts its
+Gmail thread pool down, and lets the sends that were already running finish
+afterwards. A reply is then never sent without its job advancing.
+"""
+import asyncio
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+import openai
+
+import main as bot
+
+
+class AsyncEmailEngine:
+    """Runs polling cycles on an event loop until the stop event is set."""
+
+    def __init__(self, service_factory, config, label_ids, state, openai_client):
+        settings = config['settings']
+        self.service_factory = service_factory
+        self.config = config
+        self.label_ids = label_ids
+        self.state = state
+        self.openai_client = openai_client
+        self.gmail_pool = ThreadPoolExecutor(max_workers=settings['max_concurrent_gmail_calls'], thread_name_prefix="gmail-io")
+        self.openai_slots = asyncio.Semaphore(settings['max_concurrent_openai_calls'])
+        self.email_slots = asyncio.Semaphore(settings['max_in_flight_emails'])
+        self._local = threading.local()
+        self._actions = set()  # shielded _apply_action tasks still running
+
+    # --- Gmail calls on the dedicated thread pool ---
+    def _with_service(self, fn, *args):
+        if not hasattr(self._local, 'service'):
+            self._local.service = self.service_factory()
+        return fn(self._local.service, *args)
+
+    async def gmail(self, fn, *args):
+        """Runs fn(service, *args) on the Gmail thread pool."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.gmail_pool, partial(self._with_service, fn, *args))
+
+    # --- OpenAI calls ---
+    async def call_openai(self, **request):
+        """Async counterpart of main.call_openai() for chat completions."""
+        create = partial(self.openai_client.chat.completions.create, **request)
+        if bot.rate_limiter is None:
+            response = await create()
+        else:
+            response = await bot.rate_limiter.openai_async(create, bot.estimate_request_tokens(request))
+        if bot.stage_metrics is not None:
+            bot.stage_metrics.record_tokens(getattr(response, 'usage', None))
+        return response
+
+    async def determine_user_intent(self, last_message_content, automated=None):
+        print("Determining user intent...")
+        local_intent = bot.classify_intent_locally(last_message_content, self.config, automated)
+        if local_intent:
+            return local_intent
+        try:
+            async with self.openai_slots:
+                response = await self.call_openai(**bot.build_intent_request(last_message_content, self.config))
+            intent = bot.clean_intent_output(response.choices[0].message.content)
+            bot.record_llm_intent(last_message_content, intent)
+            return intent
+        except Exception as e:
+            print(f"Error determining intent: {e}")
+            bot.record_stage_error('intent')
+            return bot.INTENT_ON_ERROR
+
+    async def determine_intent_and_reply(self, email_subject, conversation_history, thread_id, automated=None):
+        """Async counterpart of main.determine_intent_and_reply()."""
+        print("Determining user intent and drafting a reply in one call...")
+        last_message_content = conversation_history[-1]['content']
+        local_intent = bot.classify_intent_locally(last_message_content, self.config, automated)
+        if local_intent:
+            return local_intent, None
+        cached_reply = await asyncio.to_thread(bot.lookup_cached_reply, conversation_history)
+        if cached_reply:
+            intent = await self.determine_user_intent(last_message_content, automated)
+            return intent, cached_reply if intent == "question" else None
+        try:
+            async with self.openai_slots:
+                request = await asyncio.to_thread(bot.build_intent_reply_request, email_subject, conversation_history, self.config, thread_id)
+                response = await self.call_openai(**request)
+            intent, reply_text = bot.parse_intent_reply_output(response.choices[0].message.content)
+        except Exception as e:
+            print(f"Error determining intent and reply: {e}")
+            bot.record_stage_error('intent')
+            return bot.INTENT_ON_ERROR, None
+        bot.record_llm_intent(last_message_content, intent)
+        if intent != "question" or reply_text is None:
+            return intent, None
+        bot.record_prompt_tokens(request, response.usage, conversation_history)
+        await asyncio.to_thread(bot.store_cached_reply, conversation_history, reply_text, response.usage)
+        return intent, reply_text
+
+    async def generate_ai_reply(self, email_subject, conversation_history, thread_id):
+        print("Generating AI reply...")
+        # Cache lookups may compute an embedding, so keep them off the event loop
+        cached_reply = await asyncio.to_thread(bot.lookup_cached_reply, conversation_history)
+        if cached_reply:
+            return cached_reply
+        try:
+            async with self.openai_slots:
+                request = await asyncio.to_thread(bot.build_reply_request, email_subject, conversation_history, self.config, thread_id)
+                response = await self.call_openai(**request)
+            reply_text = response.choices[0].message.content.strip()
+            bot.record_prompt_tokens(request, response.usage, conversation_history)
+            await asyncio.to_thread(bot.store_cached_reply, conversation_history, reply_text, response.usage)
+            return reply_text
+        except Exception as e:
+            print(f"Error generating AI reply: {e}")
+            bot.record_stage_error('reply')
+            return bot.REPLY_ON_ERROR
+
+    # --- Email processing ---
+    async def process_email(self, email):
+        """Async counterpart of main.process_email()."""
+        job = await asyncio.to_thread(bot.claim_job, email)
+        if job['state'] == 'labelled':
+            print(f"Email {email['id']} was already handled. Re-applying its label.")
+            await self.gmail(bot.label_email, email['id'], self.label_ids, job['label_key'])
+            return True
+        if job['state'] == 'failed':
+            print(f"Email {email['id']} was set aside after {job['attempts']} failed attempts. Skipping it.")
+            return True
+
+        full_text = already_sent = None
+        if job['state'] == 'fetched':
+            bot.increment_stat(self.state, 'processed')
+            print(f"\nProcessing email from: {email['from']} | Subject: {email['subject']}")
+
+            with bot.stage_span('thread_fetch'):
+                thread_messages = await self.gmail(bot.fetch_thread_messages_or_empty, email['threadId'])
+            already_sent = bot.reply_already_sent(email, thread_messages)
+            if already_sent:
+                thread_messages = bot.messages_up_to(email, thread_messages)
+            conversation_history, full_text = bot.build_conversation(thread_messages)
+            if not conversation_history:
+                print("Could not fetch conversation history. Skipping.")
+                return
+
+            reply_text = None
+            with bot.stage_span('intent'):
+                if self.config['settings']['llm_call_mode'] == 'combined' and not already_sent:
+                    intent, reply_text = await self.determine_intent_and_reply(email['subject'], conversation_history, email['threadId'],
+                                                                               email.get('automated'))
+                else:
+                    intent = await self.determine_user_intent(conversation_history[-1]['content'], email.get('automated'))
+            if intent is None:
+                print("Could not determine intent. Leaving the email for a later cycle.")
+                return
+            action_taken, label_key = bot.plan_action(intent)
+            if action_taken == "Replied" and not already_sent and reply_text is None:
+                with bot.stage_span('reply'):
+                    reply_text = await self.generate_ai_reply(email['subject'], conversation_history, email['threadId'])
+            job = await asyncio.to_thread(bot.advance_job, job, 'classified', intent=intent, action=action_taken,
+                                          label_key=label_key, reply_text=reply_text)
+        else:
+            print(f"\nResuming email {email['id']} from state '{job['state']}'.")
+
+        # Once a reply goes out, the label and stats must follow even if we are being cancelled
+        action = asyncio.ensure_future(self._apply_action(email, job, full_text, already_sent))
+        self._actions.add(action)
+        action.add_done_callback(self._actions.discard)
+        return await asyncio.shield(action)
+
+    async def _apply_action(self, email, job, full_text, already_sent):
+        if job['state'] == 'classified':
+            if already_sent is None and job['action'] != "Ignored":
+                with bot.stage_span('thread_fetch'):
+                    thread_messages = await self.gmail(bot.fetch_thread_messages_or_empty, email['threadId'])
+                if not thread_messages:
+                    print("Could not check the thread for an earlier reply. Leaving the email for the next run.")
+                    return
+                already_sent = bot.reply_already_sent(email, thread_messages)
+            if already_sent:
+                print("A reply to this email was already sent. Not sending again.")
+            elif job['action'] != "Ignored":
+                with bot.stage_span('send'):
+                    sent = await self.gmail(bot.deliver_action, email, job, self.config, full_text)
+                if not sent:
+                    print("Sending failed. Leaving the email for a later cycle.")
+                    return
+            bot.increment_stat(self.state, job['label_key'])
+            job = await asyncio.to_thread(bot.advance_job, job, 'replied')
+
+        await self.gmail(bot.label_email, email['id'], self.label_ids, job['label_key'], job)
+        bot.log_activity(self.state, email['from'], job['intent'].capitalize(), job['action'])
+        print(f"--- Finished processing email {email['id']} ---")
+        return True
+
+    async def _process_thread(self, emails):
+        """Processes one thread's emails in order. Returns how many were left for a later cycle."""
+        deferred = 0
+        for email in emails:
+            async with self.email_slots:
+                try:
+                    with bot.stage_span('email'):
+                        handled = await self.process_email(email)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    print(f"An error occurred processing email {email['id']}: {e}")
+                    handled = False
+                if not handled and await asyncio.to_thread(bot.record_failed_attempt, email, self.config):
+                    deferred += 1
+        return deferred
+
+    async def process_email_batch(self, sync_state):
+        """Async counterpart of main.process_email_batch()."""
+        print("\nStarting Smart Agent Brain... Checking for new messages.")
+        cycle_started = time.perf_counter()
+        await asyncio.to_thread(bot.refresh_knowledge_base, self.config)
+        with bot.stage_span('fetch'):
+            unread_emails, checkpoint = await self.gmail(bot.fetch_new_emails, self.config, self.label_ids, sync_state)
+        unread_emails = await asyncio.to_thread(bot.merge_resumable_emails, unread_emails)
+
+        deferred = 0
+        if unread_emails:
+            print(f"\n--- Found {len(unread_emails)} new emails ---")
+            threads = {}
+            for email in unread_emails:
+                threads.setdefault(email['threadId'], []).append(email)
+            deferred = sum(await asyncio.gather(*(self._process_thread(thread_emails) for thread_emails in threads.values())))
+            await self.gmail(bot.flush_label_updates, self.config, self.label_ids)
+        else:
+            print("No new emails found.")
+
+        bot.commit_sync_checkpoint(self.config, sync_state, checkpoint, deferred)
+        await asyncio.to_thread(bot.maintain_work_queue, self.config)
+        bot.publish_cache_stats(self.state)
+        bot.publish_rate_limit_stats(self.state)
+        bot.publish_context_stats(self.state)
+        await asyncio.to_thread(bot.publish_metrics, self.state, len(unread_emails), cycle_started)
+        await asyncio.to_thread(bot.persist_caches)
+
+    async def close(self):
+        """
+        Waits up to shutdown_grace_seconds for shielded actions, then shuts the Gmail pool down off the loop.
+        Sends still running are let finish, so their jobs are advanced; Gmail calls not started by then fail.
+        """
+        pending = set(self._actions)
+        if pending:
+            print(f"Waiting for {len(pending)} emails whose replies are being sent...")
+            await asyncio.wait(pending, timeout=self.config['settings']['shutdown_grace_seconds'])
+        await asyncio.to_thread(self.gmail_pool.shutdown, wait=True)
+        if pending:
+            results = await asyncio.gather(*pending, return_exceptions=True)
+            stopped = sum(1 for result in results if isinstance(result, BaseException))
+            print(f"{stopped} emails were stopped mid-way. The next run resumes them from their recorded state.")
+
+    async def run(self, sync_state, stop_event):
+        """Polls until stop_event is set, then drains the current cycle within shutdown_grace_seconds."""
+        settings = self.config['settings']
+        interval = settings['polling_interval_seconds']
+        stopping = asyncio.create_task(_wait_for_event(stop_event))
+        try:
+            while not stopping.done():
+                cycle = asyncio.create_task(self.process_email_batch(sync_state))
+                await asyncio.wait({cycle, stopping}, return_when=asyncio.FIRST_COMPLETED)
+                if not cycle.done():
+                    print(f"Stop requested. Waiting up to {settings['shutdown_grace_seconds']}s for in-flight emails...")
+                    await asyncio.wait({cycle}, timeout=settings['shutdown_grace_seconds'])
+                    if not cycle.done():
+                        cycle.cancel()
+                        await asyncio.gather(cycle, return_exceptions=True)
+                    break
+                cycle.result()
+                print(f"Cycle complete. Sleeping for {interval} seconds.")
+                await asyncio.wait({stopping}, timeout=interval)
+        finally:
+            stopping.cancel()
+            await self.close()
+
+
+async def _wait_for_event(event, poll_seconds=0.2):
+    """Waits for a threading/multiprocessing Event without blocking the loop."""
+    while not event.is_set():
+        await asyncio.sleep(poll_seconds)
+
+
+def _create_openai_client():
+    # Retries are scheduled by the shared rate limiter, so the SDK must not add its own
+    return openai.AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"), max_retries=0 if bot.rate_limiter else openai.DEFAULT_MAX_RETRIES)
+
+
+async def run_async_cycle(service_factory, config, label_ids, state, sync_state):
+    """Runs a single polling cycle, for callers such as the supervisor that schedule cycles themselves."""
+    openai_client = _create_openai_client()
+    engine = AsyncEmailEngine(service_factory, config, label_ids, state, openai_client)
+    try:
+        await engine.process_email_batch(sync_state)
+    finally:
+        await engine.close()
+        await openai_client.close()
+
+
+async def run_async_bot(service_factory, config, label_ids, state, sync_state, stop_event):
+    """Entry point used by main.main() when settings.engine is "asyncio"."""
+    openai_client = _create_openai_client()
+    engine = AsyncEmailEngine(service_factory, config, label_ids, state, openai_client)
+    try:
+        await engine.run(sync_state, stop_event)
+    finally:
+        await openai_client.close()
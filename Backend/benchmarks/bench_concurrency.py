@@ -0,0 +1,93 @@
+"""
+Measures process_email_batch throughput for different worker counts, and for
+the asyncio engine, against the fake Gmail server and a fake OpenAI client
+with simulated latency.
+
+Usage (from the Backend directory):
+    python benchmarks/bench_concurrency.py [--emails 40] [--gmail-latency 0.02] [--openai-latency 0.2]
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("OPENAI_API_KEY", "sk-benchmark")
+
+from fake_gmail import FakeGmailServer  # noqa: E402
+from fake_openai import FakeAsyncOpenAI, FakeOpenAI  # noqa: E402
+import async_engine  # noqa: E402
+import main  # noqa: E402
+from telemetry import Telemetry  # noqa: E402
+
+
+def run_once(config, emails, workers, gmail_latency, openai_latency):
+    config['settings'].update(worker_count=workers, max_concurrent_gmail_calls=workers, max_concurrent_openai_calls=workers)
+    main.client = FakeOpenAI(latency=openai_latency)
+    with FakeGmailServer(latency=gmail_latency) as server:
+        server.mailbox.seed(emails)
+        service = server.build_service()
+        with contextlib.redirect_stdout(io.StringIO()):
+            label_ids = {key: main.get_or_create_label_id(service, name) for key, name in config['labels'].items()}
+        state = Telemetry()
+        processor = main.ConcurrentEmailProcessor(server.build_service, config['settings']) if workers > 1 else None
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            main.process_email_batch(service, config, label_ids, state, None, processor)
+        elapsed = time.perf_counter() - start
+        if processor:
+            processor.shutdown()
+    assert state.stats()['processed'] == emails and len(state.recent_activity(emails)) == emails
+    return elapsed
+
+
+def run_async_once(config, emails, gmail_latency, openai_latency):
+    with FakeGmailServer(latency=gmail_latency) as server:
+        server.mailbox.seed(emails)
+        service = server.build_service()
+        with contextlib.redirect_stdout(io.StringIO()):
+            label_ids = {key: main.get_or_create_label_id(service, name) for key, name in config['labels'].items()}
+        state = Telemetry()
+
+        async def one_cycle():
+            engine = async_engine.AsyncEmailEngine(server.build_service, config, label_ids, state, FakeAsyncOpenAI(latency=openai_latency))
+            try:
+                await engine.process_email_batch(None)
+            finally:
+                await engine.close()
+
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            asyncio.run(one_cycle())
+        elapsed = time.perf_counter() - start
+    assert state.stats()['processed'] == emails and len(state.recent_activity(emails)) == emails
+    return elapsed
+
+
+def run(emails, gmail_latency, openai_latency):
+    with open(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "config.json")) as f:
+        config = json.load(f)
+    config['settings']['sync_mode'] = 'search'
+    print(f"{emails} emails, Gmail latency {gmail_latency * 1000:.0f} ms, OpenAI latency {openai_latency * 1000:.0f} ms")
+    print(f"{'workers':>7} | {'wall time':>9} | {'emails/sec':>10} | {'speedup':>7}")
+    baseline = None
+    for workers in (1, 2, 4, 8, 16):
+        elapsed = run_once(config, emails, workers, gmail_latency, openai_latency)
+        baseline = baseline or elapsed
+        print(f"{workers:>7} | {elapsed:>8.2f}s | {emails / elapsed:>10.1f} | {baseline / elapsed:>6.1f}x")
+    config['settings'].update(max_concurrent_gmail_calls=16, max_concurrent_openai_calls=emails, max_in_flight_emails=emails)
+    elapsed = run_async_once(config, emails, gmail_latency, openai_latency)
+    print(f"{'asyncio':>7} | {elapsed:>8.2f}s | {emails / elapsed:>10.1f} | {baseline / elapsed:>6.1f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--emails", type=int, default=40)
+    parser.add_argument("--gmail-latency", type=float, default=0.02)
+    parser.add_argument("--openai-latency", type=float, default=0.2)
+    args = parser.parse_args()
+    run(args.emails, args.gmail_latency, args.openai_latency)
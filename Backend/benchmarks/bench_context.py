@@ -0,0 +1,86 @@
+"""
+Prompt size and LLM time for replies along one long thread, sending the full
+history versus the token-budgeted context with a rolling summary.
+
+The thread alternates customer messages and bot replies. The bot answers every
+customer message as the thread grows to --messages messages. The fake OpenAI
+client charges a fixed latency plus a prefill cost per 1k prompt tokens, so
+LLM time follows prompt size as it does on the real API. Summary calls count
+towards the budgeted totals.
+
+Usage (from the Backend directory):
+    python benchmarks/bench_context.py [--messages 40] [--budget 3000]
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("OPENAI_API_KEY", "sk-benchmark")
+
+from fake_openai import FakeOpenAI  # noqa: E402
+from context_builder import ContextStats, SummaryCache, TokenCounter  # noqa: E402
+import main  # noqa: E402
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def make_turns(messages):
+    turns = []
+    for i in range(messages):
+        if i % 2 == 0:
+            text = (f"Hi, follow-up {i // 2} on my order #{1000 + i}: the export still fails after your last suggestion. "
+                    + "I tried clearing the cache, reinstalling and switching browsers, and I attached the error below. " * 6)
+            turns.append({"role": "user", "content": text})
+        else:
+            turns.append({"role": "assistant", "content": "Thanks for the details. Please try the following steps in order. " * 8})
+    return turns
+
+
+def run_mode(budgeted, turns, config, latency, prompt_latency_per_1k):
+    main.client = FakeOpenAI(latency=latency, prompt_latency_per_1k=prompt_latency_per_1k)
+    main.context_stats = ContextStats()
+    with tempfile.TemporaryDirectory() as tmp:
+        if budgeted:
+            main.token_counter = TokenCounter.for_model(config['settings']['openai_model'])
+            main.summary_cache = SummaryCache(os.path.join(tmp, "summary_cache.json"), 100)
+        else:
+            main.token_counter = main.summary_cache = None
+        last_prompt = 0
+        start = time.perf_counter()
+        for end in range(1, len(turns) + 1, 2):
+            before = main.client.prompt_tokens
+            main.generate_ai_reply("Export fails", turns[:end], config, "thread-1")
+            last_prompt = main.client.prompt_tokens - before
+        elapsed = time.perf_counter() - start
+    client = main.client
+    summary_stats = main.summary_cache.stats() if budgeted else {"updates": 0, "misses": 0}
+    return (client.calls, summary_stats['updates'] + summary_stats['misses'], client.prompt_tokens, last_prompt, elapsed)
+
+
+def run(messages, budget, latency, prompt_latency_per_1k):
+    with open(os.path.join(BACKEND_DIR, "config.json")) as f:
+        config = json.load(f)
+    config['settings']['context_token_budget'] = budget
+    turns = make_turns(messages)
+    counter = TokenCounter.for_model(config['settings']['openai_model'])
+    print(f"{(messages + 1) // 2} replies along a {messages}-message thread "
+          f"({counter.count_messages(turns)} tokens in full, {'tiktoken' if counter.encoding else 'estimated'}), "
+          f"budget {budget} tokens, LLM latency {latency * 1000:.0f} ms + {prompt_latency_per_1k * 1000:.0f} ms/1k prompt tokens")
+    print(f"{'context':>8} | {'calls':>5} | {'summaries':>9} | {'prompt tokens':>13} | {'last reply':>10} | {'LLM time':>8}")
+    for name, budgeted in (("full", False), ("budgeted", True)):
+        calls, summaries, prompt_tokens, last_prompt, elapsed = run_mode(budgeted, turns, config, latency, prompt_latency_per_1k)
+        print(f"{name:>8} | {calls:>5} | {summaries:>9} | {prompt_tokens:>13,} | {last_prompt:>10,} | {elapsed:>7.2f}s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--messages", type=int, default=40)
+    parser.add_argument("--budget", type=int, default=3000)
+    parser.add_argument("--latency", type=float, default=0.3)
+    parser.add_argument("--prompt-latency-per-1k", type=float, default=0.05)
+    args = parser.parse_args()
+    run(args.messages, args.budget, args.latency, args.prompt_latency_per_1k)
@@ -0,0 +1,89 @@
+"""
+Measures knowledge-base retrieval latency at 10k and 100k chunks, for BM25
+alone and for BM25 fused with a memory-mapped embedding matrix.
+
+Chunks are synthetic: words drawn from a Zipf-distributed vocabulary, so
+posting-list lengths look like those of real prose.
+
+Usage (from the Backend directory):
+    python benchmarks/bench_kb_retrieval.py [--sizes 10000 100000] [--queries 200] [--dims 256]
+"""
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from knowledge_base import KnowledgeBaseIndex  # noqa: E402
+
+VOCABULARY_SIZE = 30000
+CHUNK_WORDS = 150
+
+
+def make_vocabulary(rng):
+    letters = np.array(list("abcdefghijklmnopqrstuvwxyz"))
+    return ["".join(rng.choice(letters, size=rng.integers(4, 10))) for _ in range(VOCABULARY_SIZE)]
+
+
+def sample_text(rng, vocabulary, words):
+    ranks = np.minimum(rng.zipf(1.2, size=words), VOCABULARY_SIZE) - 1
+    return " ".join(vocabulary[r] for r in ranks)
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+def time_queries(search, queries):
+    latencies = []
+    for query in queries:
+        start = time.perf_counter()
+        search(query)
+        latencies.append((time.perf_counter() - start) * 1000)
+    return statistics.median(latencies), percentile(latencies, 99)
+
+
+def run(sizes, query_count, dims):
+    rng = np.random.default_rng(0)
+    vocabulary = make_vocabulary(rng)
+    queries = [sample_text(rng, vocabulary, 12) for _ in range(query_count)]
+    print(f"{'chunks':>8} | {'build':>8} | {'mode':>10} | {'p50 ms':>7} | {'p99 ms':>7}")
+    for size in sizes:
+        index = KnowledgeBaseIndex(CHUNK_WORDS)
+        start = time.perf_counter()
+        for i in range(size):
+            index.add_chunk(f"doc{i // 20}.md", sample_text(rng, vocabulary, CHUNK_WORDS))
+        build_seconds = time.perf_counter() - start
+
+        p50, p99 = time_queries(lambda q: index.search(q, 4), queries)
+        print(f"{size:>8} | {build_seconds:>7.1f}s | {'bm25':>10} | {p50:>7.2f} | {p99:>7.2f}")
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "embeddings.npy")
+            matrix = np.lib.format.open_memmap(path, mode="w+", dtype=np.float32, shape=(size, dims))
+            for start_row in range(0, size, 10000):
+                block = rng.standard_normal((min(10000, size - start_row), dims)).astype(np.float32)
+                matrix[start_row:start_row + len(block)] = block / np.linalg.norm(block, axis=1, keepdims=True)
+            matrix.flush()
+            del matrix
+            index.embedding_rows = {chunk_id: row for row, chunk_id in enumerate(index.chunks)}
+            index.embedder = lambda texts: rng.standard_normal((len(texts), dims))
+            index.load_embeddings(path)
+            p50, p99 = time_queries(lambda q: index.search(q, 4), queries)
+            index._embeddings = None
+        print(f"{size:>8} | {'':>8} | {'bm25+embed':>10} | {p50:>7.2f} | {p99:>7.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000])
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--dims", type=int, default=256)
+    args = parser.parse_args()
+    run(args.sizes, args.queries, args.dims)
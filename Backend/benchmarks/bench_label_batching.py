@@ -0,0 +1,149 @@
+"""
+Gmail write calls per 1000 emails with one messages.modify per email versus
+label updates batched into messages.batchModify at the end of the cycle.
+
+A mailbox is set up with setup_mailbox() against the fake Gmail server, using
+a temporary directory for its state files. It then polls an inbox that is
+mostly ignorable follow-ups, with some questions and escalations, until every
+email is handled (messages.list returns up to 100 emails per cycle). Quota units
+are counted with rate_limiter.GMAIL_QUOTA_UNITS. The raised quota keeps the
+rate limiter from throttling either run. The benchmark also reports the
+labels.list calls made at startup, with an empty and a warm label cache, and
+checks that a label deleted in Gmail is looked up again.
+
+Usage (from the Backend directory):
+    python benchmarks/bench_label_batching.py [--emails 1000] [--workers 8]
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("OPENAI_API_KEY", "sk-benchmark")
+
+from fake_gmail import FakeGmailServer  # noqa: E402
+from fake_openai import FakeOpenAI  # noqa: E402
+import main  # noqa: E402
+from rate_limiter import GMAIL_QUOTA_UNITS  # noqa: E402
+from telemetry import Telemetry  # noqa: E402
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WRITE_METHODS = ("messages.modify", "messages.batchModify", "messages.send", "labels.create")
+# 70% follow-ups, 25% questions, 5% escalations
+TRAFFIC = ["Thanks, that fixed it."] * 14 + ["How do I export my data?"] * 5 + ["Please let me talk to a human agent."]
+
+
+def make_config(root, workers):
+    with open(os.path.join(BACKEND_DIR, "config.json")) as f:
+        config = json.load(f)
+    settings = config['settings']
+    for key, value in settings.items():
+        if key.endswith("_file"):
+            settings[key] = os.path.join(root, value)
+    settings.update(sync_mode='search', worker_count=workers, max_concurrent_gmail_calls=workers,
+                    max_concurrent_openai_calls=workers, gmail_quota_units_per_second=1e6)
+    return config
+
+
+def seed(mailbox, emails):
+    for i in range(emails):
+        mailbox.add_message("Customer <customer@example.com>", f"Ticket {i}", TRAFFIC[i % len(TRAFFIC)])
+
+
+def setup(config, server):
+    """Sets up a fresh mailbox context and returns (service, label_ids, labels.list calls made)."""
+    for name, value in main.new_mailbox_context().items():
+        setattr(main, name, value)
+    main.client = FakeOpenAI()
+    server.mailbox.reset_counters()
+    with contextlib.redirect_stdout(io.StringIO()):
+        service, label_ids, _ = main.setup_mailbox(config, server.build_service)
+    return service, label_ids, server.mailbox.calls.get("labels.list", 0)
+
+
+def unread_count(mailbox):
+    return sum("UNREAD" in m["labelIds"] for m in mailbox.messages.values())
+
+
+def run_cycles(config, server, service, label_ids, emails):
+    """Runs polling cycles until the inbox is empty. Returns (wall time, cycles, calls by method)."""
+    processor = main.ConcurrentEmailProcessor(server.build_service, config['settings']) if config['settings']['worker_count'] > 1 else None
+    state = Telemetry()
+    server.mailbox.reset_counters()
+    start = time.perf_counter()
+    cycles = 0
+    with contextlib.redirect_stdout(io.StringIO()):
+        while unread_count(server.mailbox) and cycles < emails:
+            main.process_email_batch(service, config, label_ids, state, None, processor)
+            cycles += 1
+        main.shutdown_mailbox(processor)
+    elapsed = time.perf_counter() - start
+    assert state.stats()['processed'] == emails and not unread_count(server.mailbox), "every email must be handled and marked read"
+    return elapsed, cycles, dict(server.mailbox.calls)
+
+
+def run_once(mode, emails, workers, gmail_latency):
+    root = tempfile.mkdtemp(prefix="bench_labels_")
+    config = make_config(root, workers)
+    try:
+        with FakeGmailServer(latency=gmail_latency) as server:
+            seed(server.mailbox, emails)
+            service, label_ids, cold_lists = setup(config, server)
+            if mode == "per-email":
+                main.label_updates = None
+            elapsed, cycles, calls = run_cycles(config, server, service, label_ids, emails)
+            _, _, warm_lists = setup(config, server)
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+    return elapsed, cycles, calls, cold_lists, warm_lists
+
+
+def check_stale_label(workers):
+    """A label deleted by a user is looked up again and the batch retried. Returns the calls made."""
+    root = tempfile.mkdtemp(prefix="bench_labels_")
+    config = make_config(root, workers)
+    try:
+        with FakeGmailServer() as server:
+            setup(config, server)
+            server.mailbox.delete_label(main.resolve_label_ids(server.build_service(), config)['ignored'])
+            seed(server.mailbox, len(TRAFFIC))
+            service, label_ids, _ = setup(config, server)
+            _, _, calls = run_cycles(config, server, service, label_ids, len(TRAFFIC))
+            ignored = [m for m in server.mailbox.messages.values() if label_ids['ignored'] in m["labelIds"]]
+            assert len(ignored) == TRAFFIC.count(TRAFFIC[0]), "ignored emails must get the re-created label"
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+    return calls
+
+
+def run(emails, workers, gmail_latency):
+    print(f"{emails} emails (70% follow-ups, 25% questions, 5% escalations), {workers} workers, "
+          f"Gmail latency {gmail_latency * 1000:.0f} ms")
+    print(f"{'labels':>9} | {'cycles':>6} | {'modify':>6} | {'batchModify':>11} | {'send':>4} | {'writes/1000':>11} | "
+          f"{'write units/1000':>16} | {'round trips':>11} | {'wall time':>9} | {'startup labels.list':>19}")
+    for mode in ("per-email", "batched"):
+        elapsed, cycles, calls, cold_lists, warm_lists = run_once(mode, emails, workers, gmail_latency)
+        writes = sum(calls.get(method, 0) for method in WRITE_METHODS)
+        units = sum(calls.get(method, 0) * GMAIL_QUOTA_UNITS[method] for method in WRITE_METHODS)
+        round_trips = sum(calls.values())
+        print(f"{mode:>9} | {cycles:>6} | {calls.get('messages.modify', 0):>6} | {calls.get('messages.batchModify', 0):>11} | "
+              f"{calls.get('messages.send', 0):>4} | {writes * 1000 / emails:>11.0f} | {units * 1000 / emails:>16,.0f} | "
+              f"{round_trips:>11} | {elapsed:>8.2f}s | {f'{cold_lists} cold, {warm_lists} warm':>19}")
+    calls = check_stale_label(workers)
+    print(f"Deleted label: recovered with {calls.get('labels.list', 0)} labels.list, {calls.get('labels.create', 0)} labels.create "
+          f"and {calls.get('messages.batchModify', 0)} batchModify calls")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--emails", type=int, default=1000)
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--gmail-latency", type=float, default=0.005)
+    args = parser.parse_args()
+    run(args.emails, args.workers, args.gmail_latency)
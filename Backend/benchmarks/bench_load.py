@@ -0,0 +1,248 @@
+"""
+Offline load test: replays an email corpus through process_email_batch() end
+to end and reports throughput, per-email latency and peak memory.
+
+Gmail is an in-process fake_gmail.FakeMailbox behind googleapiclient, and
+OpenAI is fake_openai.FakeOpenAI, so the run needs no network, credentials or
+OPENAI_API_KEY. Both fakes can add latency and inject errors: 503s from Gmail
+and 429s or 500s from OpenAI, which the rate limiter retries with the short
+backoff set here. The corpus comes from corpus.generate() or a saved file, so
+a run can be replayed exactly. Polling cycles run until every thread's last
+message is handled and marked read, or --max-cycles is reached.
+
+Latencies are exact: the harness swaps the mailbox's StageMetrics for one that
+also keeps every sample. Peak RSS is the process' high-water mark.
+
+--json saves the results. --baseline compares them with a saved run and exits
+with status 1 if throughput dropped, or p99 latency or peak RSS rose, by more
+than --tolerance.
+
+Usage (from the Backend directory):
+    python benchmarks/bench_load.py [--threads 500] [--workers 8] [--engine threads|asyncio]
+        [--corpus corpus.jsonl] [--gmail-error-rate 0.02] [--openai-error-rate 0.02]
+        [--json results.json] [--baseline results.json --tolerance 0.2]
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import corpus as corpora  # noqa: E402
+from fake_gmail import FakeMailbox, build_inprocess_service  # noqa: E402
+from fake_openai import FakeAsyncOpenAI, FakeOpenAI  # noqa: E402
+import async_engine  # noqa: E402
+import main  # noqa: E402
+from metrics import StageMetrics  # noqa: E402
+from telemetry import Telemetry  # noqa: E402
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+REPORTED_STAGES = ("email", "fetch", "thread_fetch", "intent", "reply", "send", "label", "cycle")
+
+
+class RecordingStageMetrics(StageMetrics):
+    """StageMetrics that also keeps every observed duration, for exact percentiles."""
+
+    def __init__(self):
+        super().__init__()
+        self.samples = {}
+
+    def observe(self, stage, seconds, failed=False):
+        super().observe(stage, seconds, failed)
+        with self._lock:
+            self.samples.setdefault(stage, []).append(seconds)
+
+
+def percentile(q, values):
+    """Nearest-rank q-quantile of values, or None if there are none."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, round(q * len(ordered)) - 1))]
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def make_config(root, workers):
+    with open(os.path.join(BACKEND_DIR, "config.json")) as f:
+        config = json.load(f)
+    settings = config['settings']
+    for key, value in settings.items():
+        if key.endswith("_file"):
+            settings[key] = os.path.join(root, value)
+    settings.update(sync_mode='search', worker_count=workers, max_concurrent_gmail_calls=workers,
+                    max_concurrent_openai_calls=workers, max_in_flight_emails=max(workers, settings['max_in_flight_emails']),
+                    gmail_quota_units_per_second=1e6, openai_requests_per_minute=1e9, openai_tokens_per_minute=1e12,
+                    retry_base_seconds=0.01, retry_max_seconds=0.1)
+    return config
+
+
+def unread_count(mailbox):
+    with mailbox.lock:
+        return sum("UNREAD" in m["labelIds"] and "INBOX" in m["labelIds"] for m in mailbox.messages.values())
+
+
+def run_threads(config, service, label_ids, state, service_factory, max_cycles, mailbox):
+    settings = config['settings']
+    processor = main.ConcurrentEmailProcessor(service_factory, settings) if settings['worker_count'] > 1 else None
+    cycles = 0
+    try:
+        while unread_count(mailbox) and cycles < max_cycles:
+            main.process_email_batch(service, config, label_ids, state, None, processor)
+            cycles += 1
+    finally:
+        main.shutdown_mailbox(processor)
+    return cycles
+
+
+def run_asyncio(config, label_ids, state, service_factory, max_cycles, mailbox, openai_client):
+    async def cycles():
+        engine = async_engine.AsyncEmailEngine(service_factory, config, label_ids, state, openai_client)
+        count = 0
+        try:
+            while unread_count(mailbox) and count < max_cycles:
+                await engine.process_email_batch(None)
+                count += 1
+        finally:
+            await engine.close()
+        return count
+
+    try:
+        return asyncio.run(cycles())
+    finally:
+        main.shutdown_mailbox()
+
+
+def run(threads_corpus, args):
+    mailbox = FakeMailbox()
+    emails = corpora.load_into(mailbox, threads_corpus)
+    if args.gmail_error_rate:
+        mailbox.inject_errors(args.gmail_error_rate, seed=args.seed)
+    openai_client = (FakeAsyncOpenAI if args.engine == "asyncio" else FakeOpenAI)(latency=args.openai_latency)
+    if args.openai_error_rate:
+        openai_client.inject_errors(args.openai_error_rate, status=args.openai_error_status, seed=args.seed)
+
+    def service_factory():
+        return build_inprocess_service(mailbox, args.gmail_latency)
+
+    root = tempfile.mkdtemp(prefix="bench_load_")
+    config = make_config(root, args.workers)
+    rss_before = peak_rss_mb()
+    try:
+        for name, value in main.new_mailbox_context().items():
+            setattr(main, name, value)
+        main.client = openai_client if args.engine == "threads" else FakeOpenAI()
+        state = Telemetry()
+        with contextlib.redirect_stdout(io.StringIO()):
+            service, label_ids, _ = main.setup_mailbox(config, service_factory)
+            main.stage_metrics = recorder = RecordingStageMetrics()
+            mailbox.reset_counters()
+            start = time.perf_counter()
+            if args.engine == "asyncio":
+                cycles = run_asyncio(config, label_ids, state, service_factory, args.max_cycles, mailbox, openai_client)
+            else:
+                cycles = run_threads(config, service, label_ids, state, service_factory, args.max_cycles, mailbox)
+            elapsed = time.perf_counter() - start
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+    stats = state.stats()
+    handled = sum(stats[key] for key in ("replied", "escalated", "ignored"))
+    retries = state.document('rate_limits') or {}
+    latency = {}
+    for stage in REPORTED_STAGES:
+        samples = recorder.samples.get(stage, [])
+        if samples:
+            latency[stage] = {"count": len(samples), **{f"p{q}_ms": round(percentile(q / 100, samples) * 1000, 2) for q in (50, 90, 99)},
+                              "max_ms": round(max(samples) * 1000, 2)}
+    return {
+        "engine": args.engine, "workers": args.workers, "threads": len(threads_corpus), "emails": emails,
+        "handled": handled, "left_unread": unread_count(mailbox), "cycles": cycles, "wall_seconds": round(elapsed, 3),
+        "emails_per_second": round(handled / elapsed, 2) if elapsed else 0.0,
+        "latency": latency,
+        "peak_rss_mb": round(peak_rss_mb(), 1), "rss_before_run_mb": round(rss_before, 1),
+        "gmail": {"round_trips": mailbox.round_trips, "calls": sum(mailbox.calls.values()), "injected_errors": mailbox.injected_errors,
+                  "retries": retries.get('gmail', {}).get('retries', 0)},
+        "openai": {"calls": openai_client.calls, "injected_errors": openai_client.injected_errors,
+                   "retries": retries.get('openai', {}).get('retries', 0)},
+        "activity": {key: stats[key] for key in ("replied", "escalated", "ignored")},
+    }
+
+
+def report(result):
+    print(f"{result['engine']} engine, {result['workers']} workers: {result['handled']} of {result['emails']} emails handled "
+          f"in {result['cycles']} cycles, {result['wall_seconds']:.2f}s, {result['emails_per_second']:.1f} emails/sec "
+          f"({', '.join(f'{k} {v}' for k, v in result['activity'].items())})")
+    print(f"{'stage':>12} | {'count':>6} | {'p50 ms':>8} | {'p90 ms':>8} | {'p99 ms':>8} | {'max ms':>8}")
+    for stage, data in result['latency'].items():
+        print(f"{stage:>12} | {data['count']:>6} | {data['p50_ms']:>8.1f} | {data['p90_ms']:>8.1f} | {data['p99_ms']:>8.1f} | {data['max_ms']:>8.1f}")
+    gmail, openai_stats = result['gmail'], result['openai']
+    print(f"Gmail: {gmail['round_trips']} round trips, {gmail['calls']} calls, {gmail['injected_errors']} injected errors, "
+          f"{gmail['retries']} retries. OpenAI: {openai_stats['calls']} calls, {openai_stats['injected_errors']} injected errors, "
+          f"{openai_stats['retries']} retries.")
+    print(f"Peak RSS {result['peak_rss_mb']:.1f} MB ({result['rss_before_run_mb']:.1f} MB before the run)")
+
+
+def regressions(result, baseline, tolerance):
+    """Returns a message for each headline number that is more than `tolerance` worse than in baseline."""
+    found = []
+    if result['emails_per_second'] < baseline['emails_per_second'] * (1 - tolerance):
+        found.append(f"throughput {result['emails_per_second']:.1f} emails/sec, baseline {baseline['emails_per_second']:.1f}")
+    p99, base_p99 = result['latency'].get('email', {}).get('p99_ms'), baseline['latency'].get('email', {}).get('p99_ms')
+    if p99 is not None and base_p99 is not None and p99 > base_p99 * (1 + tolerance):
+        found.append(f"email p99 {p99:.1f} ms, baseline {base_p99:.1f} ms")
+    if result['peak_rss_mb'] > baseline['peak_rss_mb'] * (1 + tolerance):
+        found.append(f"peak RSS {result['peak_rss_mb']:.1f} MB, baseline {baseline['peak_rss_mb']:.1f} MB")
+    return found
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--threads", type=int, default=500, help="threads to generate when --corpus is not given")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--corpus", help="replay a corpus saved with --save-corpus or corpus.py")
+    parser.add_argument("--save-corpus", help="write the generated corpus to this file")
+    parser.add_argument("--engine", choices=("threads", "asyncio"), default="threads")
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--gmail-latency", type=float, default=0.005)
+    parser.add_argument("--openai-latency", type=float, default=0.05)
+    parser.add_argument("--gmail-error-rate", type=float, default=0.0)
+    parser.add_argument("--openai-error-rate", type=float, default=0.0)
+    parser.add_argument("--openai-error-status", type=int, default=429)
+    parser.add_argument("--max-cycles", type=int, default=50)
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--baseline", help="results of an earlier run to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    if args.corpus:
+        threads_corpus = corpora.load(args.corpus)
+    else:
+        threads_corpus = corpora.generate(args.threads, args.seed)
+        if args.save_corpus:
+            corpora.save(threads_corpus, args.save_corpus)
+    print(f"Corpus: {corpora.describe(threads_corpus)}")
+    result = run(threads_corpus, args)
+    report(result)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(result, f, indent=2)
+    if result['left_unread']:
+        print(f"{result['left_unread']} emails were still unread after {result['cycles']} cycles.")
+    if args.baseline:
+        with open(args.baseline) as f:
+            found = regressions(result, json.load(f), args.tolerance)
+        for message in found:
+            print(f"REGRESSION: {message}")
+        sys.exit(1 if found else 0)
@@ -0,0 +1,148 @@
+"""
+Load test for the multi-mailbox supervisor: how emails/sec scales with the
+number of worker processes.
+
+Every mailbox gets its own fake Gmail server, each in a separate process so the
+servers never compete with the bot for a GIL, and a fake OpenAI client with
+simulated latency. The bot's Gmail and OpenAI quotas are raised for the run
+because the fakes do not enforce them. The real limit of 250 Gmail units/s per
+mailbox would otherwise cap each mailbox at about two replies per second. The
+OpenAI buckets are still shared by all workers, as under the API.
+
+With the default latencies most of a cycle is spent waiting, and a worker runs
+its mailboxes' cycles one after another. More processes then mostly overlap
+those waits, which helps even on one core. The "busy" column (worker CPU time
+divided by wall time) shows how many cores the workers actually kept busy. To
+measure scaling across cores, run with --gmail-latency 0 --openai-latency 0 on
+a machine with several cores; the speedup cannot exceed the core count there.
+
+Usage (from the Backend directory):
+    python benchmarks/bench_mailboxes.py [--mailboxes 8] [--emails 25] [--processes 1 2 4]
+"""
+import argparse
+import functools
+import json
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("OPENAI_API_KEY", "sk-benchmark")
+
+from fake_gmail import FakeGmailServer, build_fake_service  # noqa: E402
+from fake_openai import FakeOpenAI  # noqa: E402
+import main  # noqa: E402
+from rate_limiter import shared_openai_buckets  # noqa: E402
+from supervisor import MP_CONTEXT, MailboxSupervisor  # noqa: E402
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+if __name__ == "__mp_main__":
+    # Spawned workers and servers import this script under this name; keep their output off the table
+    sys.stdout = open(os.devnull, "w")
+
+
+def serve_fake_gmail(emails, latency, urls, index, stop_event):
+    with FakeGmailServer(latency=latency) as server:
+        server.mailbox.seed(emails)
+        urls.put((index, server.url))
+        stop_event.wait()
+
+
+def fake_service_factory(mailbox_dir, openai_latency):
+    # Runs in the worker, which is spawned and so has to install the fake OpenAI client itself
+    if main.client is None:
+        main.client = FakeOpenAI(latency=openai_latency)
+    with open(os.path.join(mailbox_dir, "fake_gmail_url")) as f:
+        url = f.read()
+    return lambda: build_fake_service(url)
+
+
+def make_settings():
+    with open(os.path.join(BACKEND_DIR, "config.json")) as f:
+        config = json.load(f)
+    config['settings'].update(sync_mode='search', polling_interval_seconds=1, gmail_quota_units_per_second=1e6,
+                              openai_requests_per_minute=1e6, openai_tokens_per_minute=1e9)
+    return config
+
+
+def make_mailboxes(root, urls):
+    config = make_settings()
+    for index, url in urls.items():
+        mailbox_dir = os.path.join(root, f"brand{index}")
+        os.makedirs(mailbox_dir)
+        with open(os.path.join(mailbox_dir, "config.json"), "w") as f:
+            json.dump(config, f)
+        with open(os.path.join(mailbox_dir, "fake_gmail_url"), "w") as f:
+            f.write(url)
+
+
+def run_once(mailboxes, emails, processes, gmail_latency, openai_latency):
+    stop_servers = MP_CONTEXT.Event()
+    url_queue = MP_CONTEXT.Queue()
+    servers = [MP_CONTEXT.Process(target=serve_fake_gmail, args=(emails, gmail_latency, url_queue, i, stop_servers), daemon=True)
+               for i in range(mailboxes)]
+    for server in servers:
+        server.start()
+    urls = dict(url_queue.get(timeout=30) for _ in servers)
+
+    root = tempfile.mkdtemp(prefix="bench_mailboxes_")
+    devnull = open(os.devnull, "w")
+    stdout, sys.stdout = sys.stdout, devnull
+    try:
+        make_mailboxes(root, urls)
+        supervisor = MailboxSupervisor(root, worker_processes=processes, max_mailboxes=mailboxes,
+                                       service_factory=functools.partial(fake_service_factory, openai_latency=openai_latency),
+                                       openai_buckets=shared_openai_buckets(make_settings()['settings']))
+        # Workers are reaped by shutdown(), so their CPU time is in RUSAGE_CHILDREN afterwards
+        cpu_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+        start = time.perf_counter()
+        supervisor.start_all()
+        total = mailboxes * emails
+        while True:
+            supervisor.poll()
+            stats = supervisor.aggregate_data(activity_limit=0)['stats']
+            if stats['replied'] + stats['escalated'] + stats['ignored'] >= total:
+                break
+            time.sleep(0.05)
+        elapsed = time.perf_counter() - start
+        supervisor.shutdown()
+        cpu_after = resource.getrusage(resource.RUSAGE_CHILDREN)
+        worker_cpu = (cpu_after.ru_utime - cpu_before.ru_utime) + (cpu_after.ru_stime - cpu_before.ru_stime)
+    finally:
+        sys.stdout = stdout
+        devnull.close()
+        stop_servers.set()
+        for server in servers:
+            server.join(timeout=5)
+        shutil.rmtree(root, ignore_errors=True)
+    return elapsed, worker_cpu
+
+
+def run(mailboxes, emails, process_counts, gmail_latency, openai_latency):
+    print(f"{mailboxes} mailboxes x {emails} emails, Gmail latency {gmail_latency * 1000:.0f} ms, "
+          f"OpenAI latency {openai_latency * 1000:.0f} ms, {os.cpu_count()} cores")
+    print(f"{'processes':>9} | {'wall time':>9} | {'emails/sec':>10} | {'speedup':>7} | {'worker CPU':>10} | {'busy':>5}")
+    baseline = None
+    for processes in process_counts:
+        elapsed, worker_cpu = run_once(mailboxes, emails, processes, gmail_latency, openai_latency)
+        baseline = baseline or elapsed
+        print(f"{processes:>9} | {elapsed:>8.2f}s | {mailboxes * emails / elapsed:>10.1f} | {baseline / elapsed:>6.1f}x | "
+              f"{worker_cpu:>9.2f}s | {worker_cpu / elapsed:>5.2f}")
+    if gmail_latency or openai_latency:
+        print("Latency is simulated, so the speedup mostly comes from overlapping waits, not from extra cores. "
+              "'busy' is the number of cores the workers kept busy on average.")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--mailboxes", type=int, default=8)
+    parser.add_argument("--emails", type=int, default=25)
+    parser.add_argument("--processes", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--gmail-latency", type=float, default=0.02)
+    parser.add_argument("--openai-latency", type=float, default=0.2)
+    args = parser.parse_args()
+    run(args.mailboxes, args.emails, args.processes, args.gmail_latency, args.openai_latency)
@@ -0,0 +1,70 @@
+"""
+Compares the old one-request-per-message metadata fetch with the batched
+fetch_unread_emails() against a local fake Gmail server.
+
+Usage (from the Backend directory):
+    python benchmarks/bench_metadata_fetch.py [--latency 0.02] [--batch-size 50]
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("OPENAI_API_KEY", "sk-benchmark")
+
+from fake_gmail import FakeGmailServer  # noqa: E402
+import main  # noqa: E402
+
+LABELS = {"replied": "Bot: Replied", "escalated": "Bot: Escalated", "ignored": "Bot: Ignored"}
+
+
+def sequential_fetch(service, label_config):
+    """The pre-batching implementation: one messages().get() per unread message."""
+    labels_to_exclude = " ".join([f"-label:\"{name}\"" for name in label_config.values()])
+    result = service.users().messages().list(userId="me", labelIds=['INBOX'], q=f"is:unread {labels_to_exclude}", maxResults=500).execute()
+    email_data = []
+    for msg_summary in result.get('messages', []):
+        msg = service.users().messages().get(userId='me', id=msg_summary['id'], format='metadata', metadataHeaders=['Subject', 'From']).execute()
+        headers = msg['payload']['headers']
+        email_data.append({
+            "id": msg_summary['id'], "threadId": msg['threadId'],
+            "subject": next((h['value'] for h in headers if h['name'] == 'Subject'), ''),
+            "from": next((h['value'] for h in headers if h['name'] == 'From'), ''),
+        })
+    return email_data
+
+
+def batched_fetch(service, label_config, batch_size):
+    labels_to_exclude = " ".join([f"-label:\"{name}\"" for name in label_config.values()])
+    result = service.users().messages().list(userId="me", labelIds=['INBOX'], q=f"is:unread {labels_to_exclude}", maxResults=500).execute()
+    return main.fetch_message_metadata(service, [m['id'] for m in result.get('messages', [])], batch_size)
+
+
+def measure(server, fn):
+    server.mailbox.reset_counters()
+    start = time.perf_counter()
+    emails = fn()
+    return len(emails), server.mailbox.round_trips, time.perf_counter() - start
+
+
+def run(latency, batch_size):
+    print(f"Simulated round-trip latency: {latency * 1000:.0f} ms, batch size: {batch_size}")
+    print(f"{'messages':>8} | {'mode':>10} | {'round trips':>11} | {'wall time':>9}")
+    for count in (10, 100, 500):
+        with FakeGmailServer(latency=latency) as server:
+            server.mailbox.seed(count)
+            service = server.build_service()
+            for mode, fn in (("sequential", lambda: sequential_fetch(service, LABELS)),
+                             ("batched", lambda: batched_fetch(service, LABELS, batch_size))):
+                fetched, round_trips, elapsed = measure(server, fn)
+                assert fetched == count, f"{mode} fetched {fetched}/{count} messages"
+                print(f"{count:>8} | {mode:>10} | {round_trips:>11} | {elapsed:>8.3f}s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--latency", type=float, default=0.02, help="Seconds of simulated latency per HTTP round trip.")
+    parser.add_argument("--batch-size", type=int, default=50)
+    args = parser.parse_args()
+    run(args.latency, args.batch_size)
@@ -0,0 +1,129 @@
+"""
+Cost of the per-stage latency instrumentation, and the breakdown it reports
+for a cycle against the fake Gmail server and a fake OpenAI client.
+
+Span overhead is the time of `with stage_metrics.span(...)` around an empty
+block, less an empty loop. It is measured on one thread, and with several
+threads sharing the histogram lock, as the worker pool does.
+
+Usage (from the Backend directory):
+    python benchmarks/bench_metrics.py [--spans 200000] [--emails 40]
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("OPENAI_API_KEY", "sk-benchmark")
+
+from fake_gmail import FakeGmailServer  # noqa: E402
+from fake_openai import FakeOpenAI  # noqa: E402
+import main  # noqa: E402
+from metrics import NULL_SPAN, StageMetrics, render_prometheus, summarize  # noqa: E402
+from telemetry import Telemetry  # noqa: E402
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def empty_loop(spans):
+    for _ in range(spans):
+        pass
+
+
+def span_loop(metrics, spans):
+    for _ in range(spans):
+        with metrics.span('intent'):
+            pass
+
+
+def null_loop(spans):
+    for _ in range(spans):
+        with NULL_SPAN:
+            pass
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    fn(*args)
+    return time.perf_counter() - start
+
+
+def span_overhead(spans, threads):
+    """Microseconds per span, net of the loop, with `threads` threads recording at once."""
+    metrics = StageMetrics()
+    baseline = timed(empty_loop, spans)
+    if threads == 1:
+        return (timed(span_loop, metrics, spans) - baseline) / spans * 1e6
+    workers = [threading.Thread(target=span_loop, args=(metrics, spans // threads)) for _ in range(threads)]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return (time.perf_counter() - start - baseline) / spans * 1e6
+
+
+def run_cycle(emails, gmail_latency, openai_latency):
+    """Processes `emails` questions in one cycle and returns the published metrics snapshot."""
+    root = tempfile.mkdtemp(prefix="bench_metrics_")
+    with open(os.path.join(BACKEND_DIR, "config.json")) as f:
+        config = json.load(f)
+    for key, value in config['settings'].items():
+        if key.endswith("_file"):
+            config['settings'][key] = os.path.join(root, value)
+    config['settings'].update(sync_mode='search', gmail_quota_units_per_second=1e6)
+    try:
+        with FakeGmailServer(latency=gmail_latency) as server:
+            server.mailbox.seed(emails)
+            main.client = FakeOpenAI(latency=openai_latency)
+            state = Telemetry()
+            with contextlib.redirect_stdout(io.StringIO()):
+                service, label_ids, _ = main.setup_mailbox(config, server.build_service)
+                processor = main.ConcurrentEmailProcessor(server.build_service, config['settings'])
+                main.process_email_batch(service, config, label_ids, state, None, processor)
+                main.shutdown_mailbox(processor)
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+    return state.document('metrics')
+
+
+def run(spans, emails, gmail_latency, openai_latency):
+    null_cost = (timed(null_loop, spans) - timed(empty_loop, spans)) / spans * 1e6
+    print(f"Span overhead over {spans:,} spans: disabled {null_cost:.2f} us")
+    for threads in (1, 4, 8):
+        print(f"  enabled, {threads} thread{'s' if threads > 1 else ''}: {span_overhead(spans, threads):.2f} us/span")
+
+    snapshot = run_cycle(emails, gmail_latency, openai_latency)
+    summary = summarize(snapshot)
+    print(f"\nOne cycle of {emails} questions, Gmail latency {gmail_latency * 1000:.0f} ms, "
+          f"OpenAI latency {openai_latency * 1000:.0f} ms:")
+    print(f"{'stage':>12} | {'count':>5} | {'avg ms':>8} | {'p50 ms':>8} | {'p90 ms':>8} | {'p99 ms':>8} | {'errors':>6}")
+    for stage, data in summary['stages'].items():
+        print(f"{stage:>12} | {data['count']:>5} | {data['avg_ms']:>8.1f} | {data['p50_ms']:>8.1f} | "
+              f"{data['p90_ms']:>8.1f} | {data['p99_ms']:>8.1f} | {data['errors']:>6}")
+    print(f"Tokens: {summary['tokens']['prompt']:,} prompt, {summary['tokens']['completion']:,} completion; "
+          f"queue depth {summary['queue_depth']}")
+
+    mailboxes = [{"mailbox": f"brand{i}", "bot_status": "Running", "stats": dict.fromkeys(("processed", "replied", "escalated", "ignored"), 0),
+                  "metrics": snapshot} for i in range(64)]
+    start = time.perf_counter()
+    text = render_prometheus(mailboxes)
+    print(f"/metrics for 64 mailboxes: {len(text.splitlines()):,} lines, {len(text) / 1024:.0f} KB, "
+          f"rendered in {(time.perf_counter() - start) * 1000:.1f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--spans", type=int, default=200000)
+    parser.add_argument("--emails", type=int, default=40)
+    parser.add_argument("--gmail-latency", type=float, default=0.02)
+    parser.add_argument("--openai-latency", type=float, default=0.2)
+    args = parser.parse_args()
+    run(args.spans, args.emails, args.gmail_latency, args.openai_latency)
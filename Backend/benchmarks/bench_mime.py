@@ -0,0 +1,111 @@
+"""
+Compares the old thread parsing (decode every body in full, `+=` transcript)
+with the bounded MIME extraction on synthetic threads of about 10 MB.
+
+Each customer reply quotes the whole conversation below it, as mail clients
+do. Every fourth message is multipart/alternative with a large HTML twin. This
+is what makes long threads grow quadratically.
+
+Usage (from the Backend directory):
+    python benchmarks/bench_mime.py [--messages 24] [--own-kb 20]
+"""
+import argparse
+import base64
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("OPENAI_API_KEY", "sk-benchmark")
+
+import main  # noqa: E402
+
+MY_EMAIL = "bot@example.com"
+CUSTOMER = "Customer <customer@example.com>"
+
+
+def _part(mime_type, text):
+    return {"mimeType": mime_type, "headers": [{"name": "Content-Type", "value": f"{mime_type}; charset=utf-8"}],
+            "body": {"data": base64.urlsafe_b64encode(text.encode("utf-8")).decode()}}
+
+
+def make_thread(messages, own_kb):
+    """Returns (Gmail thread messages, total base64 body size)."""
+    thread, quoted = [], ""
+    for i in range(messages):
+        sender = MY_EMAIL if i % 2 else CUSTOMER
+        own = f"Message {i}: my export fails with error E{i}. " + "Here is the full log line. " * (own_kb * 1024 // 27)
+        plain = f"{own}\n\nOn Mon, 1 Jan 2024 at 10:{i:02d}, someone <x@example.com> wrote:\n" + quoted
+        if i % 4 == 1:
+            html = "<html><body><div>" + own + "</div><blockquote>" + quoted.replace("\n", "<br>") + "</blockquote></body></html>"
+            payload = {"mimeType": "multipart/alternative", "parts": [_part("text/plain", plain), _part("text/html", html)]}
+        else:
+            payload = _part("text/plain", plain)
+        payload["headers"] = payload.get("headers", []) + [{"name": "From", "value": sender}, {"name": "Date", "value": "Mon, 1 Jan 2024"}]
+        thread.append({"id": f"m{i}", "payload": payload})
+        quoted = "\n".join(f"> {line}" for line in plain.splitlines())
+    size = sum(len(p["body"]["data"]) for msg in thread for p in [msg["payload"], *msg["payload"].get("parts", [])] if "data" in p.get("body", {}))
+    return thread, size
+
+
+def legacy_body(message_part):
+    """The previous get_body_from_message()."""
+    body = ""
+    if message_part.get('body') and message_part['body'].get('data'):
+        body = base64.urlsafe_b64decode(message_part['body']['data']).decode('utf-8')
+    elif message_part.get('parts'):
+        for part in message_part['parts']:
+            if part['mimeType'] == 'text/plain':
+                return legacy_body(part)
+    return body.strip()
+
+
+def legacy_parse(thread):
+    """The previous fetch_thread_history() loop."""
+    conversation_history, full_conversation_text = [], ""
+    for msg in thread:
+        sender_header = next(h['value'] for h in msg['payload']['headers'] if h['name'] == 'From')
+        role = 'assistant' if sender_header == MY_EMAIL else 'user'
+        body = legacy_body(msg['payload'])
+        if role == 'assistant':
+            body = body.split("\n\n---")[0].strip()
+        if body:
+            conversation_history.append({"role": role, "content": body})
+            full_conversation_text += f"From: {sender_header}\nDate: \n\n{body}\n\n{'='*40}\n\n"
+    return conversation_history, full_conversation_text
+
+
+def bounded_parse(thread):
+    return main.build_conversation(main.parse_thread_messages(thread, MY_EMAIL))
+
+
+def measure(parse, thread, repeats):
+    start = time.perf_counter()
+    for _ in range(repeats):
+        history, transcript = parse(thread)
+    elapsed = (time.perf_counter() - start) / repeats
+    tracemalloc.start()
+    parse(thread)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return elapsed, peak, sum(len(m['content']) for m in history), len(transcript)
+
+
+def run(messages, own_kb, repeats):
+    thread, size = make_thread(messages, own_kb)
+    print(f"{messages}-message thread, {size / 1e6:.1f} MB of base64 bodies; "
+          f"limits {main.mime_part_max_bytes // 1024} KB/part, {main.thread_text_max_bytes // 1024} KB/thread")
+    print(f"{'parser':>8} | {'ms/thread':>9} | {'peak MB':>7} | {'LLM chars':>10} | {'transcript chars':>16}")
+    for name, parse in (("old", legacy_parse), ("bounded", bounded_parse)):
+        elapsed, peak, llm_chars, transcript_chars = measure(parse, thread, repeats)
+        print(f"{name:>8} | {elapsed * 1000:>9.1f} | {peak / 1e6:>7.1f} | {llm_chars:>10,} | {transcript_chars:>16,}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--messages", type=int, default=24)
+    parser.add_argument("--own-kb", type=int, default=20)
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+    run(args.messages, args.own_kb, args.repeats)
@@ -0,0 +1,138 @@
+"""
+Email-to-reply latency with polling versus Gmail push notifications.
+
+Runs one mailbox under the supervisor against a fake Gmail server. New emails
+arrive at random intervals. In push mode the fake server's watch hands every
+new message to a fake_pubsub.PushRelay, which posts it to the API's real
+/api/gmail/push webhook. Latency is measured from the moment the email lands
+in the inbox to the moment the reply is sent. It also reports how many polls an
+idle mailbox makes per day in each mode.
+
+Usage (from the Backend directory):
+    python benchmarks/bench_push.py [--emails 15] [--polling-interval 5]
+"""
+import argparse
+import functools
+import json
+import logging
+import os
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("OPENAI_API_KEY", "sk-benchmark")
+
+from werkzeug.serving import make_server  # noqa: E402
+
+from fake_gmail import FakeGmailServer, build_fake_service  # noqa: E402
+from fake_openai import FakeOpenAI  # noqa: E402
+from fake_pubsub import PushRelay  # noqa: E402
+import api  # noqa: E402
+import main  # noqa: E402
+from supervisor import MailboxSupervisor  # noqa: E402
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+if __name__ == "__mp_main__":
+    # The spawned worker imports this script under this name; keep its output off the table
+    sys.stdout = open(os.devnull, "w")
+
+
+def fake_service_factory(mailbox_dir, url, openai_latency):
+    # Runs in the worker, which is spawned and so has to install the fake OpenAI client itself
+    if main.client is None:
+        main.client = FakeOpenAI(latency=openai_latency)
+    return lambda: build_fake_service(url)
+
+
+def record_replies(mailbox, sent_at):
+    send_message = mailbox.send_message
+
+    def recording_send(body):
+        status, payload = send_message(body)
+        sent_at.setdefault(payload["threadId"], time.monotonic())
+        return status, payload
+    mailbox.send_message = recording_send
+
+
+def load_base_config():
+    with open(os.path.join(BACKEND_DIR, "config.json")) as f:
+        return json.load(f)
+
+
+def run_once(mode, emails, polling_interval, gmail_latency, openai_latency):
+    root = tempfile.mkdtemp(prefix="bench_push_")
+    config = load_base_config()
+    config['settings'].update(polling_interval_seconds=polling_interval, worker_processes=1,
+                              push_topic_name="projects/local/topics/gmail" if mode == "push" else "")
+    os.makedirs(os.path.join(root, "brand"))
+    with open(os.path.join(root, "brand", "config.json"), "w") as f:
+        json.dump(config, f)
+
+    webhook = make_server("127.0.0.1", 0, api.app, threaded=True)
+    threading.Thread(target=webhook.serve_forever, daemon=True).start()
+    arrived_at, sent_at = {}, {}
+    devnull = open(os.devnull, "w")
+    stdout, sys.stdout = sys.stdout, devnull
+    try:
+        with FakeGmailServer(latency=gmail_latency) as server:
+            record_replies(server.mailbox, sent_at)
+            if mode == "push":
+                PushRelay(f"http://127.0.0.1:{webhook.server_port}/api/gmail/push", api.push_verification_token).attach(server.mailbox)
+            api.supervisor = supervisor = MailboxSupervisor(root, worker_processes=1, max_mailboxes=1,
+                                                            service_factory=functools.partial(fake_service_factory, url=server.url,
+                                                                                              openai_latency=openai_latency))
+            supervisor.start_monitor()
+            supervisor.start_all()
+            while supervisor.mailbox_data("brand")['bot_status'] != 'Running':
+                time.sleep(0.05)
+            time.sleep(1)  # Let the first cycle (full sync and watch) finish
+
+            rng = random.Random(7)
+            for i in range(emails):
+                time.sleep(rng.uniform(0.5, 1.5))
+                msg_id = server.mailbox.add_message("Customer <customer@example.com>", f"Question {i}", f"How do I do thing {i}?")
+                arrived_at[msg_id] = time.monotonic()
+            deadline = time.monotonic() + polling_interval + 30
+            while len(sent_at) < emails and time.monotonic() < deadline:
+                time.sleep(0.05)
+            supervisor.shutdown()
+    finally:
+        sys.stdout = stdout
+        devnull.close()
+        webhook.shutdown()
+        shutil.rmtree(root, ignore_errors=True)
+    latencies = sorted(sent_at[thread_id] - arrived for thread_id, arrived in arrived_at.items() if thread_id in sent_at)
+    return latencies
+
+
+def run(emails, polling_interval, gmail_latency, openai_latency):
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    # The webhook refuses notifications without a verification token
+    api.push_verification_token = "bench-push-token"
+    print(f"{emails} emails at random 0.5-1.5s gaps, polling interval {polling_interval}s, "
+          f"Gmail latency {gmail_latency * 1000:.0f} ms, OpenAI latency {openai_latency * 1000:.0f} ms")
+    print(f"{'mode':>7} | {'replied':>7} | {'mean':>6} | {'p50':>6} | {'max':>6} | {'idle polls/day':>14}")
+    safety_poll = load_base_config()['settings']['push_safety_poll_seconds']
+    for mode, poll_every in (("polling", polling_interval), ("push", safety_poll)):
+        latencies = run_once(mode, emails, polling_interval, gmail_latency, openai_latency)
+        if not latencies:
+            print(f"{mode:>7} | {0:>7} | {'-':>6} | {'-':>6} | {'-':>6} | {86400 / poll_every:>14.0f}")
+            continue
+        print(f"{mode:>7} | {len(latencies):>7} | {statistics.mean(latencies):>5.2f}s | "
+              f"{statistics.median(latencies):>5.2f}s | {latencies[-1]:>5.2f}s | {86400 / poll_every:>14.0f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--emails", type=int, default=15)
+    parser.add_argument("--polling-interval", type=float, default=5)
+    parser.add_argument("--gmail-latency", type=float, default=0.02)
+    parser.add_argument("--openai-latency", type=float, default=0.2)
+    args = parser.parse_args()
+    run(args.emails, args.polling_interval, args.gmail_latency, args.openai_latency)
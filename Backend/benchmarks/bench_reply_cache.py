@@ -0,0 +1,98 @@
+"""
+Reply cache hit rate on reworded repeats of the same questions, and a check
+that messages differing only in trailing details never share a reply.
+
+Repeats vary the greeting, the sign-off and the customer's name, which the
+cache should see through. Collision pairs differ only in what follows the
+sign-off or in an id or address, which it must not: a hit there would send
+one customer the reply written for another. Neither may a reply that greets
+the customer by name be served to a customer who signed with another name.
+
+Usage (from the Backend directory):
+    python benchmarks/bench_reply_cache.py [--repeats 200]
+"""
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from reply_cache import ReplyCache, normalize_text  # noqa: E402
+
+VERSION = "kb-1"
+QUESTIONS = [
+    "How do I export my invoices as CSV from the billing page",
+    "Can I change the email address on my account without losing my data",
+    "Where do I find my API key in the dashboard settings",
+    "Why does the calendar sync stop after I change my password",
+]
+GREETINGS = ["", "Hi,\n", "Hello team,\n", "Hey there,\n", "Good morning,\n"]
+SIGN_OFFS = ["", "\n\nThanks,\nJane", "\n\nBest regards,\nSam Lee", "\n\nCheers", "\nThank you!", "\n\nKind regards,\nAlex"]
+COLLISIONS = [
+    ("I was charged twice for my subscription this month. Thanks, account jane@example.com",
+     "I was charged twice for my subscription this month. Thanks, account bob@example.com"),
+    ("Please cancel order 10442, it was placed by mistake. Thanks, order 10442",
+     "Please cancel order 10443, it was placed by mistake. Thanks, order 10443"),
+    ("My refund has not arrived yet.\n\nBest,\nJane\nCustomer id 5521",
+     "My refund has not arrived yet.\n\nBest,\nJane\nCustomer id 7730"),
+    ("Please reset the password for the admin account on workspace acme-1, it is locked out after too many attempts",
+     "Please reset the password for the admin account on workspace acme-2, it is locked out after too many attempts"),
+]
+NAMED_REPLIES = [
+    ("How do I export my invoices as CSV?\n\nThanks,\nJane Doe", "How do I export my invoices as CSV?\n\nThanks,\nBob Smith",
+     "Hi Jane, you can export invoices from the billing page."),
+    ("Where do I find my API key?\n\nRegards,\nPriya", "Where do I find my API key?\n\nRegards,\nTom",
+     "Hello! Your API key is under Settings. Thanks for asking, Priya."),
+]
+
+
+def check_collisions(cache):
+    """Stores the first message of each pair and asserts the second one misses. Returns the pairs checked."""
+    for first, second in COLLISIONS:
+        assert normalize_text(first) != normalize_text(second), f"same exact key: {first!r} / {second!r}"
+        cache.store(first, VERSION, f"reply for {first}", 100)
+        assert cache.lookup(second, VERSION) is None, f"collision: {second!r} got the reply for {first!r}"
+        assert cache.lookup(first, VERSION) is not None
+    for first, second, reply in NAMED_REPLIES:
+        cache.store(first, VERSION, reply, 100)
+        assert cache.lookup(second, VERSION) is None, f"{second!r} got the reply addressed to {first!r}"
+    # A reply that does not use the name is shared
+    first, second, _ = NAMED_REPLIES[0]
+    cache.store(first, VERSION, "Hello, you can export invoices from the billing page.", 100)
+    assert cache.lookup(second, VERSION) is not None
+    return len(COLLISIONS) + len(NAMED_REPLIES)
+
+
+def run(repeats, seed):
+    root = tempfile.mkdtemp(prefix="bench_reply_cache_")
+    try:
+        cache = ReplyCache(os.path.join(root, "reply_cache.json"), 1000, 3600)
+        rng = random.Random(seed)
+        hits = {}
+        start = time.perf_counter()
+        for _ in range(repeats):
+            text = rng.choice(GREETINGS) + rng.choice(QUESTIONS) + rng.choice(["?", "."]) + rng.choice(SIGN_OFFS)
+            found = cache.lookup(text, VERSION)
+            if found is None:
+                cache.store(text, VERSION, "cached reply", 400)
+            else:
+                hits[found[1]] = hits.get(found[1], 0) + 1
+        elapsed = time.perf_counter() - start
+        print(f"{repeats} reworded repeats of {len(QUESTIONS)} questions: {sum(hits.values())} hits "
+              f"({', '.join(f'{k} {v}' for k, v in sorted(hits.items()))}), {elapsed / repeats * 1e6:.0f} us per lookup")
+        pairs = check_collisions(ReplyCache(os.path.join(root, "collisions.json"), 1000, 3600))
+        print(f"Collision check: {pairs} pairs differing only in trailing details or the customer's name, none shared a reply")
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--repeats", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    run(args.repeats, args.seed)
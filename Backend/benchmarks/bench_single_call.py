@@ -0,0 +1,100 @@
+"""
+Per-email latency and token usage of the two LLM call modes, through the real
+OpenAI SDK against a local mock OpenAI server (fake_openai.FakeOpenAIServer):
+  - separate: an intent call, then a reply call for questions;
+  - combined: one structured-output call returning {intent, reply}.
+
+The mock charges a fixed time to first token, a prefill cost per 1k prompt
+tokens and a decode cost per completion token. The local classifier and the
+reply cache are off, so every email reaches the LLM.
+
+Usage (from the Backend directory):
+    python benchmarks/bench_single_call.py [--emails 40]
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import time
+from contextlib import redirect_stdout
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("OPENAI_API_KEY", "sk-benchmark")
+
+import openai  # noqa: E402
+
+from fake_openai import FakeOpenAIServer  # noqa: E402
+import main  # noqa: E402
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+KNOWLEDGE_BASE = "Exports: open Settings > Data and choose Export. Large exports are emailed within an hour. " * 40
+
+
+def make_emails(count):
+    rng = random.Random(3)
+    emails = []
+    for i in range(count):
+        kind = rng.choices(["question", "follow_up", "escalation"], weights=[6, 2, 2])[0]
+        text = {"question": f"How do I export report {i} as CSV? The button is greyed out.",
+                "follow_up": f"Thank you, report {i} exported fine now.",
+                "escalation": f"This is the third time report {i} failed. Let me talk to a human agent."}[kind]
+        emails.append([{"role": "user", "content": text}])
+    return emails
+
+
+def handle_separately(history, config):
+    intent = main.determine_user_intent(history[-1]['content'], config)
+    if intent == "question":
+        main.generate_ai_reply("Export", history, config)
+    return intent
+
+
+def handle_combined(history, config):
+    intent, reply_text = main.determine_intent_and_reply("Export", history, config)
+    if intent == "question" and reply_text is None:
+        main.generate_ai_reply("Export", history, config)
+    return intent
+
+
+def run(count, latency, prompt_latency_per_1k, completion_latency_per_token):
+    with open(os.path.join(BACKEND_DIR, "config.json")) as f:
+        config = json.load(f)
+    config['knowledge_base'] = KNOWLEDGE_BASE
+    emails = make_emails(count)
+    print(f"{count} emails ({sum(1 for e in emails if '?' in e[0]['content'])} questions), mock OpenAI: "
+          f"{latency * 1000:.0f} ms to first token + {prompt_latency_per_1k * 1000:.0f} ms/1k prompt tokens "
+          f"+ {completion_latency_per_token * 1000:.0f} ms/completion token")
+    questions = ['?' in history[0]['content'] for history in emails]
+    print(f"{'mode':>9} | {'calls':>5} | {'mean':>7} | {'p95':>7} | {'questions':>9} | {'others':>7} | {'prompt tok':>10} | {'completion tok':>14}")
+    intents = {}
+    for mode, handle in (("separate", handle_separately), ("combined", handle_combined)):
+        with FakeOpenAIServer(latency, prompt_latency_per_1k, completion_latency_per_token) as server:
+            main.client = openai.OpenAI(base_url=server.url, api_key="sk-benchmark", max_retries=0)
+            latencies, decided = [], []
+            with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+                for history in emails:
+                    start = time.perf_counter()
+                    decided.append(handle(history, config))
+                    latencies.append(time.perf_counter() - start)
+            intents[mode] = decided
+            fake = server.fake
+            p95 = statistics.quantiles(latencies, n=20)[-1]
+            question_mean = statistics.mean(t for t, q in zip(latencies, questions) if q)
+            other_mean = statistics.mean(t for t, q in zip(latencies, questions) if not q)
+            print(f"{mode:>9} | {fake.calls:>5} | {statistics.mean(latencies) * 1000:>5.0f}ms | {p95 * 1000:>5.0f}ms | "
+                  f"{question_mean * 1000:>7.0f}ms | {other_mean * 1000:>5.0f}ms | "
+                  f"{fake.prompt_tokens:>10,} | {fake.completion_tokens:>14,}")
+    agree = sum(a == b for a, b in zip(intents["separate"], intents["combined"]))
+    print(f"Intent agreement between modes: {agree}/{count}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--emails", type=int, default=40)
+    parser.add_argument("--latency", type=float, default=0.3)
+    parser.add_argument("--prompt-latency-per-1k", type=float, default=0.02)
+    parser.add_argument("--completion-latency-per-token", type=float, default=0.015)
+    args = parser.parse_args()
+    run(args.emails, args.latency, args.prompt_latency_per_1k, args.completion_latency_per_token)
@@ -0,0 +1,146 @@
+"""
+Cold-start cost of the API process and of a mailbox worker process.
+
+Each process' imports run in a fresh interpreter under `python -X importtime`.
+The report gives the median total import time over --repeat runs, the
+packages that cost the most (by self time, grouped by top-level package) and
+whether the heavy client libraries were loaded. The API process should load
+none of them. A worker imports the supervisor and the bot module (main).
+
+It also times work that used to happen at startup and now happens later:
+  - building a Gmail service with build("gmail", "v1") versus
+    get_gmail_service() and its cached discovery document. The first build
+    writes the cache and later ones reuse the parsed-once copy. A cache left
+    by another google-api-python-client version is replaced;
+  - importing the OpenAI SDK and building its client, which now happens on
+    the first OpenAI call instead of at import.
+
+Usage (from the Backend directory):
+    python benchmarks/bench_startup.py [--repeat 5] [--top 8]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+PROCESSES = {
+    "API process": "import api",
+    "mailbox worker": "import supervisor, main",
+}
+HEAVY_PACKAGES = ("openai", "googleapiclient", "google_auth_oauthlib", "numpy")
+OPENAI_FIRST_USE = ("import time, main; start = time.perf_counter(); main.get_openai_client(); "
+                    "print(time.perf_counter() - start)")
+
+
+def parse_importtime(stderr):
+    """Returns {module: (self seconds, cumulative seconds, depth)} from -X importtime output."""
+    modules = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip())) // 2
+        modules[name.strip()] = (int(self_us) / 1e6, int(cumulative_us) / 1e6, depth)
+    return modules
+
+
+def profile_imports(code):
+    """Runs code in a fresh interpreter. Returns (process wall seconds, import seconds, modules)."""
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", code], cwd=BACKEND_DIR,
+                            capture_output=True, text=True, check=True)
+    wall = time.perf_counter() - start
+    modules = parse_importtime(result.stderr)
+    total = sum(cumulative for _, cumulative, depth in modules.values() if depth == 0)
+    return wall, total, modules
+
+
+def by_package(modules):
+    """Self time per top-level package."""
+    totals = {}
+    for name, (self_seconds, _, _) in modules.items():
+        package = name.split(".")[0]
+        totals[package] = totals.get(package, 0.0) + self_seconds
+    return totals
+
+
+def report_process(label, code, repeat, top):
+    runs = [profile_imports(code) for _ in range(repeat)]
+    wall = statistics.median(run[0] for run in runs)
+    total = statistics.median(run[1] for run in runs)
+    modules = runs[-1][2]
+    loaded = [package for package in HEAVY_PACKAGES if package in modules]
+    print(f"{label} ({code!r}): imports {total * 1000:.0f} ms, process {wall * 1000:.0f} ms, "
+          f"{len(modules)} modules; heavy packages loaded: {', '.join(loaded) or 'none'}")
+    packages = sorted(by_package(modules).items(), key=lambda item: -item[1])[:top]
+    print("    " + ", ".join(f"{package} {seconds * 1000:.0f} ms" for package, seconds in packages))
+    return total
+
+
+def time_calls(fn, calls):
+    start = time.perf_counter()
+    for _ in range(calls):
+        fn()
+    return (time.perf_counter() - start) / calls
+
+
+def report_gmail_service(calls):
+    from google.oauth2.credentials import Credentials
+    from googleapiclient.discovery import build
+    import main
+
+    creds = Credentials(token="bench")
+    old_cwd = os.getcwd()
+    with tempfile.TemporaryDirectory(prefix="bench_startup_") as root:
+        # The cache file path is relative, like the other state files
+        os.chdir(root)
+        try:
+            uncached = time_calls(lambda: build("gmail", "v1", credentials=creds, cache_discovery=False), calls)
+            main.gmail_discovery_document = None
+            first = time_calls(lambda: main.get_gmail_service(creds), 1)
+            warm = time_calls(lambda: main.get_gmail_service(creds), calls)
+
+            main.gmail_discovery_document = None
+            restart = time_calls(lambda: main.get_gmail_service(creds), 1)
+
+            with open(main.GMAIL_DISCOVERY_CACHE_FILE, "w") as f:
+                json.dump({"version": "gmail/v1 google-api-python-client/0.0.0", "document": "{}"}, f)
+            main.gmail_discovery_document = None
+            stale = time_calls(lambda: main.get_gmail_service(creds), 1)
+            with open(main.GMAIL_DISCOVERY_CACHE_FILE) as f:
+                refreshed = json.load(f)['version'] == main.gmail_discovery_version()
+        finally:
+            os.chdir(old_cwd)
+    print(f"\nGmail service build, {calls} calls: build('gmail', 'v1') {uncached * 1000:.2f} ms each; "
+          f"get_gmail_service() {first * 1000:.2f} ms writing the cache, {restart * 1000:.2f} ms from the cache "
+          f"after a restart, then {warm * 1000:.2f} ms each")
+    print(f"Cache from another library version: rebuilt in {stale * 1000:.2f} ms, "
+          f"{'rewritten with the current version' if refreshed else 'NOT rewritten'}")
+
+
+def report_openai_first_use(repeat):
+    env = dict(os.environ, OPENAI_API_KEY=os.environ.get("OPENAI_API_KEY", "sk-benchmark"))
+    seconds = statistics.median(
+        float(subprocess.run([sys.executable, "-c", OPENAI_FIRST_USE], cwd=BACKEND_DIR, env=env,
+                             capture_output=True, text=True, check=True).stdout.split()[-1])
+        for _ in range(repeat))
+    print(f"OpenAI SDK import and client build, now on the first OpenAI call: {seconds * 1000:.0f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--top", type=int, default=8)
+    parser.add_argument("--calls", type=int, default=50)
+    args = parser.parse_args()
+    for label, code in PROCESSES.items():
+        report_process(label, code, args.repeat, args.top)
+    report_gmail_service(args.calls)
+    report_openai_first_use(args.repeat)
@@ -0,0 +1,85 @@
+"""
+Compares the per-event cost of bot telemetry through a multiprocessing
+Manager proxy (the previous shared state) with the shared-memory Telemetry
+channel, plus the cost of one dashboard read of 50 activity entries.
+
+The proxy path repeats what increment_stat/log_activity used to do: read the
+stats dict, write it back, and insert at the front of a proxied list.
+
+Usage (from the Backend directory):
+    python benchmarks/bench_telemetry.py [--events 5000]
+"""
+import argparse
+import os
+import sys
+import time
+import uuid
+from multiprocessing import Manager
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from telemetry import Telemetry  # noqa: E402
+
+
+def make_entry(i):
+    return {"id": uuid.uuid4().hex, "from": f"Customer {i} <customer{i}@example.com>",
+            "intent": "Question", "action": "Replied", "time": time.strftime("%H:%M:%S")}
+
+
+def proxy_event(state, i):
+    stats = state.get('stats')
+    stats['processed'] += 1
+    state['stats'] = stats
+    state['activity_log'].insert(0, make_entry(i))
+
+
+def proxy_read(state):
+    activity_log = state.get('activity_log', [])
+    while len(activity_log) > 50:
+        activity_log.pop()
+    return dict(state.get('stats', {})), list(activity_log)
+
+
+def telemetry_event(telemetry, i):
+    telemetry.increment('processed')
+    telemetry.log(make_entry(i))
+
+
+def telemetry_read(telemetry):
+    return telemetry.stats(), telemetry.recent_activity(50)
+
+
+def time_per_call(fn, calls):
+    start = time.perf_counter()
+    for i in range(calls):
+        fn(i)
+    return (time.perf_counter() - start) / calls * 1e6
+
+
+def run(events):
+    manager = Manager()
+    state = manager.dict()
+    state['stats'] = {"processed": 0, "replied": 0, "escalated": 0, "ignored": 0}
+    state['activity_log'] = manager.list()
+    telemetry = Telemetry()
+
+    rows = []
+    for name, event, read, target in (("manager proxy", proxy_event, proxy_read, state),
+                                      ("shared memory", telemetry_event, telemetry_read, telemetry)):
+        event_us = time_per_call(lambda i: event(target, i), events)
+        read_us = time_per_call(lambda i: read(target), 200)
+        rows.append((name, event_us, read_us))
+    manager.shutdown()
+
+    print(f"{events} events (1 counter increment + 1 activity entry each)")
+    print(f"{'channel':>13} | {'us/event':>9} | {'us/dashboard read':>17}")
+    for name, event_us, read_us in rows:
+        print(f"{name:>13} | {event_us:>9.1f} | {read_us:>17.1f}")
+    print(f"Per-event speedup: {rows[0][1] / rows[1][1]:.0f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--events", type=int, default=5000)
+    args = parser.parse_args()
+    run(args.events)
@@ -0,0 +1,134 @@
+"""
+Synthetic, replayable email corpora for the load-test harness.
+
+generate() builds support threads with a seeded RNG. Thread length and body
+size are drawn per thread, and the size is log-uniform, so most bodies are
+short and a few are large. Earlier messages alternate between the customer
+and the bot. Every thread ends with an unread customer message that the bot
+has to handle. Its wording follows an intent mix, so the replied, escalated
+and ignored paths all run. Some customer messages quote the message before
+them, as mail clients do. Some also carry an HTML alternative.
+
+save() and load() store a corpus as JSON lines, so a run can be replayed
+exactly. load_into() adds a corpus to a fake_gmail.FakeMailbox.
+
+Usage (from the Backend directory), to write a corpus file:
+    python benchmarks/corpus.py corpus.jsonl [--threads 500] [--seed 0]
+"""
+import argparse
+import html
+import json
+import math
+import random
+
+from fake_gmail import MY_EMAIL
+
+CUSTOMER = "Customer {n} <customer{n}@example.com>"
+DEFAULT_INTENT_MIX = {"question": 0.5, "follow_up": 0.3, "escalation_request": 0.1, "other": 0.1}
+OPENINGS = {
+    "question": ["How do I export my invoices as CSV?", "Why does the sync fail with error E42?",
+                 "Can I change the email address on my account?", "Where do I find my API key?"],
+    "follow_up": ["Thanks, that fixed it.", "Thank you for the quick help.", "Thanks, all sorted now."],
+    "escalation_request": ["Please let me talk to a human agent.", "I need a human to look at this, it is urgent."],
+    "other": ["Just letting you know the new dashboard looks great.", "FYI we are moving offices next week."],
+}
+FILLER = ("The details are below. I tried restarting the app and clearing the cache. The problem started after "
+          "the last update and happens on every device we use. Our team relies on this every day. ").split()
+BOT_REPLY = "Thanks for reaching out! Here is how to do that. Let us know if anything else comes up."
+
+
+def _text(rng, opening, size):
+    words = [opening]
+    length = len(opening)
+    while length < size:
+        word = FILLER[rng.randrange(len(FILLER))]
+        words.append(word)
+        length += len(word) + 1
+    return " ".join(words)
+
+
+def _quote(previous):
+    return "\n\nOn Mon, 1 Jan 2024 at 10:00, Support <support@example.com> wrote:\n" + \
+        "\n".join(f"> {line}" for line in previous.splitlines())
+
+
+def generate(threads, seed=0, min_messages=1, max_messages=8, min_body_bytes=200, max_body_bytes=20000,
+             html_ratio=0.25, quote_ratio=0.5, intent_mix=None):
+    """
+    Returns a list of threads. Each thread is {"subject", "customer", "intent", "messages": [...]} and
+    each message is {"from_bot": bool, "text": str, "html": bool}. The last message is the one to handle.
+    """
+    rng = random.Random(seed)
+    intents, weights = zip(*(intent_mix or DEFAULT_INTENT_MIX).items())
+    corpus = []
+    for n in range(threads):
+        intent = rng.choices(intents, weights)[0]
+        size = int(math.exp(rng.uniform(math.log(min_body_bytes), math.log(max_body_bytes))))
+        # An odd count, so the thread starts and ends with the customer
+        count = rng.randrange(min_messages, max_messages + 1)
+        count = max(1, count - 1 if count % 2 == 0 else count)
+        messages = []
+        for i in range(count):
+            if i % 2:
+                messages.append({"from_bot": True, "text": BOT_REPLY, "html": False})
+                continue
+            last = i == count - 1
+            opening = rng.choice(OPENINGS[intent if last else "question"])
+            text = _text(rng, opening, size)
+            if messages and rng.random() < quote_ratio:
+                text += _quote(messages[-1]["text"])
+            messages.append({"from_bot": False, "text": text, "html": rng.random() < html_ratio})
+        corpus.append({"subject": f"Ticket {n}", "customer": CUSTOMER.format(n=n), "intent": intent, "messages": messages})
+    return corpus
+
+
+def save(corpus, path):
+    with open(path, "w", encoding="utf-8") as f:
+        for thread in corpus:
+            f.write(json.dumps(thread) + "\n")
+
+
+def load(path):
+    with open(path, "r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def load_into(mailbox, corpus):
+    """Adds every thread to mailbox. Only each thread's last message is left unread. Returns the number of those."""
+    for thread in corpus:
+        thread_id = None
+        for i, message in enumerate(thread["messages"]):
+            last = i == len(thread["messages"]) - 1
+            sender = MY_EMAIL if message["from_bot"] else thread["customer"]
+            labels = ("SENT",) if message["from_bot"] else ("INBOX", "UNREAD") if last else ("INBOX",)
+            body_html = None
+            if message["html"]:
+                body_html = "<html><body><div>" + html.escape(message["text"]).replace("\n", "<br>") + "</div></body></html>"
+            msg_id = mailbox.add_message(sender, thread["subject"], message["text"], thread_id, labels, body_html)
+            thread_id = thread_id or msg_id
+    return len(corpus)
+
+
+def describe(corpus):
+    """One-line summary: threads, messages, body size and intent mix."""
+    messages = [m for thread in corpus for m in thread["messages"]]
+    size = sum(len(m["text"]) for m in messages)
+    intents = {}
+    for thread in corpus:
+        intents[thread["intent"]] = intents.get(thread["intent"], 0) + 1
+    mix = ", ".join(f"{intent} {count}" for intent, count in sorted(intents.items()))
+    return (f"{len(corpus)} threads, {len(messages)} messages ({len(messages) / max(1, len(corpus)):.1f}/thread), "
+            f"{size / 1e6:.1f} MB of text; {mix}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Writes a synthetic email corpus as JSON lines.")
+    parser.add_argument("path")
+    parser.add_argument("--threads", type=int, default=500)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--max-messages", type=int, default=8)
+    parser.add_argument("--max-body-bytes", type=int, default=20000)
+    args = parser.parse_args()
+    corpus = generate(args.threads, args.seed, max_messages=args.max_messages, max_body_bytes=args.max_body_bytes)
+    save(corpus, args.path)
+    print(f"Wrote {describe(corpus)} to {args.path}")
@@ -0,0 +1,416 @@
+"""
+A small in-memory stand-in for the Gmail REST API, used by the benchmarks.
+
+It serves just enough of the v1 surface for the bot (messages, threads, labels,
+profile, watch and the multipart batch endpoint) and counts every HTTP round
+trip so benchmarks can compare call patterns without a real inbox. Once the bot
+has called watch, every new INBOX message is passed to the mailbox's listeners,
+for example a fake_pubsub.PushRelay.
+
+A FakeMailbox can be reached in two ways. FakeGmailServer serves it over local
+HTTP, which other processes can use too. build_inprocess_service() plugs it
+into googleapiclient as the http object, so no sockets are involved.
+inject_errors() makes a share of calls fail with a chosen status.
+"""
+import base64
+import itertools
+import json
+import os
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import googleapiclient
+import httplib2
+from googleapiclient.discovery import build_from_document
+
+MY_EMAIL = "bot@example.com"
+
+
+def _encode_body(text):
+    return base64.urlsafe_b64encode(text.encode("utf-8")).decode()
+
+
+class FakeMailbox:
+    """Holds the messages, labels and counters behind a FakeGmailServer."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.messages = {}
+        self.labels = {label: label for label in ("INBOX", "UNREAD", "SENT")}
+        self.next_label_number = len(self.labels)  # Gmail never reuses the ID of a deleted label
+        self.history_id = 1000
+        self.history = []
+        self.oldest_history_id = self.history_id
+        self.round_trips = 0
+        self.calls = {}
+        self.watch_topic = None
+        self.listeners = []  # Called with (email_address, history_id) for watched changes
+        self.error_rate = 0.0
+        self.error_status = 503
+        self.error_methods = None
+        self.injected_errors = 0
+        self._random = random.Random(0)
+        self._ids = itertools.count(1)
+
+    def inject_errors(self, rate, status=503, methods=None, seed=0):
+        """Makes a `rate` share of calls, optionally only to `methods` (e.g. {"messages.send"}), fail with `status`."""
+        with self.lock:
+            self.error_rate, self.error_status, self.error_methods = rate, status, methods
+            self._random = random.Random(seed)
+
+    def reset_counters(self):
+        with self.lock:
+            self.round_trips = 0
+            self.calls = {}
+
+    def count(self, method):
+        self.calls[method] = self.calls.get(method, 0) + 1
+
+    def add_message(self, sender, subject, body, thread_id=None, label_ids=("INBOX", "UNREAD"), html=None):
+        """Adds a message to the mailbox and returns its id. With html it is multipart/alternative."""
+        headers = [
+            {"name": "From", "value": sender},
+            {"name": "Subject", "value": subject},
+            {"name": "Date", "value": time.strftime("%a, %d %b %Y %H:%M:%S +0000")},
+        ]
+        if html is None:
+            payload = {"mimeType": "text/plain", "headers": headers, "body": {"data": _encode_body(body)}}
+        else:
+            payload = {"mimeType": "multipart/alternative", "headers": headers, "body": {"size": 0}, "parts": [
+                {"mimeType": "text/plain", "headers": [{"name": "Content-Type", "value": "text/plain; charset=utf-8"}],
+                 "body": {"data": _encode_body(body)}},
+                {"mimeType": "text/html", "headers": [{"name": "Content-Type", "value": "text/html; charset=utf-8"}],
+                 "body": {"data": _encode_body(html)}},
+            ]}
+        with self.lock:
+            msg_id = f"{next(self._ids):016x}"
+            self.history_id += 1
+            self.messages[msg_id] = {
+                "id": msg_id,
+                "threadId": thread_id or msg_id,
+                "labelIds": list(label_ids),
+                "historyId": str(self.history_id),
+                "payload": payload,
+            }
+            self.history.append((self.history_id, msg_id))
+            history_id, watched = self.history_id, self.watch_topic and "INBOX" in label_ids
+        if watched:
+            for listener in self.listeners:
+                listener(MY_EMAIL, history_id)
+        return msg_id
+
+    def seed(self, count, sender="Customer <customer@example.com>"):
+        """Adds `count` unread single-message threads."""
+        return [self.add_message(sender, f"Question {i}", f"How do I do thing {i}?") for i in range(count)]
+
+    # --- Gmail API operations ---
+    def _matches_query(self, msg, query):
+        if "is:unread" in query and "UNREAD" not in msg["labelIds"]:
+            return False
+        for name in re.findall(r'-label:"([^"]+)"', query):
+            label_id = next((i for i, n in self.labels.items() if n == name), None)
+            if label_id and label_id in msg["labelIds"]:
+                return False
+        return True
+
+    def list_messages(self, params):
+        label_ids = params.get("labelIds", [])
+        query = params.get("q", [""])[0]
+        max_results = int(params.get("maxResults", ["100"])[0])
+        found = [
+            {"id": m["id"], "threadId": m["threadId"]}
+            for m in self.messages.values()
+            if all(l in m["labelIds"] for l in label_ids) and self._matches_query(m, query)
+        ]
+        return 200, {"messages": found[:max_results], "resultSizeEstimate": len(found)} if found else {"resultSizeEstimate": 0}
+
+    def get_message(self, msg_id, params):
+        msg = self.messages.get(msg_id)
+        if msg is None:
+            return 404, {"error": {"code": 404, "message": "Requested entity was not found."}}
+        if params.get("format", ["full"])[0] == "metadata":
+            wanted = {h.lower() for h in params.get("metadataHeaders", [])}
+            headers = [h for h in msg["payload"]["headers"] if not wanted or h["name"].lower() in wanted]
+            return 200, {"id": msg["id"], "threadId": msg["threadId"], "labelIds": msg["labelIds"],
+                         "payload": {"headers": headers}}
+        return 200, msg
+
+    def expire_history(self):
+        """Makes every historyId issued so far too old to sync from."""
+        with self.lock:
+            self.oldest_history_id = self.history_id + 1
+            self.history = []
+
+    def list_history(self, params):
+        start = int(params["startHistoryId"][0])
+        if start < self.oldest_history_id:
+            return 404, {"error": {"code": 404, "message": "Requested entity was not found."}}
+        label_id = params.get("labelId", [None])[0]
+        records = []
+        for history_id, msg_id in self.history:
+            msg = self.messages[msg_id]
+            if history_id > start and (label_id is None or label_id in msg["labelIds"]):
+                summary = {"id": msg_id, "threadId": msg["threadId"], "labelIds": msg["labelIds"]}
+                records.append({"id": str(history_id), "messagesAdded": [{"message": summary}]})
+        response = {"historyId": str(self.history_id)}
+        if records:
+            response["history"] = records
+        return 200, response
+
+    def get_thread(self, thread_id):
+        messages = [m for m in self.messages.values() if m["threadId"] == thread_id]
+        if not messages:
+            return 404, {"error": {"code": 404, "message": "Requested entity was not found."}}
+        return 200, {"id": thread_id, "historyId": messages[-1]["historyId"], "messages": messages}
+
+    def _invalid_label(self, body):
+        unknown = [l for l in body.get("addLabelIds", []) + body.get("removeLabelIds", []) if l not in self.labels]
+        return unknown and (400, {"error": {"code": 400, "message": f"Invalid label: {unknown[0]}"}})
+
+    def _apply_labels(self, msg, body):
+        self.history_id += 1
+        msg["historyId"] = str(self.history_id)
+        msg["labelIds"] = [l for l in msg["labelIds"] if l not in body.get("removeLabelIds", [])]
+        msg["labelIds"] += [l for l in body.get("addLabelIds", []) if l not in msg["labelIds"]]
+
+    def modify_message(self, msg_id, body):
+        msg = self.messages.get(msg_id)
+        if msg is None:
+            return 404, {"error": {"code": 404, "message": "Requested entity was not found."}}
+        if self._invalid_label(body):
+            return self._invalid_label(body)
+        self._apply_labels(msg, body)
+        return 200, {"id": msg_id, "threadId": msg["threadId"], "labelIds": msg["labelIds"]}
+
+    def batch_modify(self, body):
+        # All or nothing, like Gmail: one unknown id or label fails the whole call
+        if len(body["ids"]) > 1000:
+            return 400, {"error": {"code": 400, "message": "Too many ids. At most 1000 are allowed."}}
+        if any(msg_id not in self.messages for msg_id in body["ids"]):
+            return 400, {"error": {"code": 400, "message": "Invalid id value"}}
+        if self._invalid_label(body):
+            return self._invalid_label(body)
+        for msg_id in body["ids"]:
+            self._apply_labels(self.messages[msg_id], body)
+        return 200, {}
+
+    def delete_label(self, label_id):
+        """Deletes a label the way a user would in the Gmail UI."""
+        with self.lock:
+            del self.labels[label_id]
+            for msg in self.messages.values():
+                msg["labelIds"] = [l for l in msg["labelIds"] if l != label_id]
+
+    def send_message(self, body):
+        # Sent mail joins its thread, so the bot sees its own replies like in a real mailbox
+        self.history_id += 1
+        msg_id = uuid.uuid4().hex[:16]
+        thread_id = body.get("threadId") or msg_id
+        self.messages[msg_id] = {
+            "id": msg_id,
+            "threadId": thread_id,
+            "labelIds": ["SENT"],
+            "historyId": str(self.history_id),
+            "payload": {
+                "mimeType": "text/plain",
+                "headers": [{"name": "From", "value": MY_EMAIL}, {"name": "Subject", "value": "Re"}],
+                "body": {"data": _encode_body("(sent by the bot)")},
+            },
+        }
+        return 200, {"id": msg_id, "threadId": thread_id, "labelIds": ["SENT"]}
+
+    def watch(self, body):
+        self.watch_topic = body["topicName"]
+        return 200, {"historyId": str(self.history_id), "expiration": str(int((time.time() + 7 * 86400) * 1000))}
+
+    def create_label(self, body):
+        label_id = f"Label_{self.next_label_number}"
+        self.next_label_number += 1
+        self.labels[label_id] = body["name"]
+        return 200, {"id": label_id, "name": body["name"]}
+
+    def dispatch(self, method, path, query, body):
+        """Routes one (possibly batched) API call to the mailbox."""
+        params = parse_qs(query)
+        routes = [
+            ("GET", r"/gmail/v1/users/me/profile$", "getProfile",
+             lambda: (200, {"emailAddress": MY_EMAIL, "historyId": str(self.history_id)})),
+            ("GET", r"/gmail/v1/users/me/labels$", "labels.list",
+             lambda: (200, {"labels": [{"id": i, "name": n} for i, n in self.labels.items()]})),
+            ("POST", r"/gmail/v1/users/me/labels$", "labels.create", lambda: self.create_label(body)),
+            ("GET", r"/gmail/v1/users/me/messages$", "messages.list", lambda: self.list_messages(params)),
+            ("POST", r"/gmail/v1/users/me/messages/send$", "messages.send", lambda: self.send_message(body)),
+            ("GET", r"/gmail/v1/users/me/messages/(?P<id>[^/]+)$", "messages.get",
+             lambda: self.get_message(match["id"], params)),
+            ("POST", r"/gmail/v1/users/me/messages/batchModify$", "messages.batchModify", lambda: self.batch_modify(body)),
+            ("POST", r"/gmail/v1/users/me/messages/(?P<id>[^/]+)/modify$", "messages.modify",
+             lambda: self.modify_message(match["id"], body)),
+            ("GET", r"/gmail/v1/users/me/history$", "history.list", lambda: self.list_history(params)),
+            ("POST", r"/gmail/v1/users/me/watch$", "watch", lambda: self.watch(body)),
+            ("GET", r"/gmail/v1/users/me/threads/(?P<id>[^/]+)$", "threads.get",
+             lambda: self.get_thread(match["id"])),
+        ]
+        for route_method, pattern, name, handler in routes:
+            match = re.match(pattern, path)
+            if route_method == method and match:
+                with self.lock:
+                    self.count(name)
+                    if self.error_rate and (self.error_methods is None or name in self.error_methods) \
+                            and self._random.random() < self.error_rate:
+                        self.injected_errors += 1
+                        return self.error_status, {"error": {"code": self.error_status, "message": "Injected error."}}
+                    return handler()
+        return 404, {"error": {"code": 404, "message": f"No fake route for {method} {path}"}}
+
+
+def handle_batch(mailbox, content_type, raw):
+    """Answers a multipart/mixed batch request. Returns (response body, response content type)."""
+    boundary = re.search(r'boundary="?([^";]+)"?', content_type).group(1)
+    out_boundary = f"batch_{uuid.uuid4().hex}"
+    chunks = []
+    # googleapiclient serialises batch parts with bare LF line endings
+    for part in raw.replace(b"\r\n", b"\n").split(f"--{boundary}".encode())[1:]:
+        if part.startswith(b"--"):
+            break
+        part_headers, _, inner = part.strip(b"\n").partition(b"\n\n")
+        content_id = re.search(rb"Content-ID: <([^>]+)>", part_headers, re.I).group(1).decode()
+        request_head, _, inner_body = inner.partition(b"\n\n")
+        method, target, _ = request_head.split(b"\n")[0].decode().split(" ", 2)
+        url = urlparse(target)
+        body = json.loads(inner_body) if inner_body.strip() else {}
+        status, payload = mailbox.dispatch(method, url.path, url.query, body)
+        data = json.dumps(payload)
+        chunks.append(
+            f"--{out_boundary}\r\nContent-Type: application/http\r\n"
+            f"Content-ID: <response-{content_id}>\r\n\r\n"
+            f"HTTP/1.1 {status} {'OK' if status == 200 else 'Error'}\r\n"
+            f"Content-Type: application/json\r\nContent-Length: {len(data)}\r\n\r\n{data}\r\n"
+        )
+    chunks.append(f"--{out_boundary}--\r\n")
+    return "".join(chunks).encode(), f"multipart/mixed; boundary={out_boundary}"
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def _read_body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else b""
+
+    def _reply(self, status, payload, content_type="application/json"):
+        data = payload if isinstance(payload, bytes) else json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _handle(self, method):
+        mailbox = self.server.mailbox
+        with mailbox.lock:
+            mailbox.round_trips += 1
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        url = urlparse(self.path)
+        raw = self._read_body()
+        if url.path == "/batch":
+            return self._reply(200, *handle_batch(mailbox, self.headers["Content-Type"], raw))
+        body = json.loads(raw) if raw else {}
+        status, payload = mailbox.dispatch(method, url.path, url.query, body)
+        self._reply(status, payload)
+
+    def do_GET(self):
+        self._handle("GET")
+
+    def do_POST(self):
+        self._handle("POST")
+
+
+class FakeGmailServer:
+    """Runs a FakeMailbox behind a local HTTP server on a background thread."""
+
+    def __init__(self, latency=0.0):
+        self.mailbox = FakeMailbox()
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+        self._server.daemon_threads = True
+        self._server.mailbox = self.mailbox
+        self._server.latency = latency
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        host, port = self._server.server_address
+        return f"http://{host}:{port}/"
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def build_service(self):
+        """Builds a googleapiclient Gmail service that talks to this server."""
+        return build_fake_service(self.url)
+
+
+def _discovery_document(url):
+    doc_path = os.path.join(os.path.dirname(googleapiclient.__file__),
+                            "discovery_cache", "documents", "gmail.v1.json")
+    with open(doc_path, "r") as f:
+        doc = json.load(f)
+    doc["rootUrl"] = doc["baseUrl"] = doc["mtlsRootUrl"] = url
+    return doc
+
+
+def build_fake_service(url):
+    """Builds a googleapiclient Gmail service for a fake server at url, e.g. one running in another process."""
+    return build_from_document(_discovery_document(url), http=httplib2.Http())
+
+
+class FakeGmailHttp:
+    """An httplib2.Http stand-in that hands googleapiclient's requests straight to a FakeMailbox."""
+
+    def __init__(self, mailbox, latency=0.0):
+        self.mailbox = mailbox
+        self.latency = latency
+
+    def request(self, uri, method="GET", body=None, headers=None, redirections=1, connection_type=None):
+        with self.mailbox.lock:
+            self.mailbox.round_trips += 1
+        if self.latency:
+            time.sleep(self.latency)
+        url = urlparse(uri)
+        raw = body.encode() if isinstance(body, str) else body or b""
+        if url.path == "/batch":
+            request_type = next(value for key, value in (headers or {}).items() if key.lower() == "content-type")
+            content, content_type = handle_batch(self.mailbox, request_type, raw)
+            status = 200
+        else:
+            status, payload = self.mailbox.dispatch(method, url.path, url.query, json.loads(raw) if raw else {})
+            content, content_type = json.dumps(payload).encode(), "application/json"
+        return httplib2.Response({"status": str(status), "content-type": content_type}), content
+
+    def close(self):
+        pass
+
+
+_INPROCESS_URL = "http://fake-gmail.invalid/"
+_inprocess_document = None
+
+
+def build_inprocess_service(mailbox, latency=0.0):
+    """Builds a googleapiclient Gmail service backed by mailbox in this process, with `latency` seconds per round trip."""
+    global _inprocess_document
+    if _inprocess_document is None:
+        _inprocess_document = json.dumps(_discovery_document(_INPROCESS_URL))
+    return build_from_document(_inprocess_document, http=FakeGmailHttp(mailbox, latency))
@@ -0,0 +1,202 @@
+"""
+An in-process stand-in for openai.OpenAI used by the benchmarks, and
+FakeOpenAIServer, which serves the same fake over HTTP for the real SDK.
+
+Only chat.completions.create() is implemented. It sleeps for a configurable
+latency, optionally plus a prefill cost per 1k prompt tokens and a decode cost
+per completion token. It answers as follows:
+  - intent prompts with a keyword picked from the email text;
+  - summary prompts with a fixed-size summary;
+  - json_schema requests with {"intent", "reply"} for the latest user message.
+inject_errors() makes a share of calls raise the openai SDK's own status errors,
+so the bot's retry handling sees what it would see from the real API.
+"""
+import asyncio
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+
+import httpx
+import openai
+
+REPLY_TEXT = "Thanks for reaching out! Here is how to do that."
+
+
+def classify_text(text):
+    """Cheap stand-in for the model's intent decision."""
+    lowered = text.lower()
+    if "human" in lowered or "agent" in lowered:
+        return "escalation_request"
+    if "thank" in lowered:
+        return "follow_up"
+    if "?" in text:
+        return "question"
+    return "other"
+
+
+class _Completions:
+    def __init__(self, owner):
+        self._owner = owner
+
+    def create(self, model, messages, max_tokens=None, temperature=None, **kwargs):
+        owner = self._owner
+        error = owner.count_call()
+        if error:
+            time.sleep(owner.latency)
+            raise error
+        response = self._respond(messages, kwargs.get("response_format"))
+        delay = owner.delay(response.usage)
+        if delay:
+            time.sleep(delay)
+        return response
+
+    def _respond(self, messages, response_format=None):
+        owner = self._owner
+        prompt = messages[-1]["content"]
+        if response_format and response_format.get("type") == "json_schema":
+            last_user_message = next(m["content"] for m in reversed(messages) if m["role"] == "user")
+            intent = classify_text(last_user_message)
+            content = json.dumps({"intent": intent, "reply": REPLY_TEXT if intent == "question" else ""})
+        elif messages[0]["role"] == "system":
+            content = REPLY_TEXT
+        elif prompt.rstrip().endswith("Updated summary:"):
+            content = "The customer reported a problem and we suggested several fixes. " * 12
+        else:
+            email_text = prompt.split('Email: "', 1)[-1]
+            content = classify_text(email_text)
+        prompt_tokens = sum(len(m["content"]) for m in messages) // 4
+        completion_tokens = len(content) // 4 + 1
+        with owner.lock:
+            owner.prompt_tokens += prompt_tokens
+            owner.completion_tokens += completion_tokens
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content=content), finish_reason="stop")],
+            usage=SimpleNamespace(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens,
+                                  total_tokens=prompt_tokens + completion_tokens),
+        )
+
+
+class FakeOpenAI:
+    """Mimics the parts of openai.OpenAI the bot uses."""
+
+    def __init__(self, latency=0.0, prompt_latency_per_1k=0.0, completion_latency_per_token=0.0):
+        self.api_key = "sk-fake"
+        self.latency = latency
+        self.prompt_latency_per_1k = prompt_latency_per_1k
+        self.completion_latency_per_token = completion_latency_per_token
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.error_rate = 0.0
+        self.error_status = 500
+        self.injected_errors = 0
+        self._random = random.Random(0)
+        self.chat = SimpleNamespace(completions=_Completions(self))
+
+    def with_options(self, **kwargs):
+        return self
+
+    def inject_errors(self, rate, status=500, seed=0):
+        """Makes a `rate` share of calls fail with `status`: 429 raises RateLimitError, 5xx InternalServerError."""
+        with self.lock:
+            self.error_rate, self.error_status = rate, status
+            self._random = random.Random(seed)
+
+    def count_call(self):
+        """Counts a call. Returns the exception to raise if an error is injected into it, else None."""
+        with self.lock:
+            self.calls += 1
+            if not self.error_rate or self._random.random() >= self.error_rate:
+                return None
+            self.injected_errors += 1
+            status = self.error_status
+        response = httpx.Response(status, request=httpx.Request("POST", "https://api.openai.invalid/v1/chat/completions"))
+        error_class = {429: openai.RateLimitError}.get(status, openai.InternalServerError if status >= 500 else openai.APIStatusError)
+        return error_class(f"Injected {status} error.", response=response, body=None)
+
+    def delay(self, usage):
+        return (self.latency + usage.prompt_tokens / 1000 * self.prompt_latency_per_1k
+                + usage.completion_tokens * self.completion_latency_per_token)
+
+
+class _AsyncCompletions(_Completions):
+    async def create(self, model, messages, max_tokens=None, temperature=None, **kwargs):
+        owner = self._owner
+        error = owner.count_call()
+        if error:
+            await asyncio.sleep(owner.latency)
+            raise error
+        response = self._respond(messages, kwargs.get("response_format"))
+        delay = owner.delay(response.usage)
+        if delay:
+            await asyncio.sleep(delay)
+        return response
+
+
+class FakeAsyncOpenAI(FakeOpenAI):
+    """Mimics the parts of openai.AsyncOpenAI the bot uses."""
+
+    def __init__(self, latency=0.0, prompt_latency_per_1k=0.0, completion_latency_per_token=0.0):
+        super().__init__(latency, prompt_latency_per_1k, completion_latency_per_token)
+        self.chat = SimpleNamespace(completions=_AsyncCompletions(self))
+
+    async def close(self):
+        pass
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)))
+        if self.path.rstrip("/") != "/v1/chat/completions":
+            return self._reply(404, {"error": {"message": f"No fake route for {self.path}"}})
+        response = self.server.fake.chat.completions.create(**body)
+        choice = response.choices[0]
+        self._reply(200, {
+            "id": f"chatcmpl-{uuid.uuid4().hex}", "object": "chat.completion", "created": int(time.time()),
+            "model": body["model"],
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": choice.message.content},
+                         "finish_reason": choice.finish_reason}],
+            "usage": vars(response.usage),
+        })
+
+    def _reply(self, status, payload):
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class FakeOpenAIServer:
+    """Serves a FakeOpenAI over HTTP on a background thread; point openai.OpenAI(base_url=...) at .url."""
+
+    def __init__(self, latency=0.0, prompt_latency_per_1k=0.0, completion_latency_per_token=0.0):
+        self.fake = FakeOpenAI(latency, prompt_latency_per_1k, completion_latency_per_token)
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+        self._server.daemon_threads = True
+        self._server.fake = self.fake
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        host, port = self._server.server_address
+        return f"http://{host}:{port}/v1"
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._server.shutdown()
+        self._server.server_close()
@@ -0,0 +1,74 @@
+"""
+A local stand-in for Gmail push delivery through a Pub/Sub push subscription.
+
+Posts notifications in the Pub/Sub push format to the bot's webhook
+(/api/gmail/push), either once from the command line or, through PushRelay,
+for every new message in a watched FakeMailbox.
+
+Usage (from the Backend directory):
+    python benchmarks/fake_pubsub.py --url http://127.0.0.1:5001/api/gmail/push --email bot@example.com --history-id 1234
+"""
+import argparse
+import base64
+import json
+import queue
+import threading
+import urllib.request
+import uuid
+from urllib.parse import urlencode
+
+
+def encode_notification(email_address, history_id):
+    """Wraps a Gmail notification in a Pub/Sub push request body."""
+    data = json.dumps({"emailAddress": email_address, "historyId": int(history_id)}).encode()
+    return {
+        "message": {"data": base64.b64encode(data).decode(), "messageId": uuid.uuid4().hex},
+        "subscription": "projects/local/subscriptions/gmail-push",
+    }
+
+
+def post_notification(url, email_address, history_id, token=""):
+    """Posts one notification and returns the webhook's HTTP status."""
+    if token:
+        url = f"{url}?{urlencode({'token': token})}"
+    request = urllib.request.Request(url, data=json.dumps(encode_notification(email_address, history_id)).encode(),
+                                     headers={"Content-Type": "application/json"}, method="POST")
+    with urllib.request.urlopen(request, timeout=10) as response:
+        return response.status
+
+
+class PushRelay:
+    """Listens to FakeMailboxes and posts their notifications to a webhook from a background thread."""
+
+    def __init__(self, url, token=""):
+        self.url = url
+        self.token = token
+        self.delivered = 0
+        self._pending = queue.Queue()
+        self._thread = threading.Thread(target=self._deliver, daemon=True)
+        self._thread.start()
+
+    def attach(self, mailbox):
+        mailbox.listeners.append(self.publish)
+
+    def publish(self, email_address, history_id):
+        self._pending.put((email_address, history_id))
+
+    def _deliver(self):
+        while True:
+            email_address, history_id = self._pending.get()
+            try:
+                post_notification(self.url, email_address, history_id, self.token)
+                self.delivered += 1
+            except OSError as e:
+                print(f"Fake Pub/Sub could not deliver a notification: {e}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--url", default="http://127.0.0.1:5001/api/gmail/push")
+    parser.add_argument("--email", required=True)
+    parser.add_argument("--history-id", type=int, required=True)
+    parser.add_argument("--token", default="")
+    args = parser.parse_args()
+    print(f"Webhook answered {post_notification(args.url, args.email, args.history_id, args.token)}.")
@@ -0,0 +1,24 @@
+"""
+Loads config.json.
+
+This lives apart from main.py so the API process can read its settings
+without importing the bot. main.py pulls in the OpenAI SDK, googleapiclient
+and the Google auth stack. Only the mailbox worker processes need those.
+"""
+import json
+import sys
+
+
+def load_config(path="config.json"):
+    """Loads the configuration from config.json."""
+    try:
+        with open(path, "r") as f:
+            config = json.load(f)
+        print(f"Configuration loaded. Running Bot Version: {config.get('bot_version', 'unknown')}")
+        return config
+    except FileNotFoundError:
+        print(f"ERROR: {path} not found.")
+        sys.exit(1)
+    except json.JSONDecodeError:
+        print(f"ERROR: {path} is not valid JSON.")
+        sys.exit(1)
@@ -0,0 +1,224 @@
+"""
+Token-budgeted conversation context for reply generation.
+
+Long threads used to be sent to OpenAI in full on every reply. build_context()
+keeps the latest user message plus as many recent turns as fit a token
+budget. It folds everything older into a rolling summary per threadId, kept
+in a SummaryCache:
+  - a hit reuses the stored summary when the turns it covers are unchanged
+    and the turns after it still fit the budget;
+  - otherwise only the turns that have newly fallen out of the window are
+    folded into the previous summary. When it re-summarizes, the window
+    shrinks to half the budget, so the next few messages fit without another
+    summary call.
+
+Tokens are counted with tiktoken when it is installed and its encoding can be
+loaded. Otherwise counting falls back to about four characters per token.
+Chat messages add OpenAI's per-message overhead either way.
+"""
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+# OpenAI chat format: every message is wrapped in a few tokens, and the reply is primed with a few more
+TOKENS_PER_MESSAGE = 3
+TOKENS_PER_REPLY = 3
+SUMMARY_HEADER = "Summary of the earlier messages in this thread:\n"
+
+_counters = {}
+_counters_lock = threading.Lock()
+
+
+class TokenCounter:
+    """Counts tokens with tiktoken's encoding for a model, or estimates them without it."""
+
+    def __init__(self, model):
+        self.model = model
+        self.encoding = None
+        try:
+            import tiktoken
+            try:
+                self.encoding = tiktoken.encoding_for_model(model)
+            except KeyError:
+                self.encoding = tiktoken.get_encoding("o200k_base")
+        except ImportError:
+            print("tiktoken is not installed. Token counts will be estimated from characters.")
+        except Exception as e:
+            print(f"Could not load the tiktoken encoding for {model}: {e}. Token counts will be estimated from characters.")
+
+    @classmethod
+    def for_model(cls, model):
+        """Returns a shared counter per model, because loading an encoding is slow."""
+        with _counters_lock:
+            if model not in _counters:
+                _counters[model] = cls(model)
+            return _counters[model]
+
+    def count(self, text):
+        if self.encoding is not None:
+            return len(self.encoding.encode(text, disallowed_special=()))
+        return (len(text) + 3) // 4
+
+    def count_messages(self, messages):
+        return sum(TOKENS_PER_MESSAGE + self.count(message['content']) for message in messages) + TOKENS_PER_REPLY
+
+
+def fingerprint(turns):
+    digest = hashlib.sha1()
+    for turn in turns:
+        digest.update(f"{turn['role']}\0{turn['content']}\0".encode("utf-8"))
+    return digest.hexdigest()
+
+
+def recent_window_start(turns, budget, counter):
+    """Index of the oldest turn in the longest suffix that fits budget. The latest turn is always kept."""
+    start = len(turns) - 1
+    used = TOKENS_PER_MESSAGE + counter.count(turns[start]['content'])
+    while start > 0:
+        cost = TOKENS_PER_MESSAGE + counter.count(turns[start - 1]['content'])
+        if used + cost > budget:
+            break
+        used += cost
+        start -= 1
+    return start
+
+
+class SummaryCache:
+    """Thread-safe, disk-backed LRU of rolling summaries per threadId."""
+
+    def __init__(self, path, max_threads):
+        self.path = path
+        self.max_threads = max_threads
+        self.hits = 0
+        self.updates = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._dirty = False
+        self._lock = threading.Lock()
+        self.load()
+
+    def get(self, thread_id):
+        """Returns {'covered', 'fingerprint', 'summary'} for a thread, or None."""
+        with self._lock:
+            entry = self._entries.get(thread_id)
+            if entry is not None:
+                self._entries.move_to_end(thread_id)
+            return entry
+
+    def put(self, thread_id, covered, turns_fingerprint, summary):
+        with self._lock:
+            self._entries[thread_id] = {"covered": covered, "fingerprint": turns_fingerprint, "summary": summary}
+            self._entries.move_to_end(thread_id)
+            while len(self._entries) > self.max_threads:
+                self._entries.popitem(last=False)
+            self._dirty = True
+
+    def record(self, outcome):
+        """Counts a lookup outcome: 'hit', 'update' or 'miss'."""
+        with self._lock:
+            if outcome == 'hit':
+                self.hits += 1
+            elif outcome == 'update':
+                self.updates += 1
+            else:
+                self.misses += 1
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "updates": self.updates, "misses": self.misses, "threads": len(self._entries)}
+
+    # --- Persistence ---
+    def load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                stored = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return
+        with self._lock:
+            self._entries.update(stored.get('entries', {}))
+            self._dirty = False
+
+    def save(self):
+        """Writes the cache to disk if it changed since the last save."""
+        with self._lock:
+            if not self._dirty:
+                return
+            entries = dict(self._entries)
+            self._dirty = False
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"entries": entries}, f)
+        os.replace(tmp_path, self.path)
+
+
+def build_context(thread_id, turns, budget, summary_tokens, counter, summary_cache, summarize):
+    """
+    Returns (messages, summarized turn count): the recent turns that fit budget, preceded by a system
+    message holding the rolling summary of the older ones. summarize(previous_summary, turns) returns
+    the new summary, or None if it failed; then the older turns are dropped without a summary.
+    """
+    if recent_window_start(turns, budget, counter) == 0:
+        return list(turns), 0
+
+    cached = summary_cache.get(thread_id) if thread_id else None
+    if cached and 0 < cached['covered'] < len(turns) and cached['fingerprint'] == fingerprint(turns[:cached['covered']]):
+        if recent_window_start(turns, budget - summary_tokens, counter) <= cached['covered']:
+            summary_cache.record('hit')
+            start, summary = cached['covered'], cached['summary']
+            return [{"role": "system", "content": SUMMARY_HEADER + summary}] + turns[start:], start
+        previous, covered, outcome = cached['summary'], cached['covered'], 'update'
+    else:
+        previous, covered, outcome = "", 0, 'miss'
+
+    # Leave room for the next few messages before the summary needs refreshing again
+    start = max(covered, recent_window_start(turns, (budget - summary_tokens) // 2, counter))
+    summary = summarize(previous, turns[covered:start])
+    if summary is None:
+        summary = previous
+    else:
+        summary_cache.record(outcome)
+        if thread_id:
+            summary_cache.put(thread_id, start, fingerprint(turns[:start]), summary)
+    messages = turns[start:]
+    if summary:
+        messages = [{"role": "system", "content": SUMMARY_HEADER + summary}] + messages
+    return messages, start
+
+
+class ContextStats:
+    """Prompt-token counters for the replies a mailbox generates."""
+
+    def __init__(self):
+        self.replies = 0
+        self.total_prompt_tokens = 0
+        self.max_prompt_tokens = 0
+        self.last_prompt_tokens = 0
+        self.summarized_replies = 0
+        self.turns_in_threads = 0
+        self.turns_sent = 0
+        self._lock = threading.Lock()
+
+    def record(self, prompt_tokens, thread_turns, sent_turns):
+        with self._lock:
+            self.replies += 1
+            self.total_prompt_tokens += prompt_tokens
+            self.max_prompt_tokens = max(self.max_prompt_tokens, prompt_tokens)
+            self.last_prompt_tokens = prompt_tokens
+            self.summarized_replies += sent_turns < thread_turns
+            self.turns_in_threads += thread_turns
+            self.turns_sent += sent_turns
+
+    def stats(self):
+        with self._lock:
+            return {
+                "replies": self.replies,
+                "avg_prompt_tokens": round(self.total_prompt_tokens / self.replies) if self.replies else 0,
+                "max_prompt_tokens": self.max_prompt_tokens,
+                "last_prompt_tokens": self.last_prompt_tokens,
+                "total_prompt_tokens": self.total_prompt_tokens,
+                "summarized_replies": self.summarized_replies,
+                "turns_in_threads": self.turns_in_threads,
+                "turns_sent": self.turns_sent,
+            }
@@ -0,0 +1,289 @@
+"""
+Local intent pre-classifier that runs before the OpenAI intent call.
+
+There are two tiers:
+  1. Rules for obvious cases: auto-replies and newsletters, recognised by
+     their headers (automated_mail_kind()), explicit requests for a human,
+     and short messages that are nothing but a thank-you. A keyword alone is
+     not enough, because customers write "unsubscribe" or "on leave until"
+     in real requests too.
+  2. An optional hashed word n-gram logistic regression model, stored as a
+     NumPy .npz file and trained from the bot's own labelled history (every
+     intent the LLM decides is appended to settings.intent_history_file,
+     which keeps the newest settings.intent_history_max_examples).
+
+classify() returns an IntentDecision with a confidence score. The bot only
+trusts it at or above settings.local_intent_threshold and otherwise asks
+OpenAI.
+
+Usage (from the Backend directory):
+    python intent_classifier.py train [--history intent_history.jsonl] [--model intent_model.npz]
+    python intent_classifier.py evaluate --corpus benchmarks/data/intent_corpus.jsonl [--threshold 0.9]
+"""
+import argparse
+import json
+import math
+import os
+import re
+import threading
+import zlib
+from collections import namedtuple
+
+INTENTS = ("question", "escalation_request", "follow_up", "other")
+FEATURE_DIMS = 2 ** 16
+
+IntentDecision = namedtuple("IntentDecision", ["intent", "confidence", "source"])
+
+# Headers that mark mail nobody has to answer. Gmail returns them with the message metadata.
+AUTOMATED_MAIL_HEADERS = ("Auto-Submitted", "X-Autoreply", "X-Autorespond", "Precedence", "List-Id", "List-Unsubscribe")
+_ESCALATION = re.compile(r"\b(speak|talk|chat) (to|with) (a |an )?(real |actual )?(human|person|agent|manager|supervisor)\b", re.I)
+_NEGATED_ESCALATION = re.compile(r"\b(no need|don'?t|do not|doesn'?t|does not|not|never|without)\b[\w\s']{0,20}\b(speak|talk|chat)\b", re.I)
+# A thank-you only counts when the whole message is made of these words
+_THANKS_OPENERS = {"thanks", "thank", "thx", "ty", "cheers", "got", "perfect", "great", "awesome", "that", "all", "ok", "okay", "many"}
+_THANKS_WORDS = _THANKS_OPENERS | {
+    "you", "so", "much", "very", "a", "lot", "for", "the", "your", "help", "quick", "reply", "response", "support",
+    "again", "team", "it", "worked", "works", "fixed", "solved", "resolved", "sorted", "good", "appreciate",
+    "appreciated", "really", "brilliant", "excellent", "wonderful", "lovely", "and"}
+_THANKS_MAX_WORDS = 12
+_TOKEN = re.compile(r"[a-z0-9']+|[?!]")
+
+
+def automated_mail_kind(headers):
+    """Returns "auto_reply", "bulk" or None for a message's headers, a {name: value} dict."""
+    headers = {name.lower(): value.strip().lower() for name, value in headers.items()}
+    if headers.get("auto-submitted", "no") != "no" or "x-autoreply" in headers or "x-autorespond" in headers:
+        return "auto_reply"
+    if headers.get("precedence") in ("bulk", "list", "junk") or "list-id" in headers or "list-unsubscribe" in headers:
+        return "bulk"
+    return None
+
+
+def _is_thanks(text):
+    words = re.findall(r"[a-z']+", text.lower())
+    return (0 < len(words) <= _THANKS_MAX_WORDS and words[0] in _THANKS_OPENERS
+            and all(word in _THANKS_WORDS for word in words) and not re.search(r"[?\d@]", text))
+
+
+def _rule_decision(text, automated=None):
+    if automated:
+        return IntentDecision("other", 0.99, "rules")
+    if _ESCALATION.search(text) and not _NEGATED_ESCALATION.search(text):
+        return IntentDecision("escalation_request", 0.99, "rules")
+    if _is_thanks(text):
+        return IntentDecision("follow_up", 0.97, "rules")
+    return None
+
+
+def extract_features(text, dims=FEATURE_DIMS):
+    """Hashes word unigrams and bigrams into (indices, values), L2-normalised."""
+    tokens = _TOKEN.findall(text.lower())
+    grams = tokens + [f"{a} {b}" for a, b in zip(tokens, tokens[1:])]
+    counts = {}
+    for gram in grams:
+        # crc32 is stable across processes, unlike hash()
+        index = zlib.crc32(gram.encode("utf-8")) % dims
+        counts[index] = counts.get(index, 0) + 1
+    norm = math.sqrt(sum(c * c for c in counts.values())) or 1.0
+    return list(counts.keys()), [c / norm for c in counts.values()]
+
+
+class HashedLogisticModel:
+    """Softmax regression over hashed n-gram features."""
+
+    def __init__(self, weights, bias, classes):
+        self.weights = weights
+        self.bias = bias
+        self.classes = list(classes)
+
+    @classmethod
+    def load(cls, path):
+        import numpy as np
+        with np.load(path) as data:
+            return cls(data["weights"], data["bias"], [str(c) for c in data["classes"]])
+
+    def save(self, path):
+        import numpy as np
+        np.savez(path, weights=self.weights, bias=self.bias, classes=np.array(self.classes))
+
+    def predict(self, text):
+        import numpy as np
+        indices, values = extract_features(text, self.weights.shape[0])
+        logits = np.asarray(values, dtype=np.float32) @ self.weights[indices] + self.bias
+        probs = np.exp(logits - logits.max())
+        probs /= probs.sum()
+        best = int(probs.argmax())
+        return self.classes[best], float(probs[best])
+
+    @classmethod
+    def train(cls, texts, labels, epochs=30, learning_rate=2.0, l2=1e-5, batch_size=32, dims=FEATURE_DIMS, seed=0):
+        import numpy as np
+        classes = [c for c in INTENTS if c in set(labels)]
+        targets = np.array([classes.index(label) for label in labels])
+        features = [extract_features(text, dims) for text in texts]
+        weights = np.zeros((dims, len(classes)), dtype=np.float32)
+        bias = np.zeros(len(classes), dtype=np.float32)
+        rng = np.random.default_rng(seed)
+
+        for _ in range(epochs):
+            order = rng.permutation(len(texts))
+            for start in range(0, len(order), batch_size):
+                batch = order[start:start + batch_size]
+                rows = np.concatenate([np.full(len(features[i][0]), r) for r, i in enumerate(batch)])
+                indices = np.concatenate([features[i][0] for i in batch]).astype(np.int64)
+                values = np.concatenate([features[i][1] for i in batch]).astype(np.float32)
+
+                logits = np.tile(bias, (len(batch), 1))
+                np.add.at(logits, rows, weights[indices] * values[:, None])
+                probs = np.exp(logits - logits.max(axis=1, keepdims=True))
+                probs /= probs.sum(axis=1, keepdims=True)
+                probs[np.arange(len(batch)), targets[batch]] -= 1.0
+
+                step = learning_rate / len(batch)
+                weights[indices] *= (1 - learning_rate * l2)
+                np.add.at(weights, indices, -step * probs[rows] * values[:, None])
+                bias -= step * probs.sum(axis=0)
+
+        return cls(weights, bias, classes)
+
+
+class LocalIntentClassifier:
+    """Rules first, then the trained model if one is available."""
+
+    def __init__(self, model_path=None, history_path=None, history_max_examples=None):
+        self.model = None
+        self.history_path = history_path
+        self.history_max_examples = history_max_examples
+        self._history_count = None  # lines in the history file, counted on the first append
+        self._history_lock = threading.Lock()
+        if model_path and os.path.exists(model_path):
+            try:
+                self.model = HashedLogisticModel.load(model_path)
+                print(f"Loaded local intent model from {model_path}.")
+            except ImportError:
+                print("NumPy is not installed. Local intent classification will use rules only.")
+
+    def classify(self, text, automated=None):
+        """
+        Returns an IntentDecision, or None if neither tier has an opinion.
+        automated is the message's automated_mail_kind(), if known.
+        """
+        decision = _rule_decision(text, automated)
+        if decision is None and self.model is not None:
+            intent, confidence = self.model.predict(text)
+            decision = IntentDecision(intent, confidence, "model")
+        return decision
+
+    def record_example(self, text, intent):
+        """
+        Appends an LLM-labelled example to the training history. Once it holds history_max_examples,
+        the oldest quarter is dropped, so the file stays bounded without a rewrite per example.
+        """
+        if not self.history_path:
+            return
+        line = json.dumps({"text": text, "intent": intent}) + "\n"
+        with self._history_lock:
+            if self.history_max_examples and self._history_count is None:
+                try:
+                    with open(self.history_path, "r", encoding="utf-8") as f:
+                        self._history_count = sum(1 for _ in f)
+                except FileNotFoundError:
+                    self._history_count = 0
+            with open(self.history_path, "a", encoding="utf-8") as f:
+                f.write(line)
+            if not self.history_max_examples:
+                return
+            self._history_count += 1
+            if self._history_count >= self.history_max_examples:
+                self._trim_history(self.history_max_examples * 3 // 4)
+
+    def _trim_history(self, keep):
+        """Rewrites the history file with its newest `keep` lines. The caller holds the lock."""
+        with open(self.history_path, "r", encoding="utf-8") as f:
+            lines = f.readlines()[-keep:]
+        tmp_path = f"{self.history_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.writelines(lines)
+        os.replace(tmp_path, self.history_path)
+        self._history_count = len(lines)
+
+
+def load_examples(path):
+    """
+    Reads {"text", "intent"} JSON lines, skipping unknown intents. An example may carry
+    the message's "headers". Returns (texts, labels, automated_mail_kind() of each).
+    """
+    texts, labels, kinds = [], [], []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            example = json.loads(line)
+            if example.get("intent") in INTENTS:
+                texts.append(example["text"])
+                labels.append(example["intent"])
+                kinds.append(automated_mail_kind(example.get("headers", {})))
+    return texts, labels, kinds
+
+
+def evaluate(texts, labels, threshold, model_path=None, folds=5, kinds=None):
+    """
+    Reports how many LLM calls the local tier would avoid and how accurate it is.
+    Without a saved model, the model tier is trained and scored with k-fold cross-validation.
+    Folds are assigned by normalised text, so repeated messages never sit in both the train and test folds.
+    """
+    decisions = [None] * len(texts)
+    kinds = kinds or [None] * len(texts)
+    if model_path:
+        classifier = LocalIntentClassifier(model_path)
+        decisions = [classifier.classify(text, kind) for text, kind in zip(texts, kinds)]
+    else:
+        text_folds = [zlib.crc32(" ".join(_TOKEN.findall(text.lower())).encode("utf-8")) % folds for text in texts]
+        for fold in range(folds):
+            test_ids = [i for i in range(len(texts)) if text_folds[i] == fold]
+            train_ids = [i for i in range(len(texts)) if text_folds[i] != fold]
+            classifier = LocalIntentClassifier()
+            classifier.model = HashedLogisticModel.train([texts[i] for i in train_ids], [labels[i] for i in train_ids])
+            for i in test_ids:
+                decisions[i] = classifier.classify(texts[i], kinds[i])
+
+    confident = [(d, label) for d, label in zip(decisions, labels) if d and d.confidence >= threshold]
+    correct = sum(1 for d, label in confident if d.intent == label)
+    by_source = {}
+    for d, _ in confident:
+        by_source[d.source] = by_source.get(d.source, 0) + 1
+
+    return {
+        "examples": len(texts),
+        "threshold": threshold,
+        "llm_calls_avoided_pct": round(100 * len(confident) / len(texts), 1) if texts else 0.0,
+        "local_accuracy_pct": round(100 * correct / len(confident), 1) if confident else 0.0,
+        # Deferred examples are assumed to be classified correctly by the LLM
+        "end_to_end_accuracy_pct": round(100 * (correct + len(texts) - len(confident)) / len(texts), 1) if texts else 0.0,
+        "decisions_by_source": by_source,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Train or evaluate the local intent pre-classifier.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    train_parser = subparsers.add_parser("train", help="Train the model from the bot's labelled history.")
+    train_parser.add_argument("--history", default="intent_history.jsonl")
+    train_parser.add_argument("--model", default="intent_model.npz")
+    train_parser.add_argument("--epochs", type=int, default=30)
+
+    eval_parser = subparsers.add_parser("evaluate", help="Report accuracy and LLM calls avoided on a labelled corpus.")
+    eval_parser.add_argument("--corpus", required=True)
+    eval_parser.add_argument("--model", default=None, help="Saved model to score. Omit to cross-validate on the corpus.")
+    eval_parser.add_argument("--threshold", type=float, nargs="+", default=[0.6, 0.75, 0.9])
+
+    args = parser.parse_args()
+    if args.command == "train":
+        texts, labels, _ = load_examples(args.history)
+        print(f"Training on {len(texts)} labelled examples from {args.history}...")
+        HashedLogisticModel.train(texts, labels, epochs=args.epochs).save(args.model)
+        print(f"Model saved to {args.model}.")
+    else:
+        texts, labels, kinds = load_examples(args.corpus)
+        for threshold in args.threshold:
+            print(json.dumps(evaluate(texts, labels, threshold, args.model, kinds=kinds)))
@@ -0,0 +1,309 @@
+"""
+Retrieval over a directory of markdown/text knowledge-base documents.
+
+Documents are split into chunks of roughly chunk_words words on paragraph
+boundaries, and the chunks go into an in-memory BM25 inverted index that is
+pickled to disk. Re-indexing is incremental: only files whose size, mtime and
+content hash changed are re-chunked, and chunks of deleted files are dropped.
+
+If an embedder is given, chunk embeddings are also kept in a memory-mapped
+NumPy array next to the index. Search then fuses the BM25 and cosine
+rankings with reciprocal rank fusion. The embedder takes a list of texts and
+returns their vectors in order, so new chunks are embedded
+EMBEDDING_BATCH_SIZE at a time rather than with one request each.
+
+Usage (from the Backend directory):
+    python knowledge_base.py build --dir knowledge_base --index kb_index.pkl
+    python knowledge_base.py search --index kb_index.pkl "how do I reset my password"
+"""
+import argparse
+import hashlib
+import heapq
+import math
+import os
+import pickle
+import re
+from collections import Counter
+
+import numpy as np
+
+DOCUMENT_EXTENSIONS = (".md", ".markdown", ".txt")
+# Chunks per embedder call; about 27k tokens at 200 words a chunk, well under the API's per-request limit
+EMBEDDING_BATCH_SIZE = 100
+_TOKEN = re.compile(r"[a-z0-9]+")
+_STOPWORDS = frozenset(
+    "a an and are as at be but by can do does for from has have how i if in is it its me my "
+    "of on or our so that the their then there this to was we what when where which who why "
+    "will with you your".split()
+)
+
+
+def tokenize(text):
+    return [t for t in _TOKEN.findall(text.lower()) if t not in _STOPWORDS]
+
+
+def chunk_document(text, chunk_words=200):
+    """Packs paragraphs (and markdown sections) into chunks of about chunk_words words."""
+    chunks, current, current_words = [], [], 0
+    for paragraph in re.split(r"\n\s*\n|\n(?=#)", text):
+        paragraph = paragraph.strip()
+        if not paragraph:
+            continue
+        words = len(paragraph.split())
+        if current and (current_words + words > chunk_words or paragraph.startswith("#")):
+            chunks.append("\n\n".join(current))
+            current, current_words = [], 0
+        current.append(paragraph)
+        current_words += words
+    if current:
+        chunks.append("\n\n".join(current))
+    return chunks
+
+
+class KnowledgeBaseIndex:
+    """BM25 inverted index over knowledge-base chunks, with optional embeddings."""
+
+    def __init__(self, chunk_words=200, k1=1.2, b=0.75):
+        self.chunk_words = chunk_words
+        self.k1 = k1
+        self.b = b
+        self.files = {}        # path -> {"size", "mtime", "sha1", "chunk_ids"}
+        self.chunks = {}       # chunk_id -> {"source", "text", "length"}
+        self.postings = {}     # term -> {chunk_id: term frequency}
+        self.total_length = 0
+        self.next_chunk_id = 0
+        self.embedding_rows = {}  # chunk_id -> row in the embeddings array
+        self.embedder = None
+        self._embeddings = None
+        self._row_chunk_ids = None
+        self._lengths = np.zeros(1024, dtype=np.float32)  # chunk_id -> token count, for vectorised scoring
+        self._posting_arrays = {}  # term -> (chunk ids, term frequencies), built lazily for search
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_posting_arrays'] = {}
+        state['_embeddings'] = None
+        state['_row_chunk_ids'] = None
+        state['embedder'] = None
+        return state
+
+    # --- Building ---
+    def add_chunk(self, source, text):
+        chunk_id = self.next_chunk_id
+        self.next_chunk_id += 1
+        terms = Counter(tokenize(text))
+        length = sum(terms.values())
+        self.chunks[chunk_id] = {"source": source, "text": text, "length": length}
+        self.total_length += length
+        if chunk_id >= len(self._lengths):
+            self._lengths = np.concatenate([self._lengths, np.zeros(len(self._lengths), dtype=np.float32)])
+        self._lengths[chunk_id] = length
+        for term, tf in terms.items():
+            self.postings.setdefault(term, {})[chunk_id] = tf
+            self._posting_arrays.pop(term, None)
+        return chunk_id
+
+    def remove_chunk(self, chunk_id):
+        chunk = self.chunks.pop(chunk_id)
+        self.total_length -= chunk['length']
+        for term in set(tokenize(chunk['text'])):
+            posting = self.postings.get(term)
+            if posting is not None:
+                posting.pop(chunk_id, None)
+                self._posting_arrays.pop(term, None)
+                if not posting:
+                    del self.postings[term]
+        row = self.embedding_rows.pop(chunk_id, None)
+        if row is not None and self._embeddings is not None:
+            self._row_chunk_ids[row] = -1
+
+    def add_document(self, source, text):
+        return [self.add_chunk(source, chunk) for chunk in chunk_document(text, self.chunk_words)]
+
+    def update_from_directory(self, directory):
+        """Re-indexes new and changed documents and drops deleted ones. Returns (added, updated, removed)."""
+        seen = set()
+        added = updated = 0
+        for root, _, names in os.walk(directory):
+            for name in sorted(names):
+                if not name.lower().endswith(DOCUMENT_EXTENSIONS):
+                    continue
+                path = os.path.join(root, name)
+                seen.add(path)
+                stat = os.stat(path)
+                known = self.files.get(path)
+                if known and known['size'] == stat.st_size and known['mtime'] == stat.st_mtime:
+                    continue
+                with open(path, "r", encoding="utf-8", errors="replace") as f:
+                    text = f.read()
+                digest = hashlib.sha1(text.encode("utf-8")).hexdigest()
+                if known and known['sha1'] == digest:
+                    known['mtime'] = stat.st_mtime
+                    continue
+                if known:
+                    for chunk_id in known['chunk_ids']:
+                        self.remove_chunk(chunk_id)
+                    updated += 1
+                else:
+                    added += 1
+                chunk_ids = self.add_document(os.path.relpath(path, directory), text)
+                self.files[path] = {"size": stat.st_size, "mtime": stat.st_mtime, "sha1": digest, "chunk_ids": chunk_ids}
+
+        removed = [path for path in self.files if path not in seen]
+        for path in removed:
+            for chunk_id in self.files.pop(path)['chunk_ids']:
+                self.remove_chunk(chunk_id)
+        return added, updated, len(removed)
+
+    @property
+    def version(self):
+        """Changes whenever the indexed content changes."""
+        digest = hashlib.sha1()
+        for path in sorted(self.files):
+            digest.update(f"{path}\0{self.files[path]['sha1']}\n".encode("utf-8"))
+        return digest.hexdigest()
+
+    # --- Embeddings ---
+    def load_embeddings(self, embeddings_path):
+        """Memory-maps the embeddings matrix and maps its rows back to chunk ids."""
+        self._embeddings = np.load(embeddings_path, mmap_mode="r")
+        self._row_chunk_ids = np.full(len(self._embeddings), -1, dtype=np.int64)
+        for chunk_id, row in self.embedding_rows.items():
+            self._row_chunk_ids[row] = chunk_id
+
+    def update_embeddings(self, embeddings_path):
+        """
+        Embeds chunks that have no vector yet and rewrites the memory-mapped matrix.
+        Returns how many chunks were embedded, since embedding_rows then has to be saved with the index.
+        """
+        missing = [chunk_id for chunk_id in self.chunks if chunk_id not in self.embedding_rows]
+        if self._embeddings is None and self.embedding_rows and os.path.exists(embeddings_path):
+            self.load_embeddings(embeddings_path)
+        if not self.chunks:
+            self._embeddings = None
+            return 0
+        if not missing:
+            # Rows of deleted chunks stay in the file until the next rewrite; search skips them
+            return 0
+
+        new_vectors = []
+        for start in range(0, len(missing), EMBEDDING_BATCH_SIZE):
+            texts = [self.chunks[chunk_id]['text'] for chunk_id in missing[start:start + EMBEDDING_BATCH_SIZE]]
+            new_vectors.extend(np.asarray(self.embedder(texts), dtype=np.float32))
+        kept_ids = [chunk_id for chunk_id in self.chunks if chunk_id in self.embedding_rows]
+        tmp_path = f"{embeddings_path}.tmp.npy"
+        matrix = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=np.float32, shape=(len(kept_ids) + len(missing), len(new_vectors[0])))
+        if kept_ids:
+            matrix[:len(kept_ids)] = self._embeddings[[self.embedding_rows[chunk_id] for chunk_id in kept_ids]]
+        for row, vector in enumerate(new_vectors, start=len(kept_ids)):
+            matrix[row] = vector / (np.linalg.norm(vector) or 1.0)
+        matrix.flush()
+        del matrix
+        self._embeddings = None
+        os.replace(tmp_path, embeddings_path)
+        self.embedding_rows = {chunk_id: row for row, chunk_id in enumerate(kept_ids + missing)}
+        self.load_embeddings(embeddings_path)
+        return len(missing)
+
+    def _embedding_ranking(self, query, limit):
+        query_vector = np.asarray(self.embedder([query])[0], dtype=np.float32)
+        scores = self._embeddings @ (query_vector / (np.linalg.norm(query_vector) or 1.0))
+        scores[self._row_chunk_ids < 0] = -np.inf
+        limit = min(limit, len(scores))
+        top_rows = np.argpartition(-scores, limit - 1)[:limit]
+        return [int(self._row_chunk_ids[row]) for row in top_rows[np.argsort(-scores[top_rows])] if self._row_chunk_ids[row] >= 0]
+
+    # --- Search ---
+    def _posting_array(self, term):
+        arrays = self._posting_arrays.get(term)
+        if arrays is None:
+            posting = self.postings[term]
+            arrays = (np.fromiter(posting.keys(), dtype=np.int64, count=len(posting)),
+                      np.fromiter(posting.values(), dtype=np.float32, count=len(posting)))
+            self._posting_arrays[term] = arrays
+        return arrays
+
+    def bm25_ranking(self, query, limit):
+        chunk_count = len(self.chunks)
+        terms = [term for term in set(tokenize(query)) if term in self.postings]
+        if not chunk_count or not terms:
+            return []
+        average_length = self.total_length / chunk_count
+        scores = np.zeros(self.next_chunk_id, dtype=np.float32)
+        for term in terms:
+            chunk_ids, tfs = self._posting_array(term)
+            idf = math.log(1 + (chunk_count - len(chunk_ids) + 0.5) / (len(chunk_ids) + 0.5))
+            norm = self.k1 * (1 - self.b + self.b * self._lengths[chunk_ids] / average_length)
+            scores[chunk_ids] += idf * tfs * (self.k1 + 1) / (tfs + norm)
+        limit = min(limit, int(np.count_nonzero(scores)))
+        if limit == 0:
+            return []
+        top = np.argpartition(-scores, limit - 1)[:limit]
+        return [int(chunk_id) for chunk_id in top[np.argsort(-scores[top])]]
+
+    def search(self, query, k=4, hybrid=True):
+        """Returns the top-k chunks as dicts with source and text. hybrid=False ranks by BM25 alone."""
+        hybrid = hybrid and self._embeddings is not None and self.embedder is not None and len(self._embeddings)
+        ranking = self.bm25_ranking(query, k * 4 if hybrid else k)
+        if hybrid:
+            # Reciprocal rank fusion of the keyword and embedding rankings
+            fused = {}
+            for ranked in (ranking, self._embedding_ranking(query, k * 4)):
+                for rank, chunk_id in enumerate(ranked):
+                    fused[chunk_id] = fused.get(chunk_id, 0.0) + 1.0 / (60 + rank)
+            ranking = heapq.nlargest(k, fused, key=fused.get)
+        return [self.chunks[chunk_id] for chunk_id in ranking[:k]]
+
+    # --- Persistence ---
+    def save(self, path):
+        with open(f"{path}.tmp", "wb") as f:
+            pickle.dump(self, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(f"{path}.tmp", path)
+
+    @classmethod
+    def load(cls, path, chunk_words=200):
+        try:
+            with open(path, "rb") as f:
+                return pickle.load(f)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            return cls(chunk_words)
+
+    def attach_embeddings(self, embedder, embeddings_path):
+        """Enables hybrid search, embedding any chunks that do not have a vector yet. Returns how many were embedded."""
+        self.embedder = embedder
+        return self.update_embeddings(embeddings_path)
+
+    def detach_embeddings(self):
+        """Falls back to BM25-only search. Rows already embedded are kept for the next attach_embeddings()."""
+        self.embedder = None
+        self._embeddings = None
+        self._row_chunk_ids = None
+
+
+def format_chunks(chunks):
+    """Formats retrieved chunks for the system prompt."""
+    return "\n\n".join(f"[Source: {chunk['source']}]\n{chunk['text']}" for chunk in chunks)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build or query the knowledge-base index.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    build_parser = subparsers.add_parser("build", help="Index new and changed documents in a directory.")
+    build_parser.add_argument("--dir", required=True)
+    build_parser.add_argument("--index", default="kb_index.pkl")
+    build_parser.add_argument("--chunk-words", type=int, default=200)
+    search_parser = subparsers.add_parser("search", help="Show the top chunks for a query.")
+    search_parser.add_argument("--index", default="kb_index.pkl")
+    search_parser.add_argument("-k", type=int, default=4)
+    search_parser.add_argument("query")
+    args = parser.parse_args()
+
+    if args.command == "build":
+        index = KnowledgeBaseIndex.load(args.index, args.chunk_words)
+        added, updated, removed = index.update_from_directory(args.dir)
+        index.save(args.index)
+        print(f"Indexed {len(index.files)} documents / {len(index.chunks)} chunks "
+              f"({added} added, {updated} updated, {removed} removed).")
+    else:
+        for chunk in KnowledgeBaseIndex.load(args.index).search(args.query, args.k):
+            print(f"--- {chunk['source']} ---\n{chunk['text']}\n")
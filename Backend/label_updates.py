@@ -0,0 +1,42 @@
+"""
+Per-cycle queue of the label updates the bot makes to handled emails.
+
+Every handled email is marked read and given a bot label. That used to be one
+messages.modify call per email, and for ignored emails, most of the traffic,
+it was the only Gmail write. Emails now queue their update with add(). At the
+end of a cycle, drain() returns the updates grouped by label key, and
+main.flush_label_updates() applies each group with messages.batchModify calls
+of up to BATCH_MODIFY_MAX_IDS emails.
+"""
+import threading
+
+# Gmail rejects batchModify calls with more ids than this
+BATCH_MODIFY_MAX_IDS = 1000
+
+
+class LabelUpdateQueue:
+    """Thread-safe map of label key -> {message id: work-queue job, or None if there is none to advance}."""
+
+    def __init__(self):
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def add(self, label_key, msg_id, job=None):
+        with self._lock:
+            self._pending.setdefault(label_key, {})[msg_id] = job
+
+    def drain(self):
+        """Returns the queued updates and starts a new, empty queue."""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        return pending
+
+    def __len__(self):
+        with self._lock:
+            return sum(len(updates) for updates in self._pending.values())
+
+
+def chunked(items, size):
+    """Yields consecutive slices of items with at most size elements each."""
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
@@ -1,32 +1,124 @@
 import os.path
 import base64
+import hashlib
 import json
 import sys
 import re
 import time
-import openai
+import threading
 import uuid
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextlib import contextmanager, nullcontext
 from email.mime.text import MIMEText
-from google.auth.transport.requests import Request
+from importlib.metadata import PackageNotFoundError, version as package_version
+import httplib2
 from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
+from googleapiclient.discovery import build_from_document
 from googleapiclient.errors import HttpError
 from dotenv import load_dotenv
+from config_loader import load_config
+from thread_cache import ThreadCache
+from intent_classifier import AUTOMATED_MAIL_HEADERS, LocalIntentClassifier, automated_mail_kind
+from reply_cache import ReplyCache
+from mime_parser import extract_text, strip_quoted_reply
+from context_builder import ContextStats, SummaryCache, TokenCounter, build_context
+from work_queue import WorkQueue
+from label_updates import BATCH_MODIFY_MAX_IDS, LabelUpdateQueue, chunked
+from metrics import NULL_SPAN, StageMetrics
+from rate_limiter import RateLimiter, classify_error, estimate_request_tokens
+from telemetry import Telemetry
 
 load_dotenv()
 
 # --- Client Initialization ---
 SCOPES = ["https://www.googleapis.com/auth/gmail.modify", "https://www.googleapis.com/auth/gmail.labels"]
 
-try:
-    client = openai.OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-    if not client.api_key:
+# Built on first use by get_openai_client(), unless a caller such as a benchmark installed its own client
+client = None
+client_lock = threading.Lock()
+
+# Cached copy of the Gmail discovery document, so building a service neither fetches nor reads it each time
+GMAIL_DISCOVERY_CACHE_FILE = "gmail_discovery.json"
+GMAIL_DISCOVERY_URL = "https://gmail.googleapis.com/$discovery/rest?version=v1"
+gmail_discovery_document = None
+
+def check_openai_api_key():
+    """Exits if OPENAI_API_KEY is missing, so a mailbox fails at startup rather than on its first email."""
+    if not os.getenv("OPENAI_API_KEY"):
         print("ERROR: OpenAI API key not found in .env file.")
         sys.exit(1)
-except Exception as e:
-    print(f"ERROR: Failed to initialize OpenAI client: {e}")
-    sys.exit(1)
+
+def get_openai_client():
+    """Returns the OpenAI client, importing the SDK and building the client on first use."""
+    global client
+    with client_lock:
+        if client is None:
+            import openai
+            # Retries are scheduled by rate_limiter, so the SDK must not add its own
+            client = openai.OpenAI(api_key=os.getenv("OPENAI_API_KEY"), max_retries=0)
+        return client
+
+# Every global assigned between here and MAILBOX_GLOBALS belongs to one mailbox
+_PROCESS_GLOBALS = frozenset(globals()) | {"_PROCESS_GLOBALS"}
+
+# Resolved once per bot process by get_my_email()
+my_email_address = None
+# Parsed threads reused across emails and cycles; configured in main()
+thread_cache = None
+# Most body bytes decoded per MIME part and per thread; configured in setup_mailbox()
+mime_part_max_bytes = 64 * 1024
+thread_text_max_bytes = 256 * 1024
+
+# Rules/model tier consulted before the OpenAI intent call; configured in main()
+intent_classifier = None
+
+# Answers to repeated questions, keyed with reply_cache_version; configured in main()
+reply_cache = None
+reply_cache_version = None
+
+# Token budgeting of reply prompts with rolling per-thread summaries; configured in setup_mailbox()
+token_counter = None
+summary_cache = None
+context_stats = None
+
+# Retrieval index over settings.knowledge_base_dir; None means the inline knowledge_base string is used
+knowledge_index = None
+knowledge_index_checked_at = 0.0
+
+# Shared Gmail/OpenAI quota scheduler with retries; configured in main()
+rate_limiter = None
+
+# Durable per-email progress used to resume after a crash; configured in main()
+work_queue = None
+work_queue_pruned_at = 0.0
+
+# Label updates applied with messages.batchModify at the end of each cycle; configured in setup_mailbox()
+label_updates = None
+
+# Per-stage latency histograms, error and token counters; configured in setup_mailbox()
+stage_metrics = None
+
+# Gmail watch() registration for push mode; renewed by ensure_push_watch()
+push_active = False
+push_watch_renew_at = 0.0
+
+# The module-level state above belongs to one mailbox. A supervisor worker that
+# serves several mailboxes swaps it in and out with mailbox_context(). The
+# assignments above are the defaults, so a mailbox global is declared only once.
+MAILBOX_GLOBALS = {name: value for name, value in globals().items() if name not in _PROCESS_GLOBALS}
+
+def new_mailbox_context():
+    """Returns the module-level state of a mailbox that has not been set up yet."""
+    return dict(MAILBOX_GLOBALS)
+
+@contextmanager
+def mailbox_context(context):
+    """Installs one mailbox's module-level state for the block and saves any changes back into context."""
+    globals().update(context)
+    try:
+        yield
+    finally:
+        context.update({name: globals()[name] for name in MAILBOX_GLOBALS})
 
 # --- New Functions for API Communication ---
 def log_activity(state, from_email, intent, action):
@@ -37,62 +129,122 @@ def log_activity(state, from_email, intent, action):
         "from": from_email,
         "intent": intent,
         "action": action,
-        "time": time.strftime("%H:%M:%S")
+        "time": time.strftime("%H:%M:%S"),
+        "timestamp": time.time()
     }
-    # Insert at the beginning to show newest first
-    if 'activity_log' in state:
-        state['activity_log'].insert(0, log_entry)
+    state.log(log_entry)
 
 def increment_stat(state, key):
     """Increments a stat in the shared state."""
-    if 'stats' in state:
-        stats = state.get('stats', {"processed": 0, "replied": 0, "escalated": 0, "ignored": 0})
-        stats[key] += 1
-        state['stats'] = stats
-
-# --- Core Bot Functions (Unchanged from your original file) ---
-def load_config():
-    """Loads the configuration from config.json."""
-    try:
-        with open("config.json", "r") as f:
-            config = json.load(f)
-        print(f"Configuration loaded. Running Bot Version: {config.get('bot_version', 'unknown')}")
-        return config
-    except FileNotFoundError:
-        print("ERROR: config.json not found.")
-        sys.exit(1)
-    except json.JSONDecodeError:
-        print("ERROR: config.json is not valid JSON.")
-        sys.exit(1)
+    state.increment(key)
 
-def get_gmail_service():
-    """Authenticates with the Gmail API and returns a service object."""
+def stage_span(stage):
+    """Times a stage of the polling cycle for the latency histograms (see metrics.py)."""
+    return stage_metrics.span(stage) if stage_metrics is not None else NULL_SPAN
+
+def record_stage_error(stage):
+    """Counts an error a stage reported instead of raising."""
+    if stage_metrics is not None:
+        stage_metrics.error(stage)
+
+# --- Core Bot Functions ---
+def get_gmail_credentials(token_path="token.json", credentials_path="credentials.json"):
+    """Loads, refreshes or creates the Gmail OAuth credentials."""
     creds = None
-    if os.path.exists("token.json"):
-        creds = Credentials.from_authorized_user_file("token.json", SCOPES)
+    if os.path.exists(token_path):
+        creds = Credentials.from_authorized_user_file(token_path, SCOPES)
     
     if not creds or not creds.valid:
         if creds and creds.expired and creds.refresh_token:
+            from google.auth.transport.requests import Request
             try:
                 creds.refresh(Request())
             except Exception as e:
-                print(f"Token refresh failed: {e}. Deleting token.json for re-authentication.")
-                os.remove("token.json")
+                print(f"Token refresh failed: {e}. Deleting {token_path} for re-authentication.")
+                os.remove(token_path)
                 creds = None
         
         if not creds:
-            flow = InstalledAppFlow.from_client_secrets_file("credentials.json", SCOPES)
+            # Only needed the first time a mailbox is authorized
+            from google_auth_oauthlib.flow import InstalledAppFlow
+            flow = InstalledAppFlow.from_client_secrets_file(credentials_path, SCOPES)
             creds = flow.run_local_server(port=0)
         
-        with open("token.json", "w") as token:
+        with open(token_path, "w") as token:
             token.write(creds.to_json())
             
-    return build("gmail", "v1", credentials=creds)
+    return creds
+
+def gmail_discovery_version():
+    """Cache key of the discovery document: the Gmail API version and the installed google-api-python-client."""
+    try:
+        return f"gmail/v1 google-api-python-client/{package_version('google-api-python-client')}"
+    except PackageNotFoundError:
+        return "gmail/v1"
+
+def fetch_gmail_discovery_document():
+    """Returns the discovery document shipped with googleapiclient, or else the one Google serves."""
+    from googleapiclient.discovery_cache import get_static_doc
+    document = get_static_doc("gmail", "v1")
+    if document is None:
+        resp, content = httplib2.Http(timeout=30).request(GMAIL_DISCOVERY_URL)
+        if resp.status != 200:
+            raise HttpError(resp, content, uri=GMAIL_DISCOVERY_URL)
+        document = content.decode("utf-8")
+    return document
+
+def load_gmail_discovery_document(path=GMAIL_DISCOVERY_CACHE_FILE):
+    """
+    Returns the Gmail discovery document, read once per process. It is kept in path
+    and fetched again when gmail_discovery_version() no longer matches the cached copy.
+    """
+    global gmail_discovery_document
+    if gmail_discovery_document is not None:
+        return gmail_discovery_document
+    version = gmail_discovery_version()
+    try:
+        with open(path, "r") as f:
+            cached = json.load(f)
+        document = cached['document'] if cached.get('version') == version else None
+    except (FileNotFoundError, json.JSONDecodeError, KeyError, AttributeError):
+        document = None
+    if document is None:
+        document = fetch_gmail_discovery_document()
+        try:
+            # Worker processes may refresh it at the same time, so each writes its own temporary file
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump({"version": version, "document": document}, f)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"Could not cache the Gmail discovery document in {path}: {e}")
+    gmail_discovery_document = document
+    return document
+
+def get_gmail_service(creds=None):
+    """Authenticates with the Gmail API and returns a service object."""
+    return build_from_document(load_gmail_discovery_document(), credentials=creds or get_gmail_credentials())
+
+def gmail_execute(request, method, count=1):
+    """Executes a Gmail API request (or batch of `count` calls) under the shared quota, retrying transient errors."""
+    if rate_limiter is None:
+        return request.execute()
+    return rate_limiter.gmail(request.execute, method, count)
+
+def call_openai(create, **request):
+    """Calls an OpenAI API method under the shared rate limits, retrying transient errors."""
+    if rate_limiter is None:
+        response = create(**request)
+    else:
+        response = rate_limiter.openai(lambda: create(**request), estimate_request_tokens(request))
+    if stage_metrics is not None:
+        stage_metrics.record_tokens(getattr(response, 'usage', None))
+    return response
 
 def get_or_create_label_id(service, label_name):
-    """Finds a label ID by name. If it doesn't exist, creates it."""
+    """Finds a label ID by name. If it doesn't exist, creates it. Returns None if Gmail could not be asked."""
     try:
-        results = service.users().labels().list(userId='me').execute()
+        results = gmail_execute(service.users().labels().list(userId='me'), 'labels.list')
         labels = results.get('labels', [])
         
         for label in labels:
@@ -101,141 +253,591 @@ def get_or_create_label_id(service, label_name):
         
         print(f"Label '{label_name}' not found. Creating it...")
         label_body = {'name': label_name, 'labelListVisibility': 'labelShow', 'messageListVisibility': 'show'}
-        created_label = service.users().labels().create(userId='me', body=label_body).execute()
+        created_label = gmail_execute(service.users().labels().create(userId='me', body=label_body), 'labels.create')
         print(f"Label created with ID: {created_label['id']}")
         return created_label['id']
         
     except HttpError as error:
         print(f"An error occurred managing labels: {error}")
-        sys.exit(1)
-
-def get_body_from_message(message_part):
-    """Decodes and extracts the email body from a message part."""
-    body = ""
-    if message_part.get('body') and message_part['body'].get('data'):
-        data = message_part['body']['data']
-        body = base64.urlsafe_b64decode(data).decode('utf-8')
-    elif message_part.get('parts'):
-        for part in message_part['parts']:
-            if part['mimeType'] == 'text/plain':
-                return get_body_from_message(part)
-    return body.strip()
+        return None
 
-def fetch_thread_history(service, thread_id):
-    """Fetches and reconstructs the conversation history from an email thread."""
+def load_label_cache(path):
+    """Loads the label IDs found by earlier runs, keyed by label name."""
     try:
-        thread = service.users().threads().get(userId='me', id=thread_id).execute()
-        messages = thread['messages']
-        
-        profile = service.users().getProfile(userId='me').execute()
-        my_email = profile['emailAddress']
-        
-        conversation_history = []
-        full_conversation_text = ""
-        
-        for msg in messages:
-            headers = msg['payload']['headers']
-            sender_header = next((h['value'] for h in headers if h['name'].lower() == 'from'), '')
-            date_header = next((h['value'] for h in headers if h['name'].lower() == 'date'), '')
-            
-            sender_email_match = re.search(r'<(.+?)>', sender_header)
-            sender_email = sender_email_match.group(1) if sender_email_match else sender_header
-            
-            role = 'assistant' if sender_email == my_email else 'user'
-            body = get_body_from_message(msg['payload'])
+        with open(path, "r") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
 
-            if role == 'assistant':
-                body = body.split("\n\n---")[0].strip()
+def save_label_cache(path, label_cache):
+    """Atomically writes the label ID cache to disk."""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(label_cache, f)
+    os.replace(tmp_path, path)
 
-            if body:
-                conversation_history.append({"role": role, "content": body})
-                full_conversation_text += f"From: {sender_header}\nDate: {date_header}\n\n{body}\n\n{'='*40}\n\n"
-        
-        return conversation_history, full_conversation_text
+def resolve_label_ids(service, config):
+    """
+    Returns the bot's label IDs by key. IDs are cached in settings.label_cache_file, so a
+    restart only calls labels.list for labels that are new or were renamed in config.json.
+    """
+    path = config['settings']['label_cache_file']
+    label_cache = load_label_cache(path)
+    label_ids = {}
+    for key, name in config['labels'].items():
+        if name not in label_cache:
+            label_id = get_or_create_label_id(service, name)
+            if label_id is None:
+                # Only reached at startup, before any email was handled
+                sys.exit(1)
+            label_cache[name] = label_id
+        label_ids[key] = label_cache[name]
+    save_label_cache(path, label_cache)
+    return label_ids
+
+def refresh_label_id(service, config, label_ids, label_key):
+    """
+    Looks up a label whose cached ID Gmail rejected, e.g. because it was deleted, and updates label_ids
+    in place. Returns False if the lookup failed; label_ids is then left as it was.
+    """
+    path = config['settings']['label_cache_file']
+    name = config['labels'][label_key]
+    label_id = get_or_create_label_id(service, name)
+    if label_id is None:
+        return False
+    label_ids[label_key] = label_id
+    save_label_cache(path, {**load_label_cache(path), name: label_id})
+    return True
+
+def get_body_from_message(message_part, max_bytes):
+    """Extracts the readable text of a message, decoding at most max_bytes. Returns (text, decoded byte count)."""
+    return extract_text(message_part, mime_part_max_bytes, max_bytes)
+
+def get_my_email(service):
+    """Returns the authenticated mailbox address, resolved once per bot process."""
+    global my_email_address
+    if my_email_address is None:
+        profile = gmail_execute(service.users().getProfile(userId='me'), 'getProfile')
+        my_email_address = profile['emailAddress']
+    return my_email_address
+
+def parse_thread_message(msg, my_email, max_bytes):
+    """
+    Extracts the sender, date, role and body of one message in a thread, without quoted replies.
+    Returns (parsed message, decoded body bytes).
+    """
+    headers = msg['payload']['headers']
+    sender_header = next((h['value'] for h in headers if h['name'].lower() == 'from'), '')
+    date_header = next((h['value'] for h in headers if h['name'].lower() == 'date'), '')
+    
+    sender_email_match = re.search(r'<(.+?)>', sender_header)
+    sender_email = sender_email_match.group(1) if sender_email_match else sender_header
+    
+    role = 'assistant' if sender_email == my_email else 'user'
+    body, decoded = get_body_from_message(msg['payload'], max_bytes)
+    body = strip_quoted_reply(body)
+
+    if role == 'assistant':
+        body = body.split("\n\n---")[0].strip()
+
+    return {"id": msg['id'], "role": role, "content": body, "from": sender_header, "date": date_header}, decoded
+
+def parse_thread_messages(messages, my_email):
+    """Parses a thread newest first, so a thread over thread_text_max_bytes loses its oldest bodies."""
+    budget = thread_text_max_bytes
+    thread_messages = []
+    for msg in reversed(messages):
+        parsed, decoded = parse_thread_message(msg, my_email, budget)
+        budget -= decoded
+        thread_messages.append(parsed)
+    thread_messages.reverse()
+    return thread_messages
+
+def build_conversation(thread_messages):
+    """Turns parsed thread messages into the chat history and the plain-text transcript."""
+    conversation_history = []
+    transcript_parts = []
+    for msg in thread_messages:
+        if msg['content']:
+            conversation_history.append({"role": msg['role'], "content": msg['content']})
+            transcript_parts.append(f"From: {msg['from']}\nDate: {msg['date']}\n\n{msg['content']}\n\n{'='*40}\n\n")
+    return conversation_history, "".join(transcript_parts)
+
+def fetch_thread_messages(service, thread_id):
+    """Returns the thread's parsed messages, downloading only what changed since it was cached."""
+    my_email = get_my_email(service)
+    cached = thread_cache.get(thread_id) if thread_cache else None
+
+    if cached is None:
+        thread = gmail_execute(service.users().threads().get(userId='me', id=thread_id), 'threads.get')
+        thread_messages = parse_thread_messages(thread['messages'], my_email)
+        outcome = 'miss'
+    else:
+        cached_history_id, cached_messages = cached
+        # A minimal fetch returns only ids and the historyId, which is enough to spot changes
+        thread = gmail_execute(service.users().threads().get(userId='me', id=thread_id, format='minimal', fields='historyId,messages/id'), 'threads.get')
+        if thread['historyId'] == cached_history_id:
+            thread_messages = cached_messages
+            outcome = 'hit'
+        else:
+            known = {msg['id']: msg for msg in cached_messages}
+            budget = thread_text_max_bytes
+            thread_messages = []
+            for msg_summary in reversed(thread['messages']):
+                if msg_summary['id'] not in known:
+                    msg = gmail_execute(service.users().messages().get(userId='me', id=msg_summary['id']), 'messages.get')
+                    known[msg_summary['id']], decoded = parse_thread_message(msg, my_email, budget)
+                    budget -= decoded
+                thread_messages.append(known[msg_summary['id']])
+            thread_messages.reverse()
+            outcome = 'delta'
+
+    if thread_cache:
+        thread_cache.record(outcome)
+        thread_cache.put(thread_id, thread['historyId'], thread_messages)
+    return thread_messages
+
+def fetch_thread_messages_or_empty(service, thread_id):
+    """fetch_thread_messages(), printing API errors and returning no messages instead of raising."""
+    try:
+        return fetch_thread_messages(service, thread_id)
     except HttpError as error:
         print(f"An error occurred fetching thread: {error}")
-        return [], ""
+        record_stage_error('thread_fetch')
+        return []
 
-def fetch_unread_emails(service, label_config):
-    """Fetches unread emails, EXCLUDING any that have already been processed by the bot."""
+def fetch_thread_history(service, thread_id):
+    """Fetches and reconstructs the conversation history from an email thread."""
+    return build_conversation(fetch_thread_messages_or_empty(service, thread_id))
+
+def fetch_message_metadata(service, message_ids, batch_size):
+    """Fetches Subject/From metadata for many messages using Gmail batch requests."""
+    batch_size = max(1, min(batch_size, 100))  # Gmail rejects batches larger than 100 calls
+    results = {}
+    retry_ids = []
+
+    def handle_response(request_id, response, exception):
+        if exception is not None:
+            if rate_limiter is not None and classify_error(exception)[0]:
+                retry_ids.append((request_id, exception))
+            else:
+                print(f"An error occurred fetching message {request_id}: {exception}")
+                record_stage_error('fetch')
+            return
+        headers = response['payload']['headers']
+        results[request_id] = {
+            "id": request_id, "threadId": response['threadId'],
+            "subject": next((h['value'] for h in headers if h['name'] == 'Subject'), ''),
+            "from": next((h['value'] for h in headers if h['name'] == 'From'), ''),
+            # "auto_reply" or "bulk" for mail that needs no answer; see intent_classifier
+            "automated": automated_mail_kind({h['name']: h['value'] for h in headers if h['name'] in AUTOMATED_MAIL_HEADERS}),
+        }
+
+    pending_ids, attempt = message_ids, 0
+    while pending_ids:
+        for start in range(0, len(pending_ids), batch_size):
+            chunk = pending_ids[start:start + batch_size]
+            batch = service.new_batch_http_request(callback=handle_response)
+            for msg_id in chunk:
+                batch.add(service.users().messages().get(userId='me', id=msg_id, format='metadata', metadataHeaders=['Subject', 'From', *AUTOMATED_MAIL_HEADERS]), request_id=msg_id)
+            try:
+                gmail_execute(batch, 'messages.get', len(chunk))
+            except HttpError as error:
+                print(f"An error occurred executing metadata batch: {error}")
+                record_stage_error('fetch')
+
+        # Calls inside a batch fail one by one, so throttled ones are retried as a smaller batch
+        pending_ids = [msg_id for msg_id, _ in retry_ids]
+        if pending_ids:
+            try:
+                time.sleep(rate_limiter.retry_delay("gmail", retry_ids[0][1], attempt))
+            except HttpError as error:
+                print(f"Giving up on {len(pending_ids)} messages after repeated errors: {error}")
+                break
+            retry_ids.clear()
+            attempt += 1
+
+    # Keep the order returned by messages().list()
+    return [results[msg_id] for msg_id in message_ids if msg_id in results]
+
+def search_unread_message_ids(service, label_config):
+    """Lists unread INBOX message ids the bot has not labelled yet. Returns None if the search failed."""
     labels_to_exclude = " ".join([f"-label:\"{name}\"" for name in label_config.values()])
     query = f"is:unread {labels_to_exclude}"
     print(f"Searching with query: {query}")
     
     try:
-        result = service.users().messages().list(userId="me", labelIds=['INBOX'], q=query).execute()
-        messages = result.get('messages', [])
-        if not messages: 
-            return []
-
-        email_data = []
-        for msg_summary in messages:
-            msg = service.users().messages().get(userId='me', id=msg_summary['id'], format='metadata', metadataHeaders=['Subject', 'From']).execute()
-            headers = msg['payload']['headers']
-            email_data.append({
-                "id": msg_summary['id'], "threadId": msg['threadId'],
-                "subject": next((h['value'] for h in headers if h['name'] == 'Subject'), ''),
-                "from": next((h['value'] for h in headers if h['name'] == 'From'), ''),
-            })
-        return email_data
+        result = gmail_execute(service.users().messages().list(userId="me", labelIds=['INBOX'], q=query), 'messages.list')
+        return [msg_summary['id'] for msg_summary in result.get('messages', [])]
     except HttpError as error:
         print(f"An error occurred fetching emails: {error}")
+        record_stage_error('fetch')
+        return None
+
+def fetch_unread_emails(service, label_config, batch_size=50):
+    """Fetches unread emails, EXCLUDING any that have already been processed by the bot."""
+    message_ids = search_unread_message_ids(service, label_config)
+    if not message_ids:
         return []
+    return fetch_message_metadata(service, message_ids, batch_size)
 
-def determine_user_intent(last_message_content, config):
-    """Uses OpenAI to classify the user's intent."""
-    print("Determining user intent...")
+def load_sync_checkpoint(path):
+    """Loads the incremental sync checkpoint (last historyId) from disk."""
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+def save_sync_checkpoint(path, checkpoint):
+    """Atomically writes the incremental sync checkpoint to disk."""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(checkpoint, f)
+    os.replace(tmp_path, path)
+
+def fetch_history_emails(service, start_history_id, label_ids, batch_size):
+    """Fetches unread INBOX messages added since start_history_id. Raises HttpError 404 if the ID has expired."""
+    bot_label_ids = set(label_ids.values())
+    message_ids = []
+    latest_history_id = start_history_id
+
+    request = service.users().history().list(userId='me', startHistoryId=start_history_id, labelId='INBOX', historyTypes=['messageAdded'])
+    while request is not None:
+        response = gmail_execute(request, 'history.list')
+        latest_history_id = response.get('historyId', latest_history_id)
+        for record in response.get('history', []):
+            for added in record.get('messagesAdded', []):
+                msg = added['message']
+                msg_labels = set(msg.get('labelIds', []))
+                if 'UNREAD' in msg_labels and not msg_labels & bot_label_ids and msg['id'] not in message_ids:
+                    message_ids.append(msg['id'])
+        request = service.users().history().list_next(request, response)
+
+    if not message_ids:
+        return [], latest_history_id
+    emails = fetch_message_metadata(service, message_ids, batch_size)
+    if len(emails) < len(message_ids):
+        # Read the same history again next cycle, so the messages that failed are not lost until a full sync
+        print(f"Could not fetch {len(message_ids) - len(emails)} messages. Keeping historyId {start_history_id}.")
+        return emails, start_history_id
+    return emails, latest_history_id
+
+def fetch_new_emails(service, config, label_ids, sync_state):
+    """
+    Returns (emails, checkpoint). In 'history' sync mode only messages added since the stored
+    historyId are fetched, with a full search on first run, on expiry and every full_sync_interval_seconds.
+    The checkpoint keeps the stored historyId while any message could not be fetched or handled
+    (see commit_sync_checkpoint), so the next incremental sync reads those messages again.
+    """
+    settings = config['settings']
+    batch_size = settings['metadata_batch_size']
+    if settings['sync_mode'] != 'history' or sync_state is None:
+        return fetch_unread_emails(service, config['labels'], batch_size), None
+
+    history_id = sync_state.get('historyId')
+    full_sync_due = time.time() - sync_state.get('last_full_sync', 0) >= settings['full_sync_interval_seconds']
+    if history_id and not full_sync_due:
+        try:
+            emails, latest_history_id = fetch_history_emails(service, history_id, label_ids, batch_size)
+            print(f"Incremental sync from historyId {history_id}: {len(emails)} new messages.")
+            return emails, {**sync_state, 'historyId': latest_history_id}
+        except HttpError as error:
+            if error.resp.status != 404:
+                print(f"An error occurred fetching mailbox history: {error}")
+                record_stage_error('fetch')
+                return [], None
+            print(f"History ID {history_id} has expired. Falling back to a full search.")
+
+    try:
+        # Read the current historyId before searching so nothing added during the search is missed
+        profile = gmail_execute(service.users().getProfile(userId='me'), 'getProfile')
+    except HttpError as error:
+        print(f"An error occurred fetching the mailbox profile: {error}")
+        record_stage_error('fetch')
+        return [], None
+    message_ids = search_unread_message_ids(service, config['labels'])
+    if message_ids is None:
+        return [], None
+    emails = fetch_message_metadata(service, message_ids, batch_size) if message_ids else []
+    checkpoint = {'historyId': profile['historyId'], 'last_full_sync': time.time()}
+    if len(emails) < len(message_ids):
+        print(f"Could not fetch {len(message_ids) - len(emails)} messages.")
+        return emails, checkpoint_keeping_history_id(sync_state, checkpoint)
+    return emails, checkpoint
+
+def checkpoint_keeping_history_id(sync_state, checkpoint):
+    """The checkpoint with the stored historyId, or None if there is none to keep."""
+    if checkpoint is None or not sync_state.get('historyId'):
+        return None
+    return {**checkpoint, 'historyId': sync_state['historyId']}
+
+def start_push_watch(service, topic_name):
+    """Asks Gmail to publish INBOX changes to a Pub/Sub topic. Returns the historyId and expiration (epoch ms)."""
+    body = {'topicName': topic_name, 'labelIds': ['INBOX'], 'labelFilterBehavior': 'include'}
+    return gmail_execute(service.users().watch(userId='me', body=body), 'watch')
+
+def ensure_push_watch(service, config):
+    """
+    Arms the Gmail watch in push mode and re-arms it before it expires. Returns True while push
+    notifications can be relied on, so the mailbox only needs the slow safety-net poll.
+    Only the supervisor calls this, since it is what delivers the notifications.
+    """
+    global push_active, push_watch_renew_at
+    settings = config['settings']
+    if not settings['push_topic_name']:
+        return False
+    if time.time() < push_watch_renew_at:
+        return push_active
+    try:
+        response = start_push_watch(service, settings['push_topic_name'])
+    except HttpError as error:
+        print(f"An error occurred arming the Gmail watch: {error}. Polling every {settings['polling_interval_seconds']} seconds instead.")
+        push_active = False
+        push_watch_renew_at = time.time() + settings['push_safety_poll_seconds']
+        return False
+    expires_at = int(response['expiration']) / 1000
+    # Renewal only happens between cycles, which are at most push_safety_poll_seconds apart
+    push_watch_renew_at = min(time.time() + settings['push_rewatch_seconds'], expires_at - settings['push_safety_poll_seconds'])
+    push_active = True
+    print(f"Gmail watch armed on {settings['push_topic_name']} until {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(expires_at))}.")
+    return True
+
+INTENT_ON_ERROR = None # Leave the email for a later cycle rather than guess an action
+REPLY_ON_ERROR = "I'm sorry, I encountered an error. A human agent will get back to you shortly."
+
+def build_intent_request(last_message_content, config):
+    """Builds the chat completion arguments for intent classification."""
     intent_prompt_template = config['prompts']['intent_classifier']
     intent_prompt = intent_prompt_template.format(last_message_content=last_message_content)
+    return {
+        "model": config['settings']['openai_model'],
+        "messages": [{"role": "user", "content": intent_prompt}],
+        "max_tokens": config['settings']['max_intent_tokens'],
+        "temperature": 0
+    }
+
+def clean_intent_output(model_output):
+    """Maps the raw classifier output onto one of the known intents."""
+    raw_intent_output = model_output.strip().lower().replace("\"", "")
     
+    clean_intent = "other" 
+    if "escalation_request" in raw_intent_output:
+        clean_intent = "escalation_request"
+    elif "question" in raw_intent_output:
+        clean_intent = "question"
+    elif "follow_up" in raw_intent_output:
+        clean_intent = "follow_up"
+    elif "other" in raw_intent_output:
+        clean_intent = "other"
+
+    print(f"Raw model output: '{raw_intent_output}'. ---> Cleaned Intent: '{clean_intent}'")
+    return clean_intent
+
+def classify_intent_locally(last_message_content, config, automated=None):
+    """
+    Returns the local classifier's intent when it is confident enough, otherwise None.
+    automated is the email's "automated" kind from fetch_message_metadata().
+    """
+    if intent_classifier is None:
+        return None
+    decision = intent_classifier.classify(last_message_content, automated)
+    if decision is None or decision.confidence < config['settings']['local_intent_threshold']:
+        return None
+    print(f"Local classifier ({decision.source}, confidence {decision.confidence:.2f}) ---> Intent: '{decision.intent}'")
+    return decision.intent
+
+def record_llm_intent(last_message_content, intent):
+    """Keeps the LLM's decision as a training example for the local classifier."""
+    if intent_classifier is not None:
+        intent_classifier.record_example(last_message_content, intent)
+
+def determine_user_intent(last_message_content, config, automated=None):
+    """Classifies the user's intent locally when confident, otherwise with OpenAI."""
+    print("Determining user intent...")
+    local_intent = classify_intent_locally(last_message_content, config, automated)
+    if local_intent:
+        return local_intent
     try:
-        response = client.chat.completions.create(
-            model=config['settings']['openai_model'],
-            messages=[{"role": "user", "content": intent_prompt}],
-            max_tokens=config['settings']['max_intent_tokens'],
-            temperature=0
-        )
-        raw_intent_output = response.choices[0].message.content.strip().lower().replace("\"", "")
-        
-        clean_intent = "other" 
-        if "escalation_request" in raw_intent_output:
-            clean_intent = "escalation_request"
-        elif "question" in raw_intent_output:
-            clean_intent = "question"
-        elif "follow_up" in raw_intent_output:
-            clean_intent = "follow_up"
-        elif "other" in raw_intent_output:
-            clean_intent = "other"
-
-        print(f"Raw model output: '{raw_intent_output}'. ---> Cleaned Intent: '{clean_intent}'")
-        return clean_intent
-        
+        response = call_openai(get_openai_client().chat.completions.create, **build_intent_request(last_message_content, config))
+        intent = clean_intent_output(response.choices[0].message.content)
+        record_llm_intent(last_message_content, intent)
+        return intent
     except Exception as e:
         print(f"Error determining intent: {e}")
-        return "question" # Default to question on error to be safe
+        record_stage_error('intent')
+        return INTENT_ON_ERROR
 
-def generate_ai_reply(email_subject, conversation_history, config):
-    """Generates a standard AI reply for user questions."""
-    print("Generating AI reply...")
-    knowledge_base_context = config['knowledge_base']
+INTENTS = ["question", "escalation_request", "follow_up", "other"]
+# Structured output for llm_call_mode 'combined': the intent and the reply from one request
+INTENT_REPLY_SCHEMA = {
+    "name": "intent_and_reply",
+    "strict": True,
+    "schema": {
+        "type": "object",
+        "properties": {"intent": {"type": "string", "enum": INTENTS}, "reply": {"type": "string"}},
+        "required": ["intent", "reply"],
+        "additionalProperties": False,
+    },
+}
+
+def build_intent_reply_request(email_subject, conversation_history, config, thread_id=None):
+    """Builds one chat completion that returns both the intent of the latest message and the reply."""
+    request = build_reply_request(email_subject, conversation_history, config, thread_id)
+    request['messages'][0] = {"role": "system", "content": f"{request['messages'][0]['content']}\n\n{config['prompts']['intent_reply_instructions']}"}
+    request['max_tokens'] += config['settings']['max_intent_tokens']
+    # The reply keeps its usual temperature; the strict schema already limits the intent to the known labels
+    request['response_format'] = {"type": "json_schema", "json_schema": INTENT_REPLY_SCHEMA}
+    return request
+
+def parse_intent_reply_output(model_output):
+    """
+    Returns (intent, reply_text) from a structured intent-and-reply response. Malformed output falls back to
+    the keyword cleaning of the intent, and no reply, so raw JSON is never sent to a customer.
+    """
+    try:
+        data = json.loads(model_output)
+        return clean_intent_output(str(data['intent'])), str(data['reply']).strip() or None
+    except (json.JSONDecodeError, KeyError, TypeError):
+        match = re.search(r'"intent"\s*:\s*"([^"]*)"', model_output)
+        return clean_intent_output(match.group(1) if match else model_output), None
+
+def determine_intent_and_reply(email_subject, conversation_history, config, thread_id=None, automated=None):
+    """
+    Single-call mode: classifies the latest message and drafts the reply in one structured request.
+    Returns (intent, reply_text). reply_text is None unless the intent is 'question', and also when the
+    caller still has to generate the reply (local or cached decisions, malformed output).
+    """
+    print("Determining user intent and drafting a reply in one call...")
+    last_message_content = conversation_history[-1]['content']
+    # Local decisions and cached replies are cheaper than any generation, so they keep the separate path
+    local_intent = classify_intent_locally(last_message_content, config, automated)
+    if local_intent:
+        return local_intent, None
+    cached_reply = lookup_cached_reply(conversation_history)
+    if cached_reply:
+        intent = determine_user_intent(last_message_content, config, automated)
+        return intent, cached_reply if intent == "question" else None
+    try:
+        request = build_intent_reply_request(email_subject, conversation_history, config, thread_id)
+        response = call_openai(get_openai_client().chat.completions.create, **request)
+        intent, reply_text = parse_intent_reply_output(response.choices[0].message.content)
+    except Exception as e:
+        print(f"Error determining intent and reply: {e}")
+        record_stage_error('intent')
+        return INTENT_ON_ERROR, None
+    record_llm_intent(last_message_content, intent)
+    if intent != "question" or reply_text is None:
+        return intent, None
+    record_prompt_tokens(request, response.usage, conversation_history)
+    store_cached_reply(conversation_history, reply_text, response.usage)
+    return intent, reply_text
+
+def retrieve_knowledge_base_context(email_subject, conversation_history, config):
+    """Returns the most relevant knowledge-base chunks for the latest message, or the inline knowledge base."""
+    if knowledge_index is None:
+        return config['knowledge_base']
+    from knowledge_base import format_chunks
+    query = f"{email_subject}\n{conversation_history[-1]['content']}"
+    top_k = config['settings']['knowledge_base_top_k']
+    try:
+        return format_chunks(knowledge_index.search(query, top_k))
+    except Exception as e:
+        print(f"Error embedding the knowledge-base query: {e}. Using keyword search for this email.")
+        return format_chunks(knowledge_index.search(query, top_k, hybrid=False))
+
+def summarize_turns(previous_summary, turns, config):
+    """Folds older turns into a thread's rolling summary. Returns None if the call fails."""
+    settings = config['settings']
+    transcript = "\n\n".join(f"{turn['role']}: {turn['content']}" for turn in turns)
+    prompt = config['prompts']['conversation_summary'].format(previous_summary=previous_summary or "(none)", messages=transcript)
+    try:
+        response = call_openai(get_openai_client().chat.completions.create, model=settings['openai_model'],
+                               messages=[{"role": "user", "content": prompt}], max_tokens=settings['context_summary_max_tokens'])
+        return response.choices[0].message.content.strip()
+    except Exception as e:
+        print(f"Error summarizing earlier messages: {e}")
+        return None
+
+def budget_conversation(thread_id, conversation_history, config):
+    """Trims the conversation to context_token_budget, replacing older turns with the thread's rolling summary."""
+    if token_counter is None:
+        return conversation_history
+    settings = config['settings']
+    messages, summarized = build_context(thread_id, conversation_history, settings['context_token_budget'],
+                                         settings['context_summary_max_tokens'], token_counter, summary_cache,
+                                         lambda previous, turns: summarize_turns(previous, turns, config))
+    if summarized:
+        print(f"Context budget: {summarized} older messages summarized, {len(conversation_history) - summarized} sent in full.")
+    return messages
+
+def build_reply_request(email_subject, conversation_history, config, thread_id=None):
+    """Builds the chat completion arguments for a reply to the conversation."""
+    knowledge_base_context = retrieve_knowledge_base_context(email_subject, conversation_history, config)
     system_prompt_template = config['prompts']['ai_reply_system']
     system_prompt = system_prompt_template.format(
         email_subject=email_subject,
         knowledge_base_context=knowledge_base_context
     )
     
-    messages_for_api = [{"role": "system", "content": system_prompt}] + conversation_history
-    
+    messages_for_api = [{"role": "system", "content": system_prompt}] + budget_conversation(thread_id, conversation_history, config)
+    return {
+        "model": config['settings']['openai_model'],
+        "messages": messages_for_api,
+        "max_tokens": config['settings']['max_reply_tokens'],
+        "temperature": config['settings']['reply_temperature']
+    }
+
+def knowledge_base_version(config):
+    """Fingerprint of everything besides the email that shapes a reply."""
+    knowledge = knowledge_index.version if knowledge_index is not None else config['knowledge_base']
+    reply_inputs = "\n".join([config['settings']['openai_model'], config['prompts']['ai_reply_system'], knowledge])
+    return hashlib.sha1(reply_inputs.encode("utf-8")).hexdigest()
+
+def lookup_cached_reply(conversation_history):
+    """Returns a cached reply for a new single-message thread, or None."""
+    # Later turns depend on the rest of the thread, so only opening messages are cached
+    if reply_cache is None or len(conversation_history) != 1:
+        return None
+    cached = reply_cache.lookup(conversation_history[-1]['content'], reply_cache_version)
+    if cached is None:
+        return None
+    reply_text, match_kind = cached
+    print(f"Reply cache hit ({match_kind}). Skipping generation.")
+    return reply_text
+
+def store_cached_reply(conversation_history, reply_text, usage):
+    """Caches a generated reply for a new single-message thread."""
+    if reply_cache is None or len(conversation_history) != 1:
+        return
+    reply_cache.store(conversation_history[-1]['content'], reply_cache_version, reply_text, usage.total_tokens if usage else 0)
+
+def record_prompt_tokens(request, usage, conversation_history):
+    """Counts the prompt size of one generated reply for the dashboard."""
+    if context_stats is None:
+        return
+    prompt_tokens = usage.prompt_tokens if usage else token_counter.count_messages(request['messages'])
+    sent_turns = sum(1 for message in request['messages'] if message['role'] != 'system')
+    context_stats.record(prompt_tokens, len(conversation_history), sent_turns)
+    print(f"Reply prompt: {prompt_tokens} tokens, {sent_turns} of {len(conversation_history)} messages sent in full.")
+
+def generate_ai_reply(email_subject, conversation_history, config, thread_id=None):
+    """Generates a standard AI reply for user questions."""
+    print("Generating AI reply...")
+    cached_reply = lookup_cached_reply(conversation_history)
+    if cached_reply:
+        return cached_reply
     try:
-        response = client.chat.completions.create(
-            model=config['settings']['openai_model'],
-            messages=messages_for_api,
-            max_tokens=config['settings']['max_reply_tokens']
-        )
-        return response.choices[0].message.content.strip()
+        request = build_reply_request(email_subject, conversation_history, config, thread_id)
+        response = call_openai(get_openai_client().chat.completions.create, **request)
+        reply_text = response.choices[0].message.content.strip()
+        record_prompt_tokens(request, response.usage, conversation_history)
+        store_cached_reply(conversation_history, reply_text, response.usage)
+        return reply_text
     except Exception as e:
         print(f"Error generating AI reply: {e}")
-        return "I'm sorry, I encountered an error. A human agent will get back to you shortly."
+        record_stage_error('reply')
+        return REPLY_ON_ERROR
 
 def send_email(service, to, subject, message_text, thread_id):
     """Creates and sends an email reply."""
@@ -248,10 +850,15 @@ def send_email(service, to, subject, message_text, thread_id):
         message['to'], message['from'], message['subject'] = recipient_email, 'me', reply_subject
         raw_message = base64.urlsafe_b64encode(message.as_bytes()).decode()
         body = {'raw': raw_message, 'threadId': thread_id}
-        service.users().messages().send(userId='me', body=body).execute()
+        gmail_execute(service.users().messages().send(userId='me', body=body), 'messages.send')
         print(f"Email reply sent to {recipient_email}.")
-    except HttpError as error:
+        return True
+    # Gmail may have accepted a send that failed this way, so it is not repeated here.
+    # The next cycle checks the thread for the reply before sending again.
+    except (HttpError, httplib2.HttpLib2Error, ConnectionError, TimeoutError) as error:
         print(f"An error occurred while sending email: {error}")
+        record_stage_error('send')
+        return False
 
 def forward_email_to_support(service, user_email, subject, full_conversation_text, config):
     """Forwards the entire conversation to the support email address."""
@@ -264,120 +871,537 @@ def forward_email_to_support(service, user_email, subject, full_conversation_tex
         message = MIMEText(forward_body)
         message['to'], message['from'], message['subject'] = support_email, 'me', forward_subject
         raw_message = base64.urlsafe_b64encode(message.as_bytes()).decode()
-        service.users().messages().send(userId='me', body={'raw': raw_message}).execute()
+        gmail_execute(service.users().messages().send(userId='me', body={'raw': raw_message}), 'messages.send')
         print("Forwarded to support successfully.")
-    except HttpError as error:
+        return True
+    except (HttpError, httplib2.HttpLib2Error, ConnectionError, TimeoutError) as error:
         print(f"An error occurred while forwarding email: {error}")
+        record_stage_error('send')
+        return False
 
 def modify_message(service, msg_id, add_label_id):
-    """Marks an email as read and applies a specified label."""
+    """Marks an email as read and applies a specified label. Returns False if it should be tried again."""
     try:
         body = {
             'removeLabelIds': ['UNREAD'],
             'addLabelIds': [add_label_id]
         }
-        service.users().messages().modify(userId='me', id=msg_id, body=body).execute()
+        gmail_execute(service.users().messages().modify(userId='me', id=msg_id, body=body), 'messages.modify')
+        return True
     except HttpError as error:
+        if error.resp.status == 404:
+            print(f"Message {msg_id} no longer exists. Nothing to label.")
+            return True
         print(f"An error occurred while modifying message: {error}")
+        record_stage_error('label')
+        return False
+
+def is_unknown_label_error(error):
+    """True if Gmail rejected a modify call because one of its label IDs does not exist."""
+    content = error.content.decode("utf-8", "replace") if isinstance(error.content, bytes) else str(error.content)
+    return error.resp.status == 400 and "label" in content.lower()
+
+def batch_modify_messages(service, config, label_ids, label_key, msg_ids):
+    """
+    Marks up to BATCH_MODIFY_MAX_IDS emails as read and applies a bot label with one messages.batchModify.
+    A stale cached label ID is looked up again and the call retried once. If the call still fails,
+    the emails are labelled one by one. Returns the IDs that no longer need labelling.
+    """
+    for attempt in range(2):
+        try:
+            body = {'ids': msg_ids, 'removeLabelIds': ['UNREAD'], 'addLabelIds': [label_ids[label_key]]}
+            gmail_execute(service.users().messages().batchModify(userId='me', body=body), 'messages.batchModify')
+            return msg_ids
+        except HttpError as error:
+            print(f"An error occurred while labelling {len(msg_ids)} messages: {error}")
+            record_stage_error('label')
+            if attempt or not is_unknown_label_error(error):
+                break
+            print(f"Label '{config['labels'][label_key]}' has a stale ID. Looking it up again.")
+            if not refresh_label_id(service, config, label_ids, label_key):
+                break
+    print(f"Labelling {len(msg_ids)} messages one by one instead.")
+    return [msg_id for msg_id in msg_ids if modify_message(service, msg_id, label_ids[label_key])]
+
+def label_email(service, msg_id, label_ids, label_key, job=None):
+    """
+    Queues an email's label update for the end of the cycle, when flush_label_updates() advances
+    its job to 'labelled'. Without a queue, e.g. outside setup_mailbox(), the label is applied now.
+    """
+    if label_updates is not None:
+        label_updates.add(label_key, msg_id, job)
+    elif modify_message(service, msg_id, label_ids[label_key]) and job is not None:
+        advance_job(job, 'labelled')
+
+def flush_label_updates(service, config, label_ids):
+    """
+    Applies the label updates queued this cycle with one messages.batchModify per label and
+    BATCH_MODIFY_MAX_IDS emails. Emails that could not be labelled keep their 'replied' state
+    and are handed back to the work queue, so the next cycle resumes them even in history sync mode.
+    """
+    pending = label_updates.drain() if label_updates is not None else {}
+    if not pending:
+        return
+    failed = []
+    with stage_span('label'):
+        for label_key, jobs in pending.items():
+            for msg_ids in chunked(list(jobs), BATCH_MODIFY_MAX_IDS):
+                labelled = set(batch_modify_messages(service, config, label_ids, label_key, msg_ids))
+                for msg_id in msg_ids:
+                    if jobs[msg_id] is None:
+                        continue
+                    if msg_id in labelled:
+                        advance_job(jobs[msg_id], 'labelled')
+                    else:
+                        failed.append(jobs[msg_id])
+    if failed and work_queue is not None:
+        print(f"{len(failed)} emails could not be labelled. Retrying them next cycle.")
+        work_queue.requeue(failed)
 
 
 # --- Updated Processing Loop ---
-def process_email_batch(service, config, label_ids, state):
+def plan_action(intent):
+    """Maps an intent to the action taken and the label/stat key."""
+    match intent:
+        case "question":
+            action_taken, label_key = "Replied", 'replied'
+        case "escalation_request":
+            action_taken, label_key = "Escalated", 'escalated'
+        case "follow_up" | "other":
+            action_taken, label_key = "Ignored", 'ignored'
+        case _:
+            print(f"Action: Unknown intent '{intent}'. Defaulting to ignore.")
+            return "Ignored", 'ignored'
+    print(f"Action: {action_taken}")
+    return action_taken, label_key
+
+def reply_already_sent(email, thread_messages):
+    """True if the mailbox already answered this email, e.g. before a crash."""
+    message_ids = [msg['id'] for msg in thread_messages]
+    if email['id'] not in message_ids:
+        return False
+    return any(msg['role'] == 'assistant' for msg in thread_messages[message_ids.index(email['id']) + 1:])
+
+def messages_up_to(email, thread_messages):
+    """The thread as it was when this email arrived."""
+    message_ids = [msg['id'] for msg in thread_messages]
+    return thread_messages[:message_ids.index(email['id']) + 1] if email['id'] in message_ids else thread_messages
+
+def deliver_action(service, email, job, config, full_text=None):
+    """Sends the reply or escalation a classified job calls for. Returns False if a send failed."""
+    if job['action'] == "Replied":
+        return send_email(service, email['from'], email['subject'], job['reply_text'], email['threadId'])
+    if job['action'] == "Escalated":
+        if full_text is None:
+            _, full_text = fetch_thread_history(service, email['threadId'])
+        if not forward_email_to_support(service, email['from'], email['subject'], full_text, config):
+            return False
+        confirm_text = "Your request has been escalated to our human support team."
+        return send_email(service, email['from'], email['subject'], confirm_text, email['threadId'])
+    return True
+
+def claim_job(email):
+    """Returns the email's progress record, creating one if the bot has not seen it before."""
+    if work_queue is None:
+        return {"message_id": email['id'], "state": "fetched"}
+    return work_queue.claim(email)
+
+def advance_job(job, new_state, **fields):
+    """Records that an email reached new_state."""
+    if work_queue is None:
+        return {**job, **fields, "state": new_state}
+    return work_queue.advance(job, new_state, **fields)
+
+def record_failed_attempt(email, config):
+    """
+    Counts an attempt that left the email for a later cycle. Returns True while it will be tried again,
+    and False once it failed max_email_attempts times and was set aside in the 'failed' state.
+    """
+    job = work_queue.get(email['id']) if work_queue is not None else None
+    if job is None:
+        return True
+    job = work_queue.record_attempt(job, config['settings']['max_email_attempts'])
+    if job['state'] != 'failed':
+        return True
+    print(f"Email {email['id']} failed {job['attempts']} times. Setting it aside for a human; it stays unread.")
+    record_stage_error('email')
+    return False
+
+def process_email(service, email, config, label_ids, state, gmail_slot=nullcontext(), openai_slot=nullcontext()):
+    """
+    Classifies and handles a single email, resuming from its recorded state after a restart.
+    The slots bound how many Gmail/OpenAI calls run at once.
+    Returns True once the email is handled, or None if it was left for a later cycle.
+    """
+    job = claim_job(email)
+    if job['state'] == 'labelled':
+        print(f"Email {email['id']} was already handled. Re-applying its label.")
+        with gmail_slot:
+            label_email(service, email['id'], label_ids, job['label_key'])
+        return True
+    if job['state'] == 'failed':
+        print(f"Email {email['id']} was set aside after {job['attempts']} failed attempts. Skipping it.")
+        return True
+
+    full_text = already_sent = None
+    if job['state'] == 'fetched':
+        increment_stat(state, 'processed')
+        print(f"\nProcessing email from: {email['from']} | Subject: {email['subject']}")
+        
+        with gmail_slot, stage_span('thread_fetch'):
+            thread_messages = fetch_thread_messages_or_empty(service, email['threadId'])
+        already_sent = reply_already_sent(email, thread_messages)
+        if already_sent:
+            # Classify what the customer wrote, not the reply we sent before a restart
+            thread_messages = messages_up_to(email, thread_messages)
+        conversation_history, full_text = build_conversation(thread_messages)
+        if not conversation_history:
+            print("Could not fetch conversation history. Skipping.")
+            return
+
+        reply_text = None
+        with openai_slot, stage_span('intent'):
+            if config['settings']['llm_call_mode'] == 'combined' and not already_sent:
+                intent, reply_text = determine_intent_and_reply(email['subject'], conversation_history, config, email['threadId'],
+                                                                email.get('automated'))
+            else:
+                intent = determine_user_intent(conversation_history[-1]['content'], config, email.get('automated'))
+        if intent is None:
+            print("Could not determine intent. Leaving the email for a later cycle.")
+            return
+        action_taken, label_key = plan_action(intent)
+
+        if action_taken == "Replied" and not already_sent and reply_text is None:
+            with openai_slot, stage_span('reply'):
+                reply_text = generate_ai_reply(email['subject'], conversation_history, config, email['threadId'])
+        job = advance_job(job, 'classified', intent=intent, action=action_taken, label_key=label_key, reply_text=reply_text)
+    else:
+        print(f"\nResuming email {email['id']} from state '{job['state']}'.")
+
+    if job['state'] == 'classified':
+        with gmail_slot:
+            if already_sent is None and job['action'] != "Ignored":
+                with stage_span('thread_fetch'):
+                    thread_messages = fetch_thread_messages_or_empty(service, email['threadId'])
+                if not thread_messages:
+                    print("Could not check the thread for an earlier reply. Leaving the email for the next run.")
+                    return
+                already_sent = reply_already_sent(email, thread_messages)
+            if already_sent:
+                print("A reply to this email was already sent. Not sending again.")
+            elif job['action'] != "Ignored":
+                with stage_span('send'):
+                    sent = deliver_action(service, email, job, config, full_text)
+                if not sent:
+                    print("Sending failed. Leaving the email for a later cycle.")
+                    return
+        increment_stat(state, job['label_key'])
+        job = advance_job(job, 'replied')
+
+    with gmail_slot:
+        label_email(service, email['id'], label_ids, job['label_key'], job)
+
+    log_activity(state, email['from'], job['intent'].capitalize(), job['action'])
+    print(f"--- Finished processing email {email['id']} ---")
+    return True
+
+class ConcurrentEmailProcessor:
+    """Processes emails on a bounded worker pool. Emails from the same thread run in order on one worker."""
+
+    def __init__(self, service_factory, settings):
+        # googleapiclient services are not thread-safe, so every worker builds its own
+        self.service_factory = service_factory
+        self.pool = ThreadPoolExecutor(max_workers=settings['worker_count'], thread_name_prefix="email-worker")
+        self.gmail_slots = threading.BoundedSemaphore(settings['max_concurrent_gmail_calls'])
+        self.openai_slots = threading.BoundedSemaphore(settings['max_concurrent_openai_calls'])
+        self._local = threading.local()
+
+    def _get_service(self):
+        if not hasattr(self._local, 'service'):
+            self._local.service = self.service_factory()
+        return self._local.service
+
+    def _process_thread(self, emails, config, label_ids, state):
+        service = self._get_service()
+        deferred = 0
+        for email in emails:
+            try:
+                with stage_span('email'):
+                    handled = process_email(service, email, config, label_ids, state, self.gmail_slots, self.openai_slots)
+            except Exception as e:
+                print(f"An error occurred processing email {email['id']}: {e}")
+                handled = False
+            if not handled and record_failed_attempt(email, config):
+                deferred += 1
+        return deferred
+
+    def run(self, emails, config, label_ids, state):
+        """Processes a batch of emails and waits for all of them to finish. Returns how many were left for later."""
+        threads = {}
+        for email in emails:
+            threads.setdefault(email['threadId'], []).append(email)
+        futures = [self.pool.submit(self._process_thread, thread_emails, config, label_ids, state) for thread_emails in threads.values()]
+        wait(futures)
+        return sum(future.result() for future in futures)
+
+    def shutdown(self):
+        self.pool.shutdown(wait=True)
+
+def process_email_batch(service, config, label_ids, state, sync_state=None, processor=None):
     """Fetches and processes one batch of unread emails."""
     print("\nStarting Smart Agent Brain... Checking for new messages.")
-    unread_emails = fetch_unread_emails(service, config['labels'])
+    cycle_started = time.perf_counter()
+    refresh_knowledge_base(config)
+    with stage_span('fetch'):
+        unread_emails, checkpoint = fetch_new_emails(service, config, label_ids, sync_state)
+    unread_emails = merge_resumable_emails(unread_emails)
     
     if not unread_emails:
         print("No new emails found.")
+        commit_sync_checkpoint(config, sync_state, checkpoint)
+        maintain_work_queue(config)
+        publish_metrics(state, 0, cycle_started)
         return
 
     print(f"\n--- Found {len(unread_emails)} new emails ---")
-    for email in unread_emails:
-        increment_stat(state, 'processed')
-        print(f"\nProcessing email from: {email['from']} | Subject: {email['subject']}")
-        
-        conversation_history, full_text = fetch_thread_history(service, email['threadId'])
-        if not conversation_history:
-            print("Could not fetch conversation history. Skipping.")
-            continue
-
-        last_message = conversation_history[-1]['content']
-        intent = determine_user_intent(last_message, config)
-
-        label_to_apply = None
-        action_taken = "Unknown"
-
-        match intent:
-            case "question":
-                action_taken = "Replied"
-                print(f"Action: {action_taken}")
-                reply_text = generate_ai_reply(email['subject'], conversation_history, config)
-                send_email(service, email['from'], email['subject'], reply_text, email['threadId'])
-                label_to_apply = label_ids['replied']
-                increment_stat(state, 'replied')
-            
-            case "escalation_request":
-                action_taken = "Escalated"
-                print(f"Action: {action_taken}")
-                forward_email_to_support(service, email['from'], email['subject'], full_text, config)
-                confirm_text = "Your request has been escalated to our human support team."
-                send_email(service, email['from'], email['subject'], confirm_text, email['threadId'])
-                label_to_apply = label_ids['escalated']
-                increment_stat(state, 'escalated')
-
-            case "follow_up" | "other":
-                action_taken = "Ignored"
-                print(f"Action: {action_taken}")
-                label_to_apply = label_ids['ignored']
-                increment_stat(state, 'ignored')
-            
-            case _:
-                action_taken = "Ignored"
-                print(f"Action: Unknown intent '{intent}'. Defaulting to ignore.")
-                label_to_apply = label_ids['ignored']
-                increment_stat(state, 'ignored')
-
-        if label_to_apply:
-            modify_message(service, email['id'], label_to_apply)
-        
-        log_activity(state, email['from'], intent.capitalize(), action_taken)
-        print(f"--- Finished processing email {email['id']} ---")
+    if processor is None:
+        deferred = 0
+        for email in unread_emails:
+            with stage_span('email'):
+                handled = process_email(service, email, config, label_ids, state)
+            if not handled and record_failed_attempt(email, config):
+                deferred += 1
+    else:
+        deferred = processor.run(unread_emails, config, label_ids, state)
+    flush_label_updates(service, config, label_ids)
+
+    # Only advance the checkpoint past emails that were handled
+    commit_sync_checkpoint(config, sync_state, checkpoint, deferred)
+    maintain_work_queue(config)
+    publish_cache_stats(state)
+    publish_rate_limit_stats(state)
+    publish_context_stats(state)
+    publish_metrics(state, len(unread_emails), cycle_started)
+    persist_caches()
+
+def merge_resumable_emails(emails):
+    """Adds emails a crashed run or an earlier cycle left half-processed, ahead of the new ones."""
+    if work_queue is None:
+        return emails
+    resumable = work_queue.take_resumable()
+    if resumable:
+        print(f"Resuming {len(resumable)} unfinished emails.")
+    seen = {email['id'] for email in resumable}
+    return resumable + [email for email in emails if email['id'] not in seen]
+
+def maintain_work_queue(config):
+    """Commits buffered work-queue transitions and hourly drops jobs past the retention window."""
+    global work_queue_pruned_at
+    if work_queue is None:
+        return
+    work_queue.flush()
+    if time.time() - work_queue_pruned_at >= 3600:
+        work_queue_pruned_at = time.time()
+        work_queue.prune(config['settings']['work_queue_retention_days'] * 86400)
+
+def publish_cache_stats(state):
+    """Copies cache hit/miss counters into the shared state for the dashboard."""
+    if thread_cache is None:
+        return
+    cache_stats = {"thread": thread_cache.stats()}
+    if reply_cache is not None:
+        cache_stats["reply"] = reply_cache.stats()
+    state.publish('cache_stats', cache_stats)
+
+def publish_rate_limit_stats(state):
+    """Copies throttle and retry counters into the shared state for the dashboard."""
+    if rate_limiter is None:
+        return
+    state.publish('rate_limits', rate_limiter.stats())
+
+def publish_context_stats(state):
+    """Copies prompt-token and summary counters into the shared state for the dashboard."""
+    if context_stats is None:
+        return
+    state.publish('context_stats', {**context_stats.stats(), "summary_cache": summary_cache.stats()})
+
+def publish_metrics(state, batch_size, cycle_started):
+    """Records the cycle's duration and backlog, then copies the stage metrics into the shared state."""
+    if stage_metrics is None:
+        return
+    stage_metrics.observe('cycle', time.perf_counter() - cycle_started)
+    stage_metrics.set_queue(batch_size, work_queue.count_unfinished() if work_queue is not None else 0)
+    state.publish('metrics', stage_metrics.snapshot())
+
+def persist_caches():
+    """Saves caches that must survive a restart."""
+    if reply_cache is not None:
+        reply_cache.save()
+    if summary_cache is not None:
+        summary_cache.save()
+
+def commit_sync_checkpoint(config, sync_state, checkpoint, deferred=0):
+    """
+    Stores a new sync checkpoint in memory and on disk. If `deferred` emails of the batch were left
+    for a later cycle, the stored historyId is kept so the next incremental sync fetches them again.
+    Emails set aside after max_email_attempts no longer count, so the historyId then moves on.
+    """
+    if sync_state is None or checkpoint is None:
+        return
+    if deferred:
+        checkpoint = checkpoint_keeping_history_id(sync_state, checkpoint)
+        if checkpoint is None:
+            return
+        print(f"{deferred} emails were left for a later cycle. Keeping historyId {checkpoint['historyId']}.")
+    sync_state.clear()
+    sync_state.update(checkpoint)
+    save_sync_checkpoint(config['settings']['sync_checkpoint_file'], sync_state)
+
+def create_reply_cache(config):
+    """Builds the reply cache, with an embedding tier if an embedding model is configured."""
+    settings = config['settings']
+    embedder = None
+    if settings['reply_cache_embedding_model']:
+        embedder = lambda text: call_openai(get_openai_client().embeddings.create, model=settings['reply_cache_embedding_model'], input=text).data[0].embedding
+    return ReplyCache(settings['reply_cache_file'], settings['reply_cache_max_entries'], settings['reply_cache_ttl_seconds'],
+                      settings['reply_cache_max_distance'], embedder, settings['reply_cache_min_similarity'])
+
+def knowledge_base_embedder(config):
+    """
+    Returns a function embedding a list of texts with the configured model in one request,
+    or None if embeddings are off.
+    """
+    model = config['settings']['knowledge_base_embedding_model']
+    if not model:
+        return None
+
+    def embed(texts):
+        response = call_openai(get_openai_client().embeddings.create, model=model, input=texts)
+        return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+    return embed
+
+def refresh_knowledge_base(config, force=False):
+    """Re-indexes changed knowledge-base documents every knowledge_base_reindex_seconds."""
+    global knowledge_index, knowledge_index_checked_at, reply_cache_version
+    settings = config['settings']
+    if not settings['knowledge_base_dir']:
+        return
+    if not force and time.time() - knowledge_index_checked_at < settings['knowledge_base_reindex_seconds']:
+        return
+    knowledge_index_checked_at = time.time()
+
+    # Imported here so that mailboxes without a knowledge_base_dir never load numpy for it
+    from knowledge_base import KnowledgeBaseIndex
+    index = knowledge_index or KnowledgeBaseIndex.load(settings['knowledge_base_index_file'], settings['knowledge_base_chunk_words'])
+    added, updated, removed = index.update_from_directory(settings['knowledge_base_dir'])
+    embedded = 0
+    embedder = knowledge_base_embedder(config)
+    if embedder:
+        try:
+            embedded = index.attach_embeddings(embedder, f"{settings['knowledge_base_index_file']}.embeddings.npy")
+        except Exception as e:
+            # An embeddings outage must not stop the mailbox. Chunks left without a vector are embedded on the next re-index.
+            print(f"Error embedding the knowledge base: {e}. Using keyword search until the next re-index.")
+            index.detach_embeddings()
+    # The index records which matrix rows hold which chunks, so a re-embed alone must be saved too,
+    # or chunks embedded after an earlier failure would be embedded again on every restart
+    if added or updated or removed or embedded:
+        index.save(settings['knowledge_base_index_file'])
+        print(f"Knowledge base re-indexed: {added} added, {updated} updated, {removed} removed, {embedded} embedded "
+              f"({len(index.chunks)} chunks).")
+    # Emails are processed between refreshes, so swapping the module globals here is safe
+    knowledge_index = index
+    reply_cache_version = knowledge_base_version(config)
 
 # --- Updated Main Function ---
-def main(state, log_queue):
+def setup_mailbox(config, service_factory, shared_buckets=None):
     """
-    Main function to run the bot, now controlled by the API.
+    Configures the clients, caches and labels of the current mailbox context.
+    shared_buckets replaces rate limiter buckets with ones other processes draw on too.
+    Returns (service, label_ids, sync_state).
     """
-    state['bot_status'] = 'Running'
-    config = load_config()
-    service = get_gmail_service()
+    global thread_cache, intent_classifier, reply_cache, reply_cache_version, work_queue, rate_limiter
+    global mime_part_max_bytes, thread_text_max_bytes, token_counter, summary_cache, context_stats, label_updates, stage_metrics
+    settings = config['settings']
+    mime_part_max_bytes = settings['mime_part_max_bytes']
+    thread_text_max_bytes = settings['thread_text_max_bytes']
+    rate_limiter = RateLimiter.from_settings(settings)
+    if shared_buckets:
+        rate_limiter.share_buckets(shared_buckets)
+    if client is None:
+        check_openai_api_key()
+    service = service_factory()
+    print(f"Authenticated as {get_my_email(service)}.")
+    thread_cache = ThreadCache(settings['thread_cache_max_threads'], settings['thread_cache_max_mb'] * 1024 * 1024)
+    intent_classifier = LocalIntentClassifier(settings['intent_model_file'], settings['intent_history_file'],
+                                              settings['intent_history_max_examples'])
+    reply_cache = create_reply_cache(config)
+    reply_cache_version = knowledge_base_version(config)
+    token_counter = TokenCounter.for_model(settings['openai_model'])
+    summary_cache = SummaryCache(settings['summary_cache_file'], settings['summary_cache_max_threads'])
+    context_stats = ContextStats()
+    work_queue = WorkQueue(settings['work_queue_file'], settings['work_queue_commit_batch_size'])
+    label_updates = LabelUpdateQueue()
+    stage_metrics = StageMetrics()
+    refresh_knowledge_base(config, force=True)
     
     print("Setting up Gmail labels...")
-    label_ids = {
-        "replied": get_or_create_label_id(service, config['labels']['replied']),
-        "escalated": get_or_create_label_id(service, config['labels']['escalated']),
-        "ignored": get_or_create_label_id(service, config['labels']['ignored'])
-    }
+    label_ids = resolve_label_ids(service, config)
     print("Label setup complete. Bot is now polling for emails...")
+    return service, label_ids, load_sync_checkpoint(settings['sync_checkpoint_file'])
+
+def shutdown_mailbox(processor=None):
+    """Releases the current mailbox context's workers and saves what must survive a restart."""
+    if processor:
+        processor.shutdown()
+    persist_caches()
+    if work_queue is not None:
+        work_queue.close()
+
+def main(state, log_queue, stop_event=None):
+    """
+    Main function to run the bot, now controlled by the API.
+    state is the Telemetry channel the API reads for the dashboard.
+    The bot finishes its current cycle and exits once stop_event is set.
+    """
+    state.publish('bot_status', 'Running')
+    config = load_config()
+    creds = get_gmail_credentials()
+    stop_event = stop_event or threading.Event()
+    service, label_ids, sync_state = setup_mailbox(config, lambda: get_gmail_service(creds))
     
-    # Initialize stats in shared state
-    state['stats'] = {"processed": 0, "replied": 0, "escalated": 0, "ignored": 0}
+    # Start each run's stats from zero
+    state.reset_counters()
 
     interval = config['settings']['polling_interval_seconds']
-    
+    if config['settings']['push_topic_name']:
+        # Notifications are delivered through the API's webhook to the mailbox supervisor only
+        print(f"Push notifications need the mailbox supervisor (api.py). Ignoring push_topic_name and polling every {interval} seconds.")
+
+    processor = None
     try:
-        while True:
-            process_email_batch(service, config, label_ids, state)
-            print(f"Cycle complete. Sleeping for {interval} seconds.")
-            time.sleep(interval)
+        if config['settings']['engine'] == 'asyncio':
+            import asyncio
+            from async_engine import run_async_bot
+            print("Using the asyncio engine.")
+            asyncio.run(run_async_bot(lambda: get_gmail_service(creds), config, label_ids, state, sync_state, stop_event))
+        else:
+            if config['settings']['worker_count'] > 1:
+                processor = ConcurrentEmailProcessor(lambda: get_gmail_service(creds), config['settings'])
+            while not stop_event.is_set():
+                process_email_batch(service, config, label_ids, state, sync_state, processor)
+                print(f"Cycle complete. Sleeping for {interval} seconds.")
+                stop_event.wait(interval)
+        print("\nStop requested. Bot process is shutting down.")
             
     except (KeyboardInterrupt, SystemExit):
         print("\nShutdown signal received in bot process.")
     except Exception as e:
         print(f"\nAn unexpected error occurred in the bot loop: {e}")
-        state['bot_status'] = 'Error'
+        state.publish('bot_status', 'Error')
     finally:
-        state['bot_status'] = 'Offline'
+        shutdown_mailbox(processor)
+        state.publish('bot_status', 'Offline')
         print("Bot polling has stopped.")
 
 if __name__ == "__main__":
@@ -385,32 +1409,9 @@ if __name__ == "__main__":
     # but it won't be connected to the API's shared state.
     print("Running bot in standalone mode. API control will not be available.")
     
-    # Create dummy state and queue objects for standalone mode
-    class DummyState:
-        def __init__(self):
-            self._dict = {
-                "activity_log": [], 
-                "stats": {"processed": 0, "replied": 0, "escalated": 0, "ignored": 0}
-            }
-        def __getitem__(self, key):
-            return self._dict.get(key)
-        def __setitem__(self, key, value):
-            self._dict[key] = value
-        def get(self, key, default=None):
-            return self._dict.get(key, default)
-        def insert(self, index, value): # Dummy for activity_log
-            self._dict["activity_log"].insert(index, value)
-
+    # Create dummy queue object for standalone mode
     class DummyQueue:
         def put(self, item):
             print(f"DUMMY LOG: {item}")
-            
-    # Need a manager for the list proxy
-    from multiprocessing import Manager
-    manager = Manager()
-    dummy_state = manager.dict()
-    dummy_state['activity_log'] = manager.list()
-    dummy_state['stats'] = manager.dict({"processed": 0, "replied": 0, "escalated": 0, "ignored": 0})
-
 
-    main(dummy_state, DummyQueue())
\ No newline at end of file
+    main(Telemetry(), DummyQueue())
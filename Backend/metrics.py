@@ -0,0 +1,219 @@
+"""
+Per-stage latency histograms, error counts and usage counters for a mailbox.
+
+main.stage_span() times each stage of a polling cycle:
+  - fetch: listing new emails and fetching their metadata;
+  - thread_fetch: downloading and parsing a thread;
+  - intent: classifying the latest message. In combined mode this also
+    drafts the reply;
+  - reply: generating a reply;
+  - send: sending a reply, escalation or confirmation;
+  - label: applying the cycle's label updates;
+  - email: one email from claim to finish;
+  - cycle: the whole process_email_batch().
+Durations go into fixed buckets (LATENCY_BUCKETS, in seconds), the layout a
+Prometheus histogram uses. A span costs two perf_counter() calls, a bisect and
+a few updates under a lock, about a microsecond. Errors are counted per stage
+where the bot reports them, and for any exception that escapes a span.
+
+The bot publishes snapshot() to its Telemetry channel once per cycle. The API
+merges the mailboxes' snapshots. summarize() turns them into percentiles for
+the dashboard, and render_prometheus() serves them on /metrics. Percentiles are
+interpolated within a bucket, as in Prometheus' histogram_quantile().
+"""
+import threading
+import time
+from bisect import bisect_left
+
+STAGES = ("cycle", "fetch", "thread_fetch", "intent", "reply", "send", "label", "email")
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+PERCENTILES = (0.5, 0.9, 0.99)
+HANDLED_COUNTERS = ("replied", "escalated", "ignored")
+
+
+class Span:
+    """Times one stage. An exception leaving the block counts as an error of that stage."""
+    __slots__ = ("_metrics", "_stage", "_start")
+
+    def __init__(self, metrics, stage):
+        self._metrics = metrics
+        self._stage = stage
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._metrics.observe(self._stage, time.perf_counter() - self._start, exc_type is not None)
+        return False
+
+
+class _NullSpan:
+    """Stands in for a Span when the mailbox has no StageMetrics."""
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+NULL_SPAN = _NullSpan()
+
+
+class StageMetrics:
+    """Thread-safe histograms and counters for one mailbox."""
+
+    def __init__(self):
+        self._counts = {stage: [0] * (len(LATENCY_BUCKETS) + 1) for stage in STAGES}
+        self._sums = dict.fromkeys(STAGES, 0.0)
+        self._errors = dict.fromkeys(STAGES, 0)
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.batch_size = 0
+        self.queue_depth = 0
+        self._lock = threading.Lock()
+
+    def span(self, stage):
+        return Span(self, stage)
+
+    def observe(self, stage, seconds, failed=False):
+        # Bucket i holds durations up to LATENCY_BUCKETS[i]; the last one is +Inf
+        index = bisect_left(LATENCY_BUCKETS, seconds)
+        with self._lock:
+            self._counts[stage][index] += 1
+            self._sums[stage] += seconds
+            if failed:
+                self._errors[stage] += 1
+
+    def error(self, stage):
+        with self._lock:
+            self._errors[stage] += 1
+
+    def record_tokens(self, usage):
+        """Adds the token usage of an OpenAI response. Embedding responses have no completion tokens."""
+        with self._lock:
+            self.prompt_tokens += getattr(usage, 'prompt_tokens', 0) or 0
+            self.completion_tokens += getattr(usage, 'completion_tokens', 0) or 0
+
+    def set_queue(self, batch_size, queue_depth):
+        """Records the size of the last batch and how many emails are still unfinished after it."""
+        with self._lock:
+            self.batch_size = batch_size
+            self.queue_depth = queue_depth
+
+    def snapshot(self):
+        """Returns a JSON-serializable copy for Telemetry.publish()."""
+        with self._lock:
+            return {
+                "stages": {stage: {"counts": list(self._counts[stage]), "sum": round(self._sums[stage], 6), "errors": self._errors[stage]}
+                           for stage in STAGES},
+                "tokens": {"prompt": self.prompt_tokens, "completion": self.completion_tokens},
+                "batch_size": self.batch_size,
+                "queue_depth": self.queue_depth,
+            }
+
+
+def merge_snapshots(snapshots):
+    """Adds up the snapshots of several mailboxes. Gauges are summed too: the total backlog across mailboxes."""
+    merged = StageMetrics().snapshot()
+    for snapshot in snapshots:
+        for stage, data in snapshot.get('stages', {}).items():
+            total = merged['stages'].get(stage)
+            if total is None or len(data['counts']) != len(total['counts']):
+                continue  # Published by a bot with other stages or buckets
+            total['counts'] = [a + b for a, b in zip(total['counts'], data['counts'])]
+            total['sum'] = round(total['sum'] + data['sum'], 6)
+            total['errors'] += data['errors']
+        for key in ('prompt', 'completion'):
+            merged['tokens'][key] += snapshot.get('tokens', {}).get(key, 0)
+        merged['batch_size'] += snapshot.get('batch_size', 0)
+        merged['queue_depth'] += snapshot.get('queue_depth', 0)
+    return merged
+
+
+def quantile(q, counts):
+    """Estimates the q-quantile in seconds from bucket counts, or None without observations."""
+    total = sum(counts)
+    if not total:
+        return None
+    rank = q * total
+    seen = 0
+    for index, count in enumerate(counts):
+        if count and seen + count >= rank:
+            if index == len(LATENCY_BUCKETS):
+                return LATENCY_BUCKETS[-1]  # Beyond the last bound; report the bound
+            lower = LATENCY_BUCKETS[index - 1] if index else 0.0
+            return lower + (LATENCY_BUCKETS[index] - lower) * (rank - seen) / count
+        seen += count
+    return LATENCY_BUCKETS[-1]
+
+
+def summarize(snapshot):
+    """Dashboard view of a snapshot: count, errors, mean and percentiles in milliseconds per stage that ran."""
+    stages = {}
+    for stage, data in snapshot.get('stages', {}).items():
+        count = sum(data['counts'])
+        if not count:
+            continue
+        summary = {"count": count, "errors": data['errors'], "avg_ms": round(data['sum'] / count * 1000, 1)}
+        for q in PERCENTILES:
+            summary[f"p{round(q * 100)}_ms"] = round(quantile(q, data['counts']) * 1000, 1)
+        stages[stage] = summary
+    return {
+        "stages": stages,
+        "tokens": snapshot.get('tokens', {"prompt": 0, "completion": 0}),
+        "batch_size": snapshot.get('batch_size', 0),
+        "queue_depth": snapshot.get('queue_depth', 0),
+    }
+
+
+def _label_value(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _metric(lines, name, metric_type, help_text, samples):
+    lines.append(f"# HELP {name} {help_text}")
+    lines.append(f"# TYPE {name} {metric_type}")
+    for suffix, labels, value in samples:
+        label_text = ",".join(f'{key}="{_label_value(label)}"' for key, label in labels.items())
+        lines.append(f"{name}{suffix}{{{label_text}}} {value}")
+
+
+def render_prometheus(mailboxes):
+    """
+    Renders the Prometheus text exposition format (version 0.0.4) for a list of
+    supervisor.mailbox_data() dicts, each with a "metrics" snapshot.
+    """
+    lines = []
+    _metric(lines, "emailbot_up", "gauge", "1 if the mailbox's bot is running.",
+            [("", {"mailbox": m['mailbox']}, int(m['bot_status'] == 'Running')) for m in mailboxes])
+    _metric(lines, "emailbot_emails_processed_total", "counter", "Emails the bot started processing.",
+            [("", {"mailbox": m['mailbox']}, m['stats']['processed']) for m in mailboxes])
+    _metric(lines, "emailbot_emails_handled_total", "counter", "Emails handled, by action.",
+            [("", {"mailbox": m['mailbox'], "action": key}, m['stats'][key]) for m in mailboxes for key in HANDLED_COUNTERS])
+
+    with_metrics = [m for m in mailboxes if m.get('metrics')]
+    samples = []
+    for m in with_metrics:
+        for stage, data in m['metrics']['stages'].items():
+            labels = {"mailbox": m['mailbox'], "stage": stage}
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS + ("+Inf",), data['counts']):
+                cumulative += count
+                samples.append(("_bucket", {**labels, "le": bound}, cumulative))
+            samples.append(("_sum", labels, data['sum']))
+            samples.append(("_count", labels, cumulative))
+    _metric(lines, "emailbot_stage_duration_seconds", "histogram", "Time spent in each stage of email processing.", samples)
+    _metric(lines, "emailbot_stage_errors_total", "counter", "Errors reported by each stage of email processing.",
+            [("", {"mailbox": m['mailbox'], "stage": stage}, data['errors'])
+             for m in with_metrics for stage, data in m['metrics']['stages'].items()])
+    _metric(lines, "emailbot_openai_tokens_total", "counter", "OpenAI tokens used, by type.",
+            [("", {"mailbox": m['mailbox'], "type": key}, m['metrics']['tokens'][key])
+             for m in with_metrics for key in ('prompt', 'completion')])
+    _metric(lines, "emailbot_last_batch_size", "gauge", "Emails in the mailbox's last polling cycle.",
+            [("", {"mailbox": m['mailbox']}, m['metrics']['batch_size']) for m in with_metrics])
+    _metric(lines, "emailbot_queue_depth", "gauge", "Emails left unfinished after the last cycle, to be resumed by the next.",
+            [("", {"mailbox": m['mailbox']}, m['metrics']['queue_depth']) for m in with_metrics])
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,156 @@
+"""
+Bounded text extraction from Gmail message payloads.
+
+Gmail returns a message as a tree of MIME parts whose bodies are base64url
+strings. iter_text_parts() walks that tree lazily, at any depth (forwarded
+messages nest whole multiparts). It yields only the readable parts: from a
+multipart/alternative it takes text/plain over text/html, and it skips
+attachments. extract_text() then decodes each part with two limits:
+max_part_bytes per part and max_total_bytes per call. Only the base64 prefix
+that covers the limit is decoded, so a 10 MB HTML body costs no more than a
+small one. Charsets come from the part's Content-Type, and an
+unknown or broken charset degrades to replacement characters instead of an
+exception.
+
+strip_quoted_reply() removes the quoted history that mail clients append to
+replies. The bot already has the earlier messages of the thread, so the
+quotes would only repeat them to the LLM. An "On ... wrote:" line only counts
+as an attribution when it ends the line, names a date or an address and is
+followed by quoted lines, so a customer's own sentence is never cut.
+"""
+import base64
+import binascii
+import codecs
+import re
+from html.parser import HTMLParser
+
+_CHARSET = re.compile(r'charset\s*=\s*"?([^";\s]+)', re.IGNORECASE)
+_BLOCK_TAGS = {"p", "div", "br", "li", "tr", "table", "ul", "ol", "blockquote", "pre",
+               "h1", "h2", "h3", "h4", "h5", "h6", "hr"}
+_SKIPPED_TAGS = {"script", "style", "head", "title"}
+_REPLY_HEADER = re.compile(
+    r"^(?:-{2,}\s*Original Message\s*-{2,}"                  # Outlook
+    r"|From:\s[^\n]+\n(?:[^\n]+\n)?Sent:\s)",             # Outlook without the divider
+    re.MULTILINE | re.IGNORECASE)
+# Gmail and Apple Mail: "On <date>, <name> <address> wrote:" ending its line (it may wrap once)
+# and followed by >-quoted lines. Customers write "On ... wrote:" in their own sentences too.
+_ATTRIBUTION = re.compile(r"^On\s[^\n]{0,200}(?:\n[^\n]{0,200})?\swrote:[ \t]*\n(?:[ \t]*\n)*[ \t]*>",
+                          re.MULTILINE | re.IGNORECASE)
+# An attribution names the sender's <address> or the date: a year, a time or a numeric date
+_ATTRIBUTION_DETAIL = re.compile(r"<[^<>\s]+@[^<>\s]+>|\b(?:19|20)\d{2}\b|\b\d{1,2}:\d{2}\b|\b\d{1,2}[/.-]\d{1,2}[/.-]\d{2,4}\b")
+_BLANK_LINES = re.compile(r"\n\s*\n\s*\n+")
+
+
+def _header(part, name):
+    return next((h['value'] for h in part.get('headers', []) if h['name'].lower() == name), '')
+
+
+def _is_attachment(part):
+    return bool(part.get('filename')) or _header(part, 'content-disposition').lower().startswith('attachment')
+
+
+def _preferred_alternative(parts):
+    for mime_type in ('text/plain', 'text/html'):
+        for part in parts:
+            if part.get('mimeType') == mime_type and not _is_attachment(part):
+                return part
+    # Neither flavour at the top level, e.g. multipart/related holding the HTML
+    return next((part for part in reversed(parts) if part.get('parts')), None)
+
+
+def iter_text_parts(payload):
+    """Yields the text/plain and text/html parts of a payload in reading order."""
+    stack = [payload]
+    while stack:
+        part = stack.pop()
+        children = part.get('parts')
+        if children:
+            if part.get('mimeType') == 'multipart/alternative':
+                children = [child for child in [_preferred_alternative(children)] if child is not None]
+            stack.extend(reversed(children))
+        elif part.get('mimeType', 'text/plain') in ('text/plain', 'text/html') and not _is_attachment(part):
+            yield part
+
+
+def decode_part(part, max_bytes):
+    """Returns (text, decoded byte count) for at most max_bytes of a part's body."""
+    data = (part.get('body') or {}).get('data')
+    if not data or max_bytes <= 0:
+        return "", 0
+    # Every 4 base64 characters hold 3 bytes, so decode just the prefix that covers max_bytes
+    prefix = data[:(max_bytes + 2) // 3 * 4]
+    try:
+        raw = base64.urlsafe_b64decode(prefix + "=" * (-len(prefix) % 4))[:max_bytes]
+    except (binascii.Error, ValueError):
+        return "", 0
+    match = _CHARSET.search(_header(part, 'content-type'))
+    charset = match.group(1) if match else 'utf-8'
+    try:
+        codecs.lookup(charset)
+    except LookupError:
+        charset = 'utf-8'
+    return raw.decode(charset, errors='replace'), len(raw)
+
+
+class _HTMLTextExtractor(HTMLParser):
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.pieces = []
+        self._skipping = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in _SKIPPED_TAGS:
+            self._skipping += 1
+        elif tag in _BLOCK_TAGS:
+            self.pieces.append("\n")
+
+    def handle_endtag(self, tag):
+        if tag in _SKIPPED_TAGS:
+            self._skipping = max(0, self._skipping - 1)
+        elif tag in _BLOCK_TAGS:
+            self.pieces.append("\n")
+
+    def handle_data(self, data):
+        if not self._skipping:
+            self.pieces.append(data)
+
+
+def html_to_text(html):
+    """Converts an HTML body to plain text, dropping scripts and styles and keeping block breaks."""
+    if html.rfind("<") > html.rfind(">"):
+        html = html[:html.rfind("<")]  # A tag cut off by the byte limit
+    extractor = _HTMLTextExtractor()
+    extractor.feed(html)
+    extractor.close()
+    lines = (" ".join(line.split()) for line in "".join(extractor.pieces).splitlines())
+    return _BLANK_LINES.sub("\n\n", "\n".join(lines)).strip()
+
+
+def strip_quoted_reply(text):
+    """Removes the quoted earlier messages from a reply. Returns text unchanged if nothing else is left."""
+    starts = [match.start() for match in _ATTRIBUTION.finditer(text) if _ATTRIBUTION_DETAIL.search(match.group())][:1]
+    match = _REPLY_HEADER.search(text)
+    if match:
+        starts.append(match.start())
+    own_text = text[:min(starts)] if starts else text
+    own_text = "\n".join(line for line in own_text.splitlines() if not line.lstrip().startswith(">")).strip()
+    return own_text or text.strip()
+
+
+def extract_text(payload, max_part_bytes, max_total_bytes):
+    """
+    Returns (text, decoded byte count) for the readable parts of a payload. Each part
+    contributes at most max_part_bytes, and decoding stops after max_total_bytes.
+    """
+    pieces = []
+    used = 0
+    for part in iter_text_parts(payload):
+        if used >= max_total_bytes:
+            break
+        text, decoded = decode_part(part, min(max_part_bytes, max_total_bytes - used))
+        used += decoded
+        if part.get('mimeType') == 'text/html':
+            text = html_to_text(text)
+        if text.strip():
+            pieces.append(text.strip())
+    return "\n\n".join(pieces), used
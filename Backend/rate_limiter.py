@@ -0,0 +1,328 @@
+"""
+Shared rate limiting and retries for Gmail and OpenAI calls.
+
+Token buckets track Gmail quota units per second (each API method has its own
+cost) and OpenAI requests and tokens per minute. A bucket never refuses a
+reservation. It goes into debt and tells the caller how long to wait. Waiting
+callers are therefore served in arrival order at the refill rate, which keeps
+throughput near the quota ceiling instead of bursting into 429s and stalling.
+reserve() only returns a delay, so the same buckets work from worker threads
+(time.sleep) and from the event loop (asyncio.sleep). Under the supervisor,
+every worker process draws on the same OpenAI buckets in shared memory
+(SharedTokenBucket), because all mailboxes use one API key. Gmail quota is
+per user, so each mailbox keeps its own Gmail bucket.
+
+Transient failures are retried with exponential backoff and full jitter:
+429s, 5xx responses, Gmail's 403 rate-limit errors and connection errors.
+Retries never happen sooner than a Retry-After header allows. A 429 also
+pauses the whole bucket, so other workers back off too instead of adding to
+the overload.
+
+messages.send is the exception. A send that failed with a 5xx or a dropped
+connection may still have been accepted by Gmail, and sending it again would
+mail the customer twice. Sends are only retried after a 429 or a 403
+rate-limit error, where Gmail certainly rejected the message. Other failures
+go back to the caller, which leaves the email for the next cycle to check.
+"""
+import asyncio
+import multiprocessing
+import random
+import sys
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from multiprocessing.sharedctypes import RawArray
+
+# Quota units per call, from the Gmail API usage limits documentation
+GMAIL_QUOTA_UNITS = {
+    "getProfile": 1,
+    "labels.list": 1,
+    "labels.create": 5,
+    "history.list": 2,
+    "messages.list": 5,
+    "messages.get": 5,
+    "messages.modify": 5,
+    "messages.batchModify": 50,
+    "messages.send": 100,
+    "threads.get": 10,
+    "watch": 100,
+}
+_GMAIL_RATE_LIMIT_REASONS = ("ratelimitexceeded", "userratelimitexceeded")
+# Methods that must not be repeated unless Gmail certainly did not act on them
+_GMAIL_UNSAFE_TO_REPEAT = frozenset({"messages.send"})
+_SCOPE_NAMES = {"gmail": "Gmail", "openai": "OpenAI"}
+
+
+class TokenBucket:
+    """Refills at `rate` tokens per second up to `capacity`, and lends tokens it does not have yet."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def reserve(self, amount):
+        """Takes `amount` tokens and returns how many seconds the caller must wait before using them."""
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            self._tokens -= amount
+            return max(0.0, -self._tokens / self.rate, self._paused_until - now)
+
+    def refund(self, amount):
+        """Returns tokens that were reserved but not used."""
+        with self._lock:
+            self._refill(time.monotonic())
+            self._tokens = min(self.capacity, self._tokens + amount)
+
+    def pause(self, seconds):
+        """Makes every reservation wait at least `seconds` from now."""
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+
+class SharedTokenBucket(TokenBucket):
+    """
+    A TokenBucket whose state lives in shared memory, so several processes draw on one quota.
+    Create it in the parent and pass it to the workers as a Process argument.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        # tokens, updated, paused_until; time.monotonic() is the same clock in every process
+        self._state = RawArray("d", [capacity, time.monotonic(), 0.0])
+        # A spawn-context lock can be handed to workers whatever their start method
+        self._lock = multiprocessing.get_context("spawn").Lock()
+
+    @property
+    def _tokens(self):
+        return self._state[0]
+
+    @_tokens.setter
+    def _tokens(self, value):
+        self._state[0] = value
+
+    @property
+    def _updated(self):
+        return self._state[1]
+
+    @_updated.setter
+    def _updated(self, value):
+        self._state[1] = value
+
+    @property
+    def _paused_until(self):
+        return self._state[2]
+
+    @_paused_until.setter
+    def _paused_until(self, value):
+        self._state[2] = value
+
+
+def shared_openai_buckets(settings):
+    """
+    OpenAI request and token buckets for every worker process of a supervisor.
+    The mailboxes share one API key, so they must share its per-minute quota too.
+    """
+    return {
+        "openai_requests": SharedTokenBucket(settings['openai_requests_per_minute'] / 60, settings['openai_requests_per_minute'] / 60),
+        "openai_tokens": SharedTokenBucket(settings['openai_tokens_per_minute'] / 60, settings['openai_tokens_per_minute'] / 60),
+    }
+
+
+def parse_retry_after(headers):
+    """Reads Retry-After (seconds or an HTTP date) or OpenAI's retry-after-ms. Returns seconds or None."""
+    if headers is None:
+        return None
+    if headers.get("retry-after-ms"):
+        try:
+            return float(headers["retry-after-ms"]) / 1000
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+
+def classify_error(error):
+    """Returns (retryable, status, retry_after_seconds) for an exception raised by a Gmail or OpenAI call."""
+    # Like the OpenAI SDK below, the Google client libraries are only looked up once loaded, so the
+    # supervisor can build shared buckets in the API process without importing them
+    if _is_gmail_http_error(error):
+        status = error.resp.status
+        content = error.content.decode("utf-8", "replace").lower() if isinstance(error.content, bytes) else str(error.content).lower()
+        rate_limited = status == 403 and any(reason in content for reason in _GMAIL_RATE_LIMIT_REASONS)
+        return status == 429 or status >= 500 or rate_limited, 429 if rate_limited else status, parse_retry_after(error.resp)
+    # The bot imports the OpenAI SDK on its first OpenAI call. Until then, no error can come from it.
+    openai = sys.modules.get("openai")
+    if openai is not None and isinstance(error, openai.APIStatusError):
+        # An exhausted billing quota also comes back as a 429, but waiting will not fix it
+        if getattr(error, "code", None) == "insufficient_quota":
+            return False, error.status_code, None
+        retryable = error.status_code in (408, 409, 429) or error.status_code >= 500
+        return retryable, error.status_code, parse_retry_after(error.response.headers)
+    if openai is not None and isinstance(error, openai.APIConnectionError):
+        return True, None, None
+    httplib2 = sys.modules.get("httplib2")
+    if httplib2 is not None and isinstance(error, httplib2.HttpLib2Error):
+        return True, None, None
+    if isinstance(error, (ConnectionError, TimeoutError)):
+        return True, None, None
+    return False, None, None
+
+
+def _is_gmail_http_error(error):
+    errors = sys.modules.get("googleapiclient.errors")
+    return errors is not None and isinstance(error, errors.HttpError)
+
+
+def estimate_request_tokens(request):
+    """Rough token count for an OpenAI request: about four characters per token plus the completion budget."""
+    if "messages" in request:
+        characters = sum(len(message.get("content") or "") for message in request["messages"])
+    else:
+        characters = len(str(request.get("input", "")))
+    return characters // 4 + request.get("max_tokens", 0)
+
+
+class RateLimiter:
+    """Schedules Gmail and OpenAI calls under their quotas and retries transient failures."""
+
+    def __init__(self, gmail_units_per_second, openai_requests_per_minute, openai_tokens_per_minute,
+                 max_retries=5, retry_base_seconds=1.0, retry_max_seconds=60.0):
+        # Capacity is one second of refill, so bursts never run far ahead of the quota
+        self.buckets = {
+            "gmail": TokenBucket(gmail_units_per_second, gmail_units_per_second),
+            "openai_requests": TokenBucket(openai_requests_per_minute / 60, openai_requests_per_minute / 60),
+            "openai_tokens": TokenBucket(openai_tokens_per_minute / 60, openai_tokens_per_minute / 60),
+        }
+        self.max_retries = max_retries
+        self.retry_base_seconds = retry_base_seconds
+        self.retry_max_seconds = retry_max_seconds
+        self._stats = {scope: {"calls": 0, "throttled": 0, "throttle_wait_seconds": 0.0, "retries": 0,
+                               "rate_limited": 0, "server_errors": 0, "failures": 0} for scope in ("gmail", "openai")}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_settings(cls, settings):
+        return cls(settings['gmail_quota_units_per_second'], settings['openai_requests_per_minute'],
+                   settings['openai_tokens_per_minute'], settings['max_retries'],
+                   settings['retry_base_seconds'], settings['retry_max_seconds'])
+
+    def share_buckets(self, buckets):
+        """Replaces buckets with ones shared across processes, e.g. from shared_openai_buckets()."""
+        self.buckets.update(buckets)
+
+    # --- Scheduling ---
+    def _reserve(self, scope, amounts):
+        wait = max(self.buckets[bucket].reserve(amount) for bucket, amount in amounts.items())
+        with self._lock:
+            self._stats[scope]['calls'] += 1
+            if wait > 0:
+                self._stats[scope]['throttled'] += 1
+                self._stats[scope]['throttle_wait_seconds'] += wait
+        return wait
+
+    def _retry_delay(self, scope, buckets, error, attempt, repeatable=True):
+        """
+        Returns how long to wait before retrying, or re-raises once the error is final.
+        A call that is not repeatable is only retried when the API certainly rejected it.
+        """
+        retryable, status, retry_after = classify_error(error)
+        if not repeatable:
+            retryable = retryable and status == 429 and _is_gmail_http_error(error)
+        with self._lock:
+            stats = self._stats[scope]
+            if status == 429:
+                stats['rate_limited'] += 1
+            elif status is not None and status >= 500:
+                stats['server_errors'] += 1
+            if not retryable or attempt >= self.max_retries:
+                stats['failures'] += 1
+                raise error
+            stats['retries'] += 1
+        delay = random.uniform(0, min(self.retry_max_seconds, self.retry_base_seconds * 2 ** attempt))
+        if retry_after is not None:
+            delay = max(delay, retry_after + random.uniform(0, self.retry_base_seconds))
+        if status == 429:
+            for bucket in buckets:
+                self.buckets[bucket].pause(delay)
+        print(f"{_SCOPE_NAMES[scope]} call failed ({status or type(error).__name__}). Retrying in {delay:.1f}s "
+              f"(attempt {attempt + 1} of {self.max_retries}).")
+        return delay
+
+    def _openai_amounts(self, estimated_tokens):
+        return {"openai_requests": 1, "openai_tokens": estimated_tokens}
+
+    def _settle_tokens(self, response, estimated_tokens):
+        usage = getattr(response, "usage", None)
+        if usage is not None and getattr(usage, "total_tokens", None) is not None:
+            self.buckets["openai_tokens"].refund(estimated_tokens - usage.total_tokens)
+
+    # --- Public API ---
+    def gmail(self, fn, method, count=1):
+        """Runs fn() once quota is available for `count` calls of a Gmail method."""
+        amounts = {"gmail": GMAIL_QUOTA_UNITS[method] * count}
+        repeatable = method not in _GMAIL_UNSAFE_TO_REPEAT
+        attempt = 0
+        while True:
+            time.sleep(self._reserve("gmail", amounts))
+            try:
+                return fn()
+            except Exception as error:
+                time.sleep(self._retry_delay("gmail", amounts, error, attempt, repeatable))
+                attempt += 1
+
+    def openai(self, fn, estimated_tokens):
+        """Runs fn() once the OpenAI request and token budgets allow it."""
+        amounts = self._openai_amounts(estimated_tokens)
+        attempt = 0
+        while True:
+            time.sleep(self._reserve("openai", amounts))
+            try:
+                response = fn()
+            except Exception as error:
+                time.sleep(self._retry_delay("openai", amounts, error, attempt))
+                attempt += 1
+                continue
+            self._settle_tokens(response, estimated_tokens)
+            return response
+
+    async def openai_async(self, fn, estimated_tokens):
+        """Awaits fn() once the OpenAI request and token budgets allow it."""
+        amounts = self._openai_amounts(estimated_tokens)
+        attempt = 0
+        while True:
+            await asyncio.sleep(self._reserve("openai", amounts))
+            try:
+                response = await fn()
+            except Exception as error:
+                await asyncio.sleep(self._retry_delay("openai", amounts, error, attempt))
+                attempt += 1
+                continue
+            self._settle_tokens(response, estimated_tokens)
+            return response
+
+    def retry_delay(self, scope, error, attempt):
+        """Backoff for callers that retry themselves, e.g. individual requests inside a Gmail batch."""
+        return self._retry_delay(scope, [scope] if scope == "gmail" else ["openai_requests"], error, attempt)
+
+    def stats(self):
+        with self._lock:
+            return {scope: {key: round(value, 2) if isinstance(value, float) else value for key, value in stats.items()}
+                    for scope, stats in self._stats.items()}
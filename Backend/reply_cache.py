@@ -0,0 +1,282 @@
+"""
+Persistent cache of AI replies for repeated questions.
+
+Replies are keyed on a normalised fingerprint of the latest user message plus
+a knowledge-base version string, so editing the knowledge base or the reply
+prompt invalidates every entry. Lookups try, in order:
+  1. an exact match on the normalised text,
+  2. a near-exact match: 64-bit SimHash within max_distance bits, found
+     through four 16-bit band indexes,
+  3. optionally, cosine similarity over embeddings kept in a NumPy matrix.
+Near and embedding matches also need the same details: the numbers and email
+addresses in the message, such as order or account ids. Two customers who
+ask the same thing about different accounts never share a reply.
+
+The key leaves out the name a message is signed with, so that the same
+question from different customers can share a reply. A reply that uses the
+customer's name, or greets someone by name, is therefore never cached: it
+would reach the next customer addressed as the first one.
+
+Entries expire after ttl_seconds and are evicted least-recently-used once
+max_entries is reached. The cache is saved to a JSON file (with embeddings
+in a sibling .npy file) so it survives restarts.
+"""
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+_WORD = re.compile(r"[a-z0-9]+")
+_QUOTED_LINE = re.compile(r"^\s*>.*$", re.M)
+_GREETING = re.compile(r"^\s*(hi|hello|hey|dear|good (morning|afternoon|evening))\b[^\n,]{0,30}[,\n]", re.I)
+# A sign-off ending the message, followed by at most a short name: letters only, so ids and addresses are kept
+_SIGN_OFF = re.compile(r"(^|[.!?\n])\s*(thanks|thank you|many thanks|regards|kind regards|best|cheers|sincerely)\b"
+                       r"[\s,.!-]*(?P<name>(?:[^\W\d_]+[\s,.!-]*){0,3})$", re.I)
+# "Hi Jane," opening a reply; generic salutations do not name anyone
+_NAMED_GREETING = re.compile(r"^\s*(?:hi|hello|hey|dear)\s+([^\W\d_]+)", re.I)
+_GENERIC_SALUTATIONS = frozenset({"there", "all", "team", "everyone", "customer", "friend", "sir", "madam"})
+_DETAIL = re.compile(r"[\w.+-]+@[\w-]+(?:\.[\w-]+)+|\w*\d[\w-]*")
+_BANDS = 4
+_BAND_BITS = 64 // _BANDS
+
+
+def normalize_text(text):
+    """Drops quoted lines, greetings and sign-offs, then lowercases and strips punctuation."""
+    text = _QUOTED_LINE.sub("", text)
+    text = _SIGN_OFF.sub(r"\1", _GREETING.sub("", text))
+    return " ".join(_WORD.findall(text.lower()))
+
+
+def names_customer(text, reply):
+    """True if the reply uses a name the message is signed with, or opens by greeting someone by name."""
+    greeting = _NAMED_GREETING.match(reply)
+    if greeting and greeting.group(1).lower() not in _GENERIC_SALUTATIONS:
+        return True
+    sign_off = _SIGN_OFF.search(_QUOTED_LINE.sub("", text).strip())
+    names = set(_WORD.findall(sign_off.group("name").lower())) if sign_off else set()
+    return bool(names & set(_WORD.findall(reply.lower())))
+
+
+def message_details(text):
+    """Fingerprint of the numbers and email addresses in a message, outside quoted lines."""
+    details = sorted(set(_DETAIL.findall(_QUOTED_LINE.sub("", text).lower())))
+    return hashlib.sha1("\n".join(details).encode("utf-8")).hexdigest()[:16]
+
+
+def simhash(normalized_text):
+    """64-bit SimHash over word unigrams and bigrams."""
+    words = normalized_text.split()
+    features = words + [" ".join(words[i:i + 2]) for i in range(len(words) - 1)]
+    weights = [0] * 64
+    for feature in features:
+        digest = int.from_bytes(hashlib.blake2b(feature.encode("utf-8"), digest_size=8).digest(), "big")
+        for bit in range(64):
+            weights[bit] += 1 if digest >> bit & 1 else -1
+    return sum(1 << bit for bit in range(64) if weights[bit] > 0)
+
+
+def _bands(fingerprint):
+    return [(i, fingerprint >> (i * _BAND_BITS) & ((1 << _BAND_BITS) - 1)) for i in range(_BANDS)]
+
+
+class ReplyCache:
+    """Thread-safe, disk-backed reply cache with TTL and LRU eviction."""
+
+    def __init__(self, path, max_entries, ttl_seconds, max_distance=3, embedder=None, min_similarity=0.95):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.max_distance = max_distance
+        self.embedder = embedder
+        self.min_similarity = min_similarity
+        self.exact_hits = 0
+        self.near_hits = 0
+        self.embedding_hits = 0
+        self.misses = 0
+        self.saved_tokens = 0
+        self._entries = OrderedDict()
+        self._band_index = {}
+        self._vectors = {}
+        self._matrix = None
+        self._dirty = False
+        self._lock = threading.Lock()
+        self.load()
+
+    @staticmethod
+    def make_key(version, normalized_text):
+        return hashlib.sha1(f"{version}\n{normalized_text}".encode("utf-8")).hexdigest()
+
+    # --- Index maintenance (caller holds the lock) ---
+    def _index(self, key, entry):
+        for band in _bands(entry['simhash']):
+            self._band_index.setdefault((entry['version'],) + band, set()).add(key)
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        for band in _bands(entry['simhash']):
+            bucket = self._band_index.get((entry['version'],) + band)
+            if bucket:
+                bucket.discard(key)
+        if self._vectors.pop(key, None) is not None:
+            self._matrix = None
+        self._dirty = True
+
+    def _expire(self, now):
+        expired = [key for key, entry in self._entries.items() if now - entry['created'] > self.ttl_seconds]
+        for key in expired:
+            self._remove(key)
+
+    def _nearest_by_embedding(self, vector, version, details):
+        import numpy as np
+        if self._matrix is None:
+            keys = list(self._vectors)
+            self._matrix = (keys, np.vstack([self._vectors[k] for k in keys]) if keys else None)
+        keys, matrix = self._matrix
+        if matrix is None:
+            return None
+        scores = matrix @ vector
+        for index in np.argsort(-scores)[:5]:
+            if scores[index] < self.min_similarity:
+                break
+            entry = self._entries[keys[index]]
+            if entry['version'] == version and entry.get('details') == details:
+                return keys[index]
+        return None
+
+    def _find_exact_or_near(self, key, fingerprint, version, details):
+        if key in self._entries:
+            return key, "exact"
+        candidates = set()
+        for band in _bands(fingerprint):
+            candidates |= self._band_index.get((version,) + band, set())
+        candidates = {k for k in candidates if self._entries[k].get('details') == details}
+        distances = {k: bin(self._entries[k]['simhash'] ^ fingerprint).count("1") for k in candidates}
+        best = min(distances, key=distances.get, default=None)
+        if best is not None and distances[best] <= self.max_distance:
+            return best, "near"
+        return None, None
+
+    def _record_lookup(self, key, kind):
+        entry = self._entries.get(key) if key else None
+        if entry is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.saved_tokens += entry['tokens']
+        if kind == "exact":
+            self.exact_hits += 1
+        elif kind == "near":
+            self.near_hits += 1
+        else:
+            self.embedding_hits += 1
+        return entry['reply'], kind
+
+    # --- Public API ---
+    def lookup(self, text, version):
+        """Returns (reply, match_kind) for a cached answer to this text, or None."""
+        normalized = normalize_text(text)
+        key = self.make_key(version, normalized)
+        details = message_details(text)
+        with self._lock:
+            self._expire(time.time())
+            match, kind = self._find_exact_or_near(key, simhash(normalized), version, details)
+
+        if match is None and self.embedder is not None:
+            # Embedding calls are slow, so never make them while holding the lock
+            vector = self._embed(normalized)
+            if vector is not None:
+                with self._lock:
+                    match, kind = self._nearest_by_embedding(vector, version, details), "embedding"
+
+        with self._lock:
+            return self._record_lookup(match, kind)
+
+    def store(self, text, version, reply, tokens):
+        """Caches a freshly generated reply together with the tokens it cost, unless it is addressed to the customer by name."""
+        if names_customer(text, reply):
+            return
+        normalized = normalize_text(text)
+        key = self.make_key(version, normalized)
+        vector = self._embed(normalized) if self.embedder is not None else None
+        entry = {"version": version, "simhash": simhash(normalized), "details": message_details(text), "reply": reply,
+                 "tokens": tokens, "created": time.time()}
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = entry
+            self._index(key, entry)
+            if vector is not None:
+                self._vectors[key] = vector
+                self._matrix = None
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+            self._dirty = True
+
+    def _embed(self, normalized_text):
+        import numpy as np
+        try:
+            vector = np.asarray(self.embedder(normalized_text), dtype=np.float32)
+        except Exception as e:
+            print(f"Error computing reply cache embedding: {e}")
+            return None
+        return vector / (np.linalg.norm(vector) or 1.0)
+
+    def stats(self):
+        with self._lock:
+            hits = self.exact_hits + self.near_hits + self.embedding_hits
+            lookups = hits + self.misses
+            return {
+                "hits": hits,
+                "exact_hits": self.exact_hits,
+                "near_hits": self.near_hits,
+                "embedding_hits": self.embedding_hits,
+                "misses": self.misses,
+                "hit_rate": round(hits / lookups, 3) if lookups else 0.0,
+                "saved_tokens": self.saved_tokens,
+                "entries": len(self._entries),
+            }
+
+    # --- Persistence ---
+    def load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                stored = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return
+        vectors = {}
+        if self.embedder is not None and os.path.exists(f"{self.path}.npy"):
+            import numpy as np
+            matrix = np.load(f"{self.path}.npy")
+            vectors = {key: matrix[i] for i, key in enumerate(stored.get('vector_keys', []))}
+        with self._lock:
+            for key, entry in stored.get('entries', {}).items():
+                self._entries[key] = entry
+                self._index(key, entry)
+                if key in vectors:
+                    self._vectors[key] = vectors[key]
+            self._expire(time.time())
+            self._dirty = False
+        print(f"Loaded {len(self._entries)} cached replies from {self.path}.")
+
+    def save(self):
+        """Writes the cache to disk if it changed since the last save."""
+        with self._lock:
+            if not self._dirty:
+                return
+            entries = dict(self._entries)
+            vector_keys = list(self._vectors)
+            vectors = [self._vectors[key] for key in vector_keys]
+            self._dirty = False
+        if vectors:
+            import numpy as np
+            with open(f"{self.path}.npy.tmp", "wb") as f:
+                np.save(f, np.vstack(vectors))
+            os.replace(f"{self.path}.npy.tmp", f"{self.path}.npy")
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"entries": entries, "vector_keys": vector_keys}, f)
+        os.replace(tmp_path, self.path)
+
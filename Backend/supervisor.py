@@ -0,0 +1,463 @@
+"""
+Runs many mailboxes across a pool of worker processes from one control plane.
+
+Each mailbox is a directory under settings.mailboxes_dir with its own
+config.json, credentials.json and token.json. Relative *_file and *_dir
+settings resolve against that directory, so every mailbox keeps its own sync
+checkpoint, caches and work queue. If the directory holds no mailboxes, the
+Backend directory itself runs as the single mailbox "default".
+
+The pool has up to settings.worker_processes processes (0 means one per
+mailbox). Workers are started with the "spawn" method, because forking the
+multithreaded API process could copy locks that other threads hold. A worker
+that serves several mailboxes runs their cycles one after another: it swaps
+each mailbox's state into the bot module with main.mailbox_context(), so only
+one can run at a time, and a slow cycle delays the others and any stop or
+notify command until it ends. Keep worker_processes at 0, or at least the
+number of mailboxes, to isolate them. The supervisor, which lives in the API
+process, does the following:
+  - gives each newly started mailbox to the least-loaded worker;
+  - moves mailboxes when the load differs by more than one. The target
+    worker only picks a mailbox up after its old worker confirms the stop,
+    so two processes never poll the same inbox;
+  - restarts worker processes that die and hands their mailboxes back out;
+  - picks up mailbox directories added while it is running;
+  - routes Gmail push notifications to the worker serving the mailbox.
+
+In push mode (settings.push_topic_name) a mailbox arms a Gmail watch and only
+polls every settings.push_safety_poll_seconds. A notification wakes it at
+once. Any subscriber can deliver notifications through notify(); the API's
+webhook is one. Push mode needs the supervisor: a bot started on its own has
+nothing to deliver notifications to it, so it ignores push_topic_name. The API
+also refuses push mode unless its settings.push_verification_token is set, and
+its mailboxes then poll at settings.polling_interval_seconds.
+
+Every mailbox writes to its own Telemetry channel. These are preallocated
+(settings.max_mailboxes) because shared memory can only be handed to a
+worker when the worker is spawned. The OpenAI rate limit buckets live in
+shared memory for the same reason: the mailboxes share one API key, so every
+worker draws on the one quota set in the API's config.json.
+"""
+import asyncio
+import heapq
+import multiprocessing
+import os
+import queue
+import threading
+import time
+
+from config_loader import load_config
+from metrics import merge_snapshots, render_prometheus, summarize
+from telemetry import COUNTERS, Telemetry
+
+# Workers never inherit the API process's threads, locks or imported modules
+MP_CONTEXT = multiprocessing.get_context("spawn")
+
+DEFAULT_MAILBOX = "default"
+# How long to wait for workers to finish their current cycle on shutdown
+WORKER_STOP_TIMEOUT_SECONDS = 30
+# How often the supervisor checks for dead workers and new mailbox directories
+MONITOR_INTERVAL_SECONDS = 1.0
+RESCAN_INTERVAL_SECONDS = 10.0
+
+
+def discover_mailboxes(mailboxes_dir, default_dir="."):
+    """Maps mailbox names to directories that contain a config.json."""
+    found = {}
+    if mailboxes_dir and os.path.isdir(mailboxes_dir):
+        for name in sorted(os.listdir(mailboxes_dir)):
+            path = os.path.join(mailboxes_dir, name)
+            if os.path.isfile(os.path.join(path, "config.json")):
+                found[name] = path
+    return found or {DEFAULT_MAILBOX: default_dir}
+
+
+def load_mailbox_config(mailbox_dir):
+    """Loads a mailbox's config.json, resolving relative file and directory settings against mailbox_dir."""
+    config = load_config(os.path.join(mailbox_dir, "config.json"))
+    for key, value in config['settings'].items():
+        if key.endswith(("_file", "_dir")) and isinstance(value, str) and value and not os.path.isabs(value):
+            config['settings'][key] = os.path.join(mailbox_dir, value)
+    return config
+
+
+def default_service_factory(mailbox_dir):
+    """Returns a function building Gmail services with the mailbox's own OAuth credentials."""
+    import main as bot
+    creds = bot.get_gmail_credentials(os.path.join(mailbox_dir, "token.json"), os.path.join(mailbox_dir, "credentials.json"))
+    return lambda: bot.get_gmail_service(creds)
+
+
+# --- Worker process side ---
+# The bot module (main) is imported only here, in the worker processes. The API
+# process never loads it, or the OpenAI and Google client libraries it imports.
+class MailboxRunner:
+    """One mailbox served by a worker process."""
+
+    def __init__(self, name, mailbox_dir, state, service_factory, shared_buckets=None, push_enabled=True):
+        import main as bot
+        self.name = name
+        self.state = state
+        self.context = bot.new_mailbox_context()
+        self.processor = None
+        with bot.mailbox_context(self.context):
+            self.config = load_mailbox_config(mailbox_dir)
+            if self.config['settings']['push_topic_name'] and not push_enabled:
+                print(f"Mailbox '{name}' has a push_topic_name, but push notifications are disabled. Polling instead.")
+                self.config['settings']['push_topic_name'] = ""
+            self.make_service = service_factory(mailbox_dir)
+            self.service, self.label_ids, self.sync_state = bot.setup_mailbox(self.config, self.make_service, shared_buckets)
+            self.email_address = bot.my_email_address
+            settings = self.config['settings']
+            if settings['engine'] != 'asyncio' and settings['worker_count'] > 1:
+                self.processor = bot.ConcurrentEmailProcessor(self.make_service, settings)
+        self.next_run = time.monotonic()
+        state.publish('bot_status', 'Running')
+
+    def notify(self, history_id):
+        """Wakes the mailbox for a push notification unless its sync checkpoint already covers history_id."""
+        if int(history_id) <= int(self.sync_state.get('historyId') or 0):
+            return
+        self.next_run = min(self.next_run, time.monotonic())
+
+    def run_cycle(self):
+        settings = self.config['settings']
+        push = False
+        import main as bot
+        try:
+            with bot.mailbox_context(self.context):
+                push = bot.ensure_push_watch(self.service, self.config)
+                if settings['engine'] == 'asyncio':
+                    from async_engine import run_async_cycle
+                    asyncio.run(run_async_cycle(self.make_service, self.config, self.label_ids, self.state, self.sync_state))
+                else:
+                    bot.process_email_batch(self.service, self.config, self.label_ids, self.state, self.sync_state, self.processor)
+        except Exception as e:
+            print(f"An unexpected error occurred in mailbox '{self.name}': {e}")
+        interval = settings['push_safety_poll_seconds'] if push else settings['polling_interval_seconds']
+        self.next_run = time.monotonic() + interval
+
+    def close(self):
+        import main as bot
+        with bot.mailbox_context(self.context):
+            bot.shutdown_mailbox(self.processor)
+        self.state.publish('bot_status', 'Offline')
+
+
+def worker_main(worker_id, telemetry, commands, events, service_factory, shared_buckets=None, push_enabled=True):
+    """
+    Serves the mailboxes the supervisor assigns to this process, one cycle at a time.
+    Commands are ("start", name, mailbox_dir, slot, reset_stats), ("notify", name, history_id),
+    ("stop", name) and ("shutdown",). Pending commands are handled before the next cycle starts.
+    """
+    runners = {}
+    while True:
+        next_run = min((runner.next_run for runner in runners.values()), default=time.monotonic() + 1.0)
+        try:
+            command = commands.get(timeout=min(1.0, max(0.0, next_run - time.monotonic())))
+        except queue.Empty:
+            command = None
+
+        if command is None:
+            due = min(runners.values(), key=lambda runner: runner.next_run, default=None)
+            if due is not None and due.next_run <= time.monotonic():
+                due.run_cycle()
+        elif command[0] == "start":
+            _, name, mailbox_dir, slot, reset_stats = command
+            state = telemetry[slot]
+            if reset_stats:
+                state.reset_counters()
+            try:
+                runners[name] = MailboxRunner(name, mailbox_dir, state, service_factory, shared_buckets, push_enabled)
+                print(f"Worker {worker_id} is now serving mailbox '{name}'.")
+                events.put(("started", name, runners[name].email_address))
+            except (Exception, SystemExit) as e:
+                print(f"Worker {worker_id} could not start mailbox '{name}': {e}")
+                state.publish('bot_status', 'Error')
+                events.put(("failed", name))
+        elif command[0] == "notify":
+            runner = runners.get(command[1])
+            if runner:
+                runner.notify(command[2])
+        elif command[0] == "stop":
+            runner = runners.pop(command[1], None)
+            if runner:
+                runner.close()
+            events.put(("stopped", command[1]))
+        elif command[0] == "shutdown":
+            for runner in runners.values():
+                runner.close()
+            return
+
+
+# --- API process side ---
+class MailboxSupervisor:
+    """Starts, stops, balances and monitors mailboxes on a pool of worker processes."""
+
+    def __init__(self, mailboxes_dir, default_dir=".", worker_processes=0, max_mailboxes=64, service_factory=None,
+                 openai_buckets=None, push_enabled=True):
+        self.mailboxes_dir = mailboxes_dir
+        self.default_dir = default_dir
+        # With one slot per mailbox, the least-loaded slot is always an idle one
+        self.pool_size = worker_processes or max_mailboxes
+        self.service_factory = service_factory or default_service_factory
+        # From rate_limiter.shared_openai_buckets(); None leaves every mailbox its own OpenAI quota
+        self.openai_buckets = openai_buckets
+        # False when nothing can deliver notifications safely, so mailboxes must not rely on them
+        self.push_enabled = push_enabled
+        self.telemetry = [Telemetry(log_capacity=64) for _ in range(max_mailboxes)]
+        self.mailboxes = {}  # name -> {"dir", "slot", "running", "worker", "email"}
+        self.workers = [None] * self.pool_size  # index -> {"process", "commands"}
+        self.events = MP_CONTEXT.Queue()
+        self._stopping = set()  # Mailboxes whose old worker has not confirmed the stop yet
+        self._lock = threading.RLock()
+        self._closed = threading.Event()
+        self._rescanned_at = 0.0
+        self._monitor = None
+        self.refresh()
+
+    # --- Mailbox registry ---
+    def refresh(self):
+        """Registers mailbox directories that appeared since the last scan. Returns their names."""
+        added = []
+        with self._lock:
+            for name, path in discover_mailboxes(self.mailboxes_dir, self.default_dir).items():
+                if name in self.mailboxes:
+                    continue
+                if len(self.mailboxes) >= len(self.telemetry):
+                    print(f"Cannot add mailbox '{name}': settings.max_mailboxes ({len(self.telemetry)}) reached.")
+                    break
+                self.mailboxes[name] = {"dir": path, "slot": len(self.mailboxes), "running": False, "worker": None, "email": None}
+                self.telemetry[self.mailboxes[name]['slot']].publish('bot_status', 'Offline')
+                added.append(name)
+        return added
+
+    def names(self):
+        with self._lock:
+            return list(self.mailboxes)
+
+    # --- Worker pool ---
+    def _spawn_worker(self, index):
+        commands = MP_CONTEXT.Queue()
+        process = MP_CONTEXT.Process(target=worker_main, name=f"mailbox-worker-{index}", daemon=True,
+                                     args=(index, self.telemetry, commands, self.events, self.service_factory, self.openai_buckets,
+                                           self.push_enabled))
+        process.start()
+        self.workers[index] = {"process": process, "commands": commands}
+        print(f"Started mailbox worker {index} (PID {process.pid}).")
+
+    def _load(self):
+        loads = [0] * self.pool_size
+        for mailbox in self.mailboxes.values():
+            if mailbox['worker'] is not None:
+                loads[mailbox['worker']] += 1
+        return loads
+
+    def _launch(self, name, reset_stats):
+        loads = self._load()
+        index = loads.index(min(loads))
+        if self.workers[index] is None or not self.workers[index]['process'].is_alive():
+            self._spawn_worker(index)
+        mailbox = self.mailboxes[name]
+        mailbox['worker'] = index
+        self.telemetry[mailbox['slot']].publish('bot_status', 'Starting...')
+        self.workers[index]['commands'].put(("start", name, mailbox['dir'], mailbox['slot'], reset_stats))
+
+    def _release(self, name):
+        """Asks the mailbox's worker to stop serving it. The stop is confirmed through self.events."""
+        mailbox = self.mailboxes[name]
+        self.workers[mailbox['worker']]['commands'].put(("stop", name))
+        self._stopping.add(name)
+        mailbox['worker'] = None
+
+    def _rebalance(self):
+        """Moves one mailbox from the busiest to the idlest worker if their loads differ by more than one."""
+        if self._stopping:
+            return
+        loads = self._load()
+        busiest = loads.index(max(loads))
+        if loads[busiest] - min(loads) > 1:
+            name = next(n for n, m in self.mailboxes.items() if m['worker'] == busiest)
+            print(f"Rebalancing: moving mailbox '{name}' off worker {busiest}.")
+            self._release(name)
+
+    # --- Control ---
+    def start(self, name):
+        with self._lock:
+            mailbox = self.mailboxes[name]
+            if mailbox['running']:
+                return False
+            mailbox['running'] = True
+            if name not in self._stopping:
+                self._launch(name, reset_stats=True)
+            return True
+
+    def stop(self, name):
+        with self._lock:
+            mailbox = self.mailboxes[name]
+            if not mailbox['running']:
+                return False
+            mailbox['running'] = False
+            if mailbox['worker'] is not None:
+                self._release(name)
+            return True
+
+    def start_all(self):
+        return [name for name in self.names() if self.start(name)]
+
+    def stop_all(self):
+        return [name for name in self.names() if self.stop(name)]
+
+    def is_running(self, name):
+        with self._lock:
+            return self.mailboxes[name]['running']
+
+    def notify(self, email_address, history_id):
+        """
+        Wakes the mailbox receiving email_address for a Gmail push notification.
+        Returns the mailbox name, or None if no running mailbox has that address.
+        """
+        with self._lock:
+            for name, mailbox in self.mailboxes.items():
+                if mailbox['email'] and mailbox['email'].lower() == email_address.lower():
+                    if mailbox['worker'] is None:
+                        # Stopped or moving; a newly started mailbox catches up with an immediate cycle anyway
+                        return None
+                    self.workers[mailbox['worker']]['commands'].put(("notify", name, history_id))
+                    return name
+        return None
+
+    # --- Monitoring ---
+    def poll(self):
+        """Handles worker events, restarts dead workers, picks up new mailboxes and rebalances."""
+        with self._lock:
+            while True:
+                try:
+                    event, name, *details = self.events.get_nowait()
+                except queue.Empty:
+                    break
+                mailbox = self.mailboxes.get(name)
+                if event == "started":
+                    mailbox['email'] = details[0]
+                elif event == "stopped":
+                    self._stopping.discard(name)
+                    if mailbox['running'] and mailbox['worker'] is None:
+                        self._launch(name, reset_stats=False)
+                elif event == "failed":
+                    mailbox['running'] = False
+                    mailbox['worker'] = None
+
+            for index, worker in enumerate(self.workers):
+                if worker is None or worker['process'].is_alive():
+                    continue
+                print(f"Mailbox worker {index} exited with code {worker['process'].exitcode}. Restarting its mailboxes.")
+                self.workers[index] = None
+                orphans = [name for name, mailbox in self.mailboxes.items() if mailbox['worker'] == index]
+                for name in orphans:
+                    self.mailboxes[name]['worker'] = None
+                    self._stopping.discard(name)
+                for name in orphans:
+                    self._launch(name, reset_stats=False)
+
+            if time.monotonic() - self._rescanned_at >= RESCAN_INTERVAL_SECONDS:
+                self._rescanned_at = time.monotonic()
+                for name in self.refresh():
+                    print(f"Found new mailbox '{name}'.")
+            self._rebalance()
+
+    def _monitor_loop(self):
+        while not self._closed.wait(MONITOR_INTERVAL_SECONDS):
+            try:
+                self.poll()
+            except Exception as e:
+                print(f"An error occurred while supervising mailboxes: {e}")
+
+    def start_monitor(self):
+        self._monitor = threading.Thread(target=self._monitor_loop, name="mailbox-supervisor", daemon=True)
+        self._monitor.start()
+
+    def shutdown(self):
+        """Stops every mailbox and worker, terminating workers that do not finish their cycle in time."""
+        self._closed.set()
+        with self._lock:
+            for worker in self.workers:
+                if worker is not None and worker['process'].is_alive():
+                    worker['commands'].put(("shutdown",))
+            for index, worker in enumerate(self.workers):
+                if worker is None:
+                    continue
+                worker['process'].join(timeout=WORKER_STOP_TIMEOUT_SECONDS)
+                if worker['process'].is_alive():
+                    print(f"Mailbox worker {index} did not stop in time. Terminating process...")
+                    worker['process'].terminate()
+                    worker['process'].join(timeout=5)
+                self.workers[index] = None
+            for mailbox in self.mailboxes.values():
+                mailbox['running'], mailbox['worker'] = False, None
+                self.telemetry[mailbox['slot']].publish('bot_status', 'Offline')
+            self._stopping.clear()
+
+    # --- Dashboard data ---
+    def mailbox_data(self, name, activity_limit=50):
+        with self._lock:
+            mailbox = self.mailboxes[name]
+            state = self.telemetry[mailbox['slot']]
+            worker, email = mailbox['worker'], mailbox['email']
+        return {
+            "mailbox": name,
+            "email": email,
+            "worker": worker,
+            "bot_status": state.document('bot_status', 'Unknown'),
+            "stats": state.stats(),
+            "cache_stats": state.document('cache_stats', {}),
+            "rate_limits": state.document('rate_limits', {}),
+            "context_stats": state.document('context_stats', {}),
+            "metrics": summarize(state.document('metrics', {})),
+            "activity_log": state.recent_activity(activity_limit),
+        }
+
+    def _telemetry_by_name(self):
+        with self._lock:
+            return [(name, self.telemetry[mailbox['slot']]) for name, mailbox in self.mailboxes.items()]
+
+    def prometheus_metrics(self):
+        """Every mailbox's counters and stage histograms in the Prometheus text format."""
+        return render_prometheus([
+            {"mailbox": name, "bot_status": state.document('bot_status', 'Unknown'), "stats": state.stats(),
+             "metrics": state.document('metrics', {})}
+            for name, state in self._telemetry_by_name()])
+
+    def aggregate_data(self, activity_limit=50):
+        """Totals across all mailboxes, plus a per-mailbox summary."""
+        per_mailbox = [self.mailbox_data(name, activity_limit) for name in self.names()]
+        stats = {key: sum(data['stats'][key] for data in per_mailbox) for key in COUNTERS}
+        rate_limits = {}
+        for data in per_mailbox:
+            for scope, counters in data['rate_limits'].items():
+                totals = rate_limits.setdefault(scope, {})
+                for key, value in counters.items():
+                    totals[key] = round(totals.get(key, 0) + value, 2)
+        context_stats = {}
+        for data in per_mailbox:
+            for key, value in data['context_stats'].items():
+                if key == 'max_prompt_tokens':
+                    context_stats[key] = max(context_stats.get(key, 0), value)
+                elif key not in ('avg_prompt_tokens', 'last_prompt_tokens', 'summary_cache'):
+                    context_stats[key] = context_stats.get(key, 0) + value
+        if context_stats.get('replies'):
+            context_stats['avg_prompt_tokens'] = round(context_stats['total_prompt_tokens'] / context_stats['replies'])
+        activity = heapq.merge(*([{**entry, "mailbox": data['mailbox']} for entry in data['activity_log']] for data in per_mailbox),
+                               key=lambda entry: entry.get('timestamp', 0), reverse=True)
+        statuses = {data['bot_status'] for data in per_mailbox}
+        # Histograms add up bucket by bucket, so percentiles across mailboxes come from the merged counts
+        metrics = summarize(merge_snapshots(state.document('metrics', {}) for _, state in self._telemetry_by_name()))
+        return {
+            "bot_status": next((status for status in ('Running', 'Starting...', 'Error') if status in statuses), 'Offline'),
+            "stats": stats,
+            "rate_limits": rate_limits,
+            "context_stats": context_stats,
+            "metrics": metrics,
+            "activity_log": [entry for _, entry in zip(range(activity_limit), activity)],
+            "mailboxes": {data['mailbox']: {"bot_status": data['bot_status'], "worker": data['worker'], "stats": data['stats']}
+                          for data in per_mailbox},
+        }
@@ -0,0 +1,143 @@
+"""
+Lock-free telemetry channel between the bot process and the API process.
+
+The bot writes and the dashboard reads. Nothing goes through a Manager
+process, so an update is a few writes into shared memory rather than an IPC
+round trip, and the bot never waits for the dashboard. There are three
+parts:
+  - counters: a shared array of int64 (processed, replied, ...);
+  - activity: a fixed-size ring buffer of JSON entries. Readers build the
+    newest-first view, so writers never shift a list;
+  - documents: small JSON values such as bot_status, cache_stats and the
+    per-stage latency histograms (metrics.py), each in its own fixed-size slot.
+
+Ring slots and documents are guarded by sequence counters (a seqlock). The
+writer makes the counter odd while it writes and even when it is done. A
+reader retries or skips a slot whose counter changed while it was copying.
+Inside the bot process, writers from several threads share an ordinary
+threading lock, which never crosses a process boundary.
+
+Create the Telemetry in the parent and pass it to the bot process as a
+Process argument.
+"""
+import json
+import struct
+import threading
+from multiprocessing.sharedctypes import RawArray
+
+COUNTERS = ("processed", "replied", "escalated", "ignored")
+DOCUMENTS = ("bot_status", "cache_stats", "rate_limits", "context_stats", "metrics")
+
+# Slot header: sequence counter, entry number (ring only) and payload length
+_HEADER = struct.Struct("qqi")
+_READ_ATTEMPTS = 8
+
+
+class Telemetry:
+    """Counters, an activity ring buffer and JSON documents in shared memory."""
+
+    def __init__(self, log_capacity=256, log_entry_bytes=1024, document_bytes=16384):
+        self.log_capacity = log_capacity
+        self.log_entry_bytes = log_entry_bytes
+        self.document_bytes = document_bytes
+        self._counters = RawArray("q", len(COUNTERS))
+        self._log_head = RawArray("q", 1)
+        self._log = RawArray("B", log_capacity * (_HEADER.size + log_entry_bytes))
+        self._documents = RawArray("B", len(DOCUMENTS) * (_HEADER.size + document_bytes))
+        self._attach()
+
+    def _attach(self):
+        # Byte views make slot copies a single memcpy; slicing a ctypes array builds a list of ints
+        self._log_view = memoryview(self._log).cast("B")
+        self._documents_view = memoryview(self._documents).cast("B")
+        self._write_lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for key in ('_log_view', '_documents_view', '_write_lock'):
+            del state[key]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._attach()
+
+    # --- Seqlock slots ---
+    @staticmethod
+    def _write_slot(buffer, offset, payload, entry_number=0):
+        sequence = _HEADER.unpack_from(buffer, offset)[0]
+        _HEADER.pack_into(buffer, offset, sequence + 1, entry_number, len(payload))
+        start = offset + _HEADER.size
+        buffer[start:start + len(payload)] = payload
+        _HEADER.pack_into(buffer, offset, sequence + 2, entry_number, len(payload))
+
+    @staticmethod
+    def _read_slot(buffer, offset):
+        """Returns (entry_number, payload bytes), or None if the writer kept changing the slot."""
+        for _ in range(_READ_ATTEMPTS):
+            sequence, entry_number, length = _HEADER.unpack_from(buffer, offset)
+            if sequence % 2:
+                continue
+            start = offset + _HEADER.size
+            payload = bytes(buffer[start:start + length])
+            if _HEADER.unpack_from(buffer, offset)[0] == sequence:
+                return entry_number, payload
+        return None
+
+    def _fit(self, value, limit):
+        payload = json.dumps(value, ensure_ascii=False).encode("utf-8")
+        if len(payload) > limit:
+            raise ValueError(f"Telemetry value of {len(payload)} bytes does not fit in a {limit}-byte slot.")
+        return payload
+
+    # --- Writer side (bot process) ---
+    def increment(self, key, amount=1):
+        index = COUNTERS.index(key)
+        with self._write_lock:
+            self._counters[index] += amount
+
+    def reset_counters(self):
+        with self._write_lock:
+            for index in range(len(COUNTERS)):
+                self._counters[index] = 0
+
+    def log(self, entry):
+        """Appends an activity entry, overwriting the oldest once the ring is full."""
+        if len(entry.get("from", "")) > 200:
+            entry = {**entry, "from": entry["from"][:200]}
+        payload = self._fit(entry, self.log_entry_bytes)
+        with self._write_lock:
+            entry_number = self._log_head[0]
+            offset = (entry_number % self.log_capacity) * (_HEADER.size + self.log_entry_bytes)
+            self._write_slot(self._log_view, offset, payload, entry_number)
+            self._log_head[0] = entry_number + 1
+
+    def publish(self, key, value):
+        """Replaces a JSON document such as bot_status or cache_stats."""
+        payload = self._fit(value, self.document_bytes)
+        with self._write_lock:
+            self._write_slot(self._documents_view, DOCUMENTS.index(key) * (_HEADER.size + self.document_bytes), payload)
+
+    # --- Reader side (API process) ---
+    def stats(self):
+        return {key: self._counters[index] for index, key in enumerate(COUNTERS)}
+
+    def recent_activity(self, limit=50):
+        """Returns up to `limit` activity entries, newest first."""
+        head = self._log_head[0]
+        entries = []
+        for entry_number in range(head - 1, max(-1, head - 1 - min(limit, self.log_capacity)), -1):
+            offset = (entry_number % self.log_capacity) * (_HEADER.size + self.log_entry_bytes)
+            slot = self._read_slot(self._log_view, offset)
+            if slot is None:
+                continue
+            if slot[0] != entry_number:
+                break  # The writer has lapped us; everything older is gone too
+            entries.append(json.loads(slot[1]))
+        return entries
+
+    def document(self, key, default=None):
+        slot = self._read_slot(self._documents_view, DOCUMENTS.index(key) * (_HEADER.size + self.document_bytes))
+        if slot is None or not slot[1]:
+            return default
+        return json.loads(slot[1])
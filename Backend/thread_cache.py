@@ -0,0 +1,78 @@
+"""
+LRU cache of parsed Gmail threads, keyed by threadId.
+
+Each entry remembers the thread's historyId and its parsed messages, so the
+bot only has to download messages that are new since the last time it saw
+the thread. Entries are evicted least-recently-used first once either the
+thread count or the approximate memory cap is exceeded.
+"""
+import threading
+from collections import OrderedDict
+
+
+def _entry_size(messages):
+    """Rough size in bytes of a thread's parsed messages."""
+    return sum(len(m['content']) + len(m['from']) + len(m['date']) + len(m['id']) for m in messages)
+
+
+class ThreadCache:
+    """Thread-safe LRU of (historyId, parsed messages) per threadId."""
+
+    def __init__(self, max_threads, max_bytes):
+        self.max_threads = max_threads
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self.hits = 0
+        self.delta_updates = 0
+        self.misses = 0
+        self.evictions = 0
+        self._threads = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, thread_id):
+        """Returns (history_id, messages) for a cached thread, or None."""
+        with self._lock:
+            entry = self._threads.get(thread_id)
+            if entry is None:
+                return None
+            self._threads.move_to_end(thread_id)
+            return entry[0], entry[1]
+
+    def put(self, thread_id, history_id, messages):
+        """Stores a thread's parsed messages, evicting old threads if needed."""
+        size = _entry_size(messages)
+        with self._lock:
+            old = self._threads.pop(thread_id, None)
+            if old is not None:
+                self.total_bytes -= old[2]
+            if size > self.max_bytes:
+                return
+            self._threads[thread_id] = (history_id, messages, size)
+            self.total_bytes += size
+            while len(self._threads) > self.max_threads or self.total_bytes > self.max_bytes:
+                _, (_, _, evicted_size) = self._threads.popitem(last=False)
+                self.total_bytes -= evicted_size
+                self.evictions += 1
+
+    def record(self, outcome):
+        """Counts a lookup outcome: 'hit', 'delta' or 'miss'."""
+        with self._lock:
+            if outcome == 'hit':
+                self.hits += 1
+            elif outcome == 'delta':
+                self.delta_updates += 1
+            else:
+                self.misses += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.delta_updates + self.misses
+            return {
+                "hits": self.hits,
+                "delta_updates": self.delta_updates,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": round((self.hits + self.delta_updates) / lookups, 3) if lookups else 0.0,
+                "threads": len(self._threads),
+                "bytes": self.total_bytes,
+            }
@@ -0,0 +1,152 @@
+"""
+Durable record of per-email progress, so a crash or restart never drops an
+email and never replays a finished step.
+
+Every message moves through fetched -> classified -> replied -> labelled.
+An email left for a later cycle has the attempt counted with record_attempt().
+After too many attempts it moves to 'failed' and is set aside for a human, so
+one message that never succeeds cannot hold the sync position back forever.
+The Gmail message id is the idempotency key and the table's primary key,
+which makes lookups a B-tree probe whose depth barely grows with millions
+of rows. The database runs in WAL mode with synchronous=NORMAL, and
+transitions are buffered in memory and written in batches, so the bot
+never pays an fsync per email. Reads see buffered transitions immediately.
+
+Losing the last unflushed batch in a crash is safe: the bot re-checks the
+Gmail thread for an earlier reply before sending (see main.process_email).
+"""
+import json
+import sqlite3
+import threading
+import time
+
+STATES = ("fetched", "classified", "replied", "labelled", "failed")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS emails (
+    message_id TEXT PRIMARY KEY,
+    thread_id TEXT NOT NULL,
+    state TEXT NOT NULL,
+    intent TEXT,
+    action TEXT,
+    label_key TEXT,
+    reply_text TEXT,
+    email TEXT NOT NULL,
+    updated_at REAL NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0
+) WITHOUT ROWID;
+DROP INDEX IF EXISTS emails_unfinished;
+CREATE INDEX IF NOT EXISTS emails_open ON emails (updated_at) WHERE state NOT IN ('labelled', 'failed');
+CREATE INDEX IF NOT EXISTS emails_updated_at ON emails (updated_at);
+"""
+_COLUMNS = ("message_id", "thread_id", "state", "intent", "action", "label_key", "reply_text", "email", "updated_at", "attempts")
+
+
+class WorkQueue:
+    """SQLite-backed state machine for each email the bot handles."""
+
+    def __init__(self, path, commit_batch_size=64):
+        self.commit_batch_size = commit_batch_size
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(emails)")}
+        if columns and "attempts" not in columns:
+            # Queues written before attempts were counted
+            self._conn.execute("ALTER TABLE emails ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0")
+        self._conn.executescript(_SCHEMA)
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._resumed = False
+        self._requeued = {}  # message_id -> email handed back by requeue()
+
+    def _row_to_job(self, row):
+        job = dict(zip(_COLUMNS, row))
+        job['email'] = json.loads(job['email'])
+        return job
+
+    def get(self, message_id):
+        """Returns the job for a message, or None if the bot has never seen it."""
+        with self._lock:
+            if message_id in self._pending:
+                return dict(self._pending[message_id])
+            row = self._conn.execute(f"SELECT {', '.join(_COLUMNS)} FROM emails WHERE message_id = ?", (message_id,)).fetchone()
+        return self._row_to_job(row) if row else None
+
+    def claim(self, email):
+        """Returns the existing job for an email, or records a new one in the 'fetched' state."""
+        job = self.get(email['id'])
+        if job is None:
+            job = self.advance({"message_id": email['id'], "thread_id": email['threadId'], "email": email, "attempts": 0}, "fetched")
+        return job
+
+    def advance(self, job, new_state, **fields):
+        """Moves a job to new_state, storing any extra fields. The write is batched."""
+        job = {**job, **fields, "state": new_state, "updated_at": time.time()}
+        with self._lock:
+            self._pending[job['message_id']] = job
+            should_flush = len(self._pending) >= self.commit_batch_size
+        if should_flush:
+            self.flush()
+        return dict(job)
+
+    def record_attempt(self, job, max_attempts):
+        """Counts a failed attempt at a job. At max_attempts it moves to 'failed' and is never resumed. Returns the job."""
+        attempts = job.get('attempts', 0) + 1
+        return self.advance(job, "failed" if attempts >= max_attempts else job['state'], attempts=attempts)
+
+    def flush(self):
+        """Writes all buffered transitions in a single transaction."""
+        with self._lock:
+            if not self._pending:
+                return
+            rows = [tuple(json.dumps(job['email']) if column == 'email' else job.get(column) for column in _COLUMNS)
+                    for job in self._pending.values()]
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.executemany(
+                    f"INSERT OR REPLACE INTO emails ({', '.join(_COLUMNS)}) VALUES ({', '.join('?' * len(_COLUMNS))})", rows)
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._pending.clear()
+
+    def take_resumable(self):
+        """
+        Returns emails a previous run left unfinished on the first call per process, and on every call
+        the emails handed back with requeue() since the last one.
+        """
+        with self._lock:
+            requeued, self._requeued = self._requeued, {}
+            if self._resumed:
+                return list(requeued.values())
+            self._resumed = True
+            rows = self._conn.execute(
+                f"SELECT {', '.join(_COLUMNS)} FROM emails WHERE state NOT IN ('labelled', 'failed') ORDER BY updated_at").fetchall()
+        emails = [self._row_to_job(row)['email'] for row in rows]
+        seen = {email['id'] for email in emails}
+        return emails + [email for message_id, email in requeued.items() if message_id not in seen]
+
+    def requeue(self, jobs):
+        """Hands unfinished jobs back for the next take_resumable(), e.g. emails whose label update failed."""
+        with self._lock:
+            for job in jobs:
+                self._requeued[job['message_id']] = job['email']
+
+    def count_unfinished(self):
+        """Number of emails neither labelled nor set aside yet, as of the last flush."""
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM emails WHERE state NOT IN ('labelled', 'failed')").fetchone()[0]
+
+    def prune(self, older_than_seconds):
+        """Deletes finished and failed jobs older than the retention window."""
+        self.flush()
+        with self._lock:
+            self._conn.execute("DELETE FROM emails WHERE state IN ('labelled', 'failed') AND updated_at < ?",
+                               (time.time() - older_than_seconds,))
+
+    def close(self):
+        self.flush()
+        with self._lock:
+            self._conn.close()
@@ -22,16 +22,69 @@ interface ActivityLog {
   time: string;
 }
 
+interface RateLimitStats {
+  calls: number;
+  throttled: number;
+  throttle_wait_seconds: number;
+  retries: number;
+  rate_limited: number;
+  server_errors: number;
+  failures: number;
+}
+
+interface ContextStats {
+  replies: number;
+  avg_prompt_tokens: number;
+  max_prompt_tokens: number;
+  total_prompt_tokens: number;
+  summarized_replies: number;
+  turns_in_threads: number;
+  turns_sent: number;
+}
+
+interface StageLatency {
+  count: number;
+  errors: number;
+  avg_ms: number;
+  p50_ms: number;
+  p90_ms: number;
+  p99_ms: number;
+}
+
+interface Metrics {
+  stages: Record<string, StageLatency>;
+  tokens: { prompt: number; completion: number };
+  batch_size: number;
+  queue_depth: number;
+}
+
 interface DashboardData {
   bot_status: string;
   stats: Stats;
+  rate_limits: Record<string, RateLimitStats>;
+  context_stats?: ContextStats;
+  metrics?: Metrics;
   activity_log: ActivityLog[];
 }
 
+const STAGE_NAMES: Record<string, string> = {
+  cycle: 'Whole cycle',
+  fetch: 'Gmail listing',
+  thread_fetch: 'Thread fetch',
+  intent: 'Intent classification',
+  reply: 'Reply generation',
+  send: 'Sending',
+  label: 'Labelling',
+  email: 'Per email (end to end)',
+};
+
 function App() {
   // --- State Management ---
   const [botStatus, setBotStatus] = useState<string>('Offline');
   const [stats, setStats] = useState<Stats>({ processed: 0, replied: 0, escalated: 0, ignored: 0 });
+  const [rateLimits, setRateLimits] = useState<Record<string, RateLimitStats>>({});
+  const [contextStats, setContextStats] = useState<ContextStats | null>(null);
+  const [metrics, setMetrics] = useState<Metrics | null>(null);
   const [activityLog, setActivityLog] = useState<ActivityLog[]>([]);
   const [isLoading, setIsLoading] = useState<boolean>(true);
 
@@ -42,6 +95,9 @@ function App() {
       const data = response.data;
       setBotStatus(data.bot_status);
       setStats(data.stats);
+      setRateLimits(data.rate_limits ?? {});
+      setContextStats(data.context_stats?.replies ? data.context_stats : null);
+      setMetrics(data.metrics?.stages && Object.keys(data.metrics.stages).length > 0 ? data.metrics : null);
       setActivityLog(data.activity_log);
     } catch (error) {
       console.error("Failed to fetch dashboard data:", error);
@@ -130,6 +186,86 @@ function App() {
             </div>
           </div>
 
+          {/* Rate Limits Section */}
+          {Object.keys(rateLimits).length > 0 && (
+            <div>
+              <h2 className="text-2xl font-semibold mb-6 text-center md:text-left">Rate Limits</h2>
+              <div className="grid grid-cols-1 md:grid-cols-2 gap-8">
+                {Object.entries(rateLimits).map(([api, limits]) => (
+                  <CardSpotlight key={api} className="p-8">
+                    <p className="text-xl font-bold capitalize mb-4 z-10 relative">{api}</p>
+                    <div className="grid grid-cols-2 gap-2 text-zinc-400 z-10 relative">
+                      <span>Calls</span><span className="text-white text-right">{limits.calls}</span>
+                      <span>Throttled</span><span className="text-white text-right">{limits.throttled} ({limits.throttle_wait_seconds}s)</span>
+                      <span>Rate limited (429)</span><span className="text-white text-right">{limits.rate_limited}</span>
+                      <span>Server errors</span><span className="text-white text-right">{limits.server_errors}</span>
+                      <span>Retries</span><span className="text-white text-right">{limits.retries}</span>
+                      <span>Gave up</span><span className="text-white text-right">{limits.failures}</span>
+                    </div>
+                  </CardSpotlight>
+                ))}
+              </div>
+            </div>
+          )}
+
+          {/* Prompt Tokens Section */}
+          {contextStats && (
+            <div>
+              <h2 className="text-2xl font-semibold mb-6 text-center md:text-left">Prompt Tokens</h2>
+              <CardSpotlight className="p-8">
+                <div className="grid grid-cols-2 md:grid-cols-4 gap-2 text-zinc-400 z-10 relative">
+                  <span>Replies</span><span className="text-white text-right">{contextStats.replies}</span>
+                  <span>Avg prompt tokens</span><span className="text-white text-right">{contextStats.avg_prompt_tokens}</span>
+                  <span>Max prompt tokens</span><span className="text-white text-right">{contextStats.max_prompt_tokens}</span>
+                  <span>Total prompt tokens</span><span className="text-white text-right">{contextStats.total_prompt_tokens}</span>
+                  <span>Summarized threads</span><span className="text-white text-right">{contextStats.summarized_replies}</span>
+                  <span>Messages sent in full</span><span className="text-white text-right">{contextStats.turns_sent} / {contextStats.turns_in_threads}</span>
+                </div>
+              </CardSpotlight>
+            </div>
+          )}
+
+          {/* Stage Latency Section */}
+          {metrics && (
+            <div>
+              <h2 className="text-2xl font-semibold mb-6 text-center md:text-left">Stage Latency</h2>
+              <CardSpotlight className="p-8">
+                <div className="overflow-x-auto z-10 relative">
+                  <table className="w-full text-left">
+                    <thead className="border-b border-zinc-700 text-zinc-400">
+                      <tr>
+                        <th className="py-2 px-4">Stage</th>
+                        <th className="py-2 px-4 text-right">Count</th>
+                        <th className="py-2 px-4 text-right">p50 (ms)</th>
+                        <th className="py-2 px-4 text-right">p90 (ms)</th>
+                        <th className="py-2 px-4 text-right">p99 (ms)</th>
+                        <th className="py-2 px-4 text-right">Errors</th>
+                      </tr>
+                    </thead>
+                    <tbody>
+                      {Object.entries(metrics.stages).map(([stage, latency]) => (
+                        <tr key={stage} className="border-b border-zinc-800">
+                          <td className="py-2 px-4">{STAGE_NAMES[stage] ?? stage}</td>
+                          <td className="py-2 px-4 text-right">{latency.count}</td>
+                          <td className="py-2 px-4 text-right">{latency.p50_ms}</td>
+                          <td className="py-2 px-4 text-right">{latency.p90_ms}</td>
+                          <td className="py-2 px-4 text-right">{latency.p99_ms}</td>
+                          <td className="py-2 px-4 text-right">{latency.errors}</td>
+                        </tr>
+                      ))}
+                    </tbody>
+                  </table>
+                  <div className="grid grid-cols-2 md:grid-cols-4 gap-2 text-zinc-400 mt-6">
+                    <span>Last batch</span><span className="text-white text-right">{metrics.batch_size} emails</span>
+                    <span>Unfinished queue</span><span className="text-white text-right">{metrics.queue_depth} emails</span>
+                    <span>Prompt tokens</span><span className="text-white text-right">{metrics.tokens.prompt}</span>
+                    <span>Completion tokens</span><span className="text-white text-right">{metrics.tokens.completion}</span>
+                  </div>
+                </div>
+              </CardSpotlight>
+            </div>
+          )}
+
           {/* Activity Log Section */}
           <div className="bg-black/50 backdrop-blur-sm border border-zinc-800 p-6 rounded-lg shadow-lg">
             <h2 className="text-2xl font-semibold mb-6">Activity Log</h2>